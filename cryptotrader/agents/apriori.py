@@ -1,7 +1,10 @@
 from time import time, sleep
+import random
 
 from ..core import Agent
 from ..utils import *
+from ..envs.batch import BatchBacktestEnvironment
+from .parallel import GenerationMap, FitPool, SeededMap, stack_params
 
 import optunity as ot
 import pandas as pd
@@ -162,9 +165,110 @@ class APrioriAgent(Agent):
                                                                              int(100 * self.step / nb_max_episode_steps)))
             return 0.0
 
+    # Batch methods
+    def batch_param(self, params, key, default, n_portfolios):
+        """
+        Read a parameter from a batch parameters dict
+        :param params: dict: Parameters names and (n_portfolios,) arrays of values
+        :param key: str: Parameter name
+        :param default: Value used when key is not on params
+        :param n_portfolios: int: Batch size
+        :return: numpy array: (n_portfolios,) parameter values
+        """
+        return np.broadcast_to(np.asarray(params.get(key, default)), (n_portfolios,))
+
+    def batch_initial_vector(self, obs):
+        """
+        Equal weights on pairs and no fiat for every portfolio, as the first step of rebalance
+        :param obs: tuple: BatchBacktestEnvironment observation
+        :return: numpy array: (n_portfolios, n_symbols) portfolio vectors
+        """
+        n_portfolios, n_symbols = obs[1].shape[1:]
+        action = np.ones(n_symbols)
+        action[-1] = 0
+        return np.tile(array_normalize(action), (n_portfolios, 1))
+
+    def batch_activation(self, b):
+        """
+        Apply agent activation on each row of b
+        :param b: numpy array: (n_portfolios, n_symbols) portfolio vectors
+        :return: numpy array:
+        """
+        if self.activation is simplex_proj:
+            return batch_simplex_proj(b)
+        return np.array([self.activation(row) for row in b], dtype=np.float64)
+
+    def batch_predict(self, obs, params):
+        """
+        Vectorized predict for many parameter sets
+        :param obs: tuple: BatchBacktestEnvironment observation
+        :param params: dict: Parameters names and (n_portfolios,) arrays of values
+        :return: numpy array: (n_portfolios, n) predictions
+        """
+        raise NotImplementedError("%s does not support batch backtests." % str(self))
+
+    def batch_rebalance(self, obs, params):
+        """
+        Vectorized rebalance for many parameter sets
+        :param obs: tuple: BatchBacktestEnvironment observation
+        :param params: dict: Parameters names and (n_portfolios,) arrays of values
+        :return: numpy array: (n_portfolios, n_symbols) portfolio vectors
+        """
+        raise NotImplementedError("%s does not support batch backtests." % str(self))
+
+    def batch_test(self, env, params, nb_max_episode_steps=None):
+        """
+        Test many parameter sets at once on a batch environment.
+        Rewards accumulate as in test, one episode per parameter set.
+        :param env: BatchBacktestEnvironment instance
+        :param params: dict: Parameters names and (n_portfolios,) arrays of values, as set_params kwargs
+        :param nb_max_episode_steps: Number of steps for one episode
+        :return: numpy array: (n_portfolios,) episode rewards
+        """
+        # Get env params
+        self.fiat = env.env._fiat
+        n_portfolios = max([np.size(value) for value in params.values()] + [1])
+
+        env.reset_status()
+        obs = env.reset(n_portfolios)
+
+        # Get max episode length
+        if nb_max_episode_steps is None:
+            nb_max_episode_steps = env.data_length
+
+        self.step = 0
+        episode_reward = np.zeros(n_portfolios)
+        while True:
+            action = self.batch_rebalance(obs, params)
+            obs, reward, _, status = env.step(action)
+
+            # Accumulate returns and regret
+            std = env.portval_std()
+            episode_reward += reward / np.where(std > 0, std, self.epsilon)
+
+            self.step += 1
+
+            if status['OOD'] or self.step == nb_max_episode_steps:
+                return episode_reward
+
+    def score(self, env, batch_size, **kwargs):
+        """
+        Average test reward over a batch of episodes
+        :param env: BacktestEnvironment instance
+        :param batch_size: Number of episodes
+        :param kwargs: test kwargs
+        :return: float: Average episode reward
+        """
+        batch_reward = 0
+        for batch in range(batch_size):
+            # sample environment
+            batch_reward += self.test(env, nb_episodes=1, verbose=False, **kwargs)
+
+        return batch_reward / batch_size
+
     def fit(self, env, nb_steps, batch_size, search_space, constraints=None, action_repetition=1, callbacks=None, verbose=1,
             visualize=False, nb_max_start_steps=0, start_step_policy=None, log_interval=10000,
-            nb_max_episode_steps=None):
+            nb_max_episode_steps=None, batched=False, n_workers=1, seed=None):
         """
         Fit the model on parameters on the environment
         :param env: BacktestEnvironment instance
@@ -180,14 +284,25 @@ class APrioriAgent(Agent):
         :param start_step_policy:
         :param log_interval:
         :param nb_max_episode_steps: Number of steps for one episode
+        :param batched: bool: Score each optimizer generation in one vectorized replay with batch_test.
+        The agent must implement batch_rebalance.
+        :param n_workers: int: Score each optimizer generation across a pool of n_workers processes
+        :param seed: int: Random seed. Evaluations reset it before each candidate, so all candidates are tested
+        on the same episodes and serial and parallel fits find the same parameters
         :return: tuple: Optimal parameters, information about the optimization process
         """
+        assert not (batched and n_workers > 1), "Choose whether batched or parallel fit."
+        pool = None
         try:
             # Initialize train
             env.training = True
             i = 0
             t0 = time()
 
+            if seed is not None:
+                random.seed(seed)
+                np.random.seed(seed)
+
             if verbose:
                 print("Optimizing model for %d steps with batch size %d..." % (nb_steps, batch_size))
 
@@ -207,6 +322,39 @@ class APrioriAgent(Agent):
             if not constraints:
                 constraints = [lambda *args, **kwargs: True]
 
+            test_kwargs = dict(action_repetition=action_repetition,
+                               callbacks=callbacks,
+                               visualize=visualize,
+                               nb_max_episode_steps=nb_max_episode_steps,
+                               nb_max_start_steps=nb_max_start_steps,
+                               start_step_policy=start_step_policy)
+
+            # Score whole optimizer generations at once on batched or parallel fit
+            tree = ot.search_spaces.SearchTree(search_space)
+            if batched:
+                batch_env = BatchBacktestEnvironment(env)
+
+                def batch_score(candidates):
+                    params = stack_params(candidates)
+                    batch_reward = np.zeros(len(candidates))
+                    for batch in range(batch_size):
+                        batch_reward += self.batch_test(batch_env, params, nb_max_episode_steps=nb_max_episode_steps)
+                    return batch_reward / batch_size
+
+                pmap = GenerationMap(batch_score, tree.to_box(), tree, constraints)
+
+            elif n_workers > 1:
+                pool = FitPool(self, env, n_workers, batch_size,
+                               seed if seed is not None else np.random.randint(2 ** 31 - 1), **test_kwargs)
+                pmap = GenerationMap(pool, tree.to_box(), tree, constraints)
+
+            elif seed is not None:
+                pool = SeededMap(self, env, batch_size, seed, **test_kwargs)
+                pmap = GenerationMap(pool, tree.to_box(), tree, constraints)
+
+            else:
+                pmap = map
+
             # Then, define optimization routine
             @ot.constraints.constrained(constraints)
             @ot.constraints.violations_defaulted(-100)
@@ -215,25 +363,16 @@ class APrioriAgent(Agent):
                     # Init variables
                     nonlocal i, nb_steps, t0, env, nb_max_episode_steps
 
+                    # Return generation score if available
+                    if pmap is not map and pmap.cached(kwargs):
+                        i += 1
+                        return pmap.pop(kwargs)
+
                     # Sample params
                     self.set_params(**kwargs)
 
                     # Try model for a batch
-                    batch_reward = 0
-                    for batch in range(batch_size):
-                        # sample environment
-                        r = self.test(env,
-                                        nb_episodes=1,
-                                        action_repetition=action_repetition,
-                                        callbacks=callbacks,
-                                        visualize=visualize,
-                                        nb_max_episode_steps=nb_max_episode_steps,
-                                        nb_max_start_steps=nb_max_start_steps,
-                                        start_step_policy=start_step_policy,
-                                        verbose=False)
-
-                        # Accumulate reward
-                        batch_reward += r
+                    batch_reward = self.score(env, batch_size, **test_kwargs)
 
                     # Increment step counter
                     i += 1
@@ -242,13 +381,13 @@ class APrioriAgent(Agent):
                     if verbose:
                         print("Optimization step {0}/{1}, step reward: {2}, ETC: {3}                     ".format(i,
                                                                             nb_steps,
-                                                                            batch_reward / batch_size,
+                                                                            batch_reward,
                                                                             str(pd.to_timedelta((time() - t0) * (nb_steps - i), unit='s'))),
                               end="\r")
                         t0 = time()
 
-                    # Average rewards and return
-                    return batch_reward / batch_size
+                    # Return average rewards
+                    return batch_reward
 
                 except KeyboardInterrupt:
                     raise ot.api.fun.MaximumEvaluationsException(0)
@@ -275,9 +414,17 @@ class APrioriAgent(Agent):
             # Call optimizer
             opt_params, info, _ = ot.maximize_structured(find_hp,
                                               num_evals=nb_steps,
-                                              search_space=search_space
+                                              search_space=search_space,
+                                              pmap=pmap
                                               )
 
+            # Report evaluation speed
+            info.stats['evals_per_second'] = info.stats['num_evals'] / info.stats['time']
+            if verbose:
+                print("\n%d evaluations in %.2f s, %.2f evaluations/s" % (info.stats['num_evals'],
+                                                                           info.stats['time'],
+                                                                           info.stats['evals_per_second']))
+
             # Update model params with optimal
             self.set_params(**opt_params)
 
@@ -294,6 +441,10 @@ class APrioriAgent(Agent):
             print("\nOptimization interrupted by user.")
             return opt_params, info
 
+        finally:
+            if pool:
+                pool.close()
+
     # Trade methods
     def trade(self, env, start_step=0, act_now=False, timeout=None, verbose=False, render=False, email=False, save_dir="./"):
         """
@@ -839,6 +990,98 @@ class Momentum(APrioriAgent):
         # project it onto simplex
         return self.activation(b)
 
+    def batch_ma(self, opens, window, mean_type):
+        """
+        Moving averages on the last two bars for each parameter set
+        :param opens: numpy array: (obs_steps, n_pairs) open prices
+        :param window: numpy array: (n_portfolios,) windows
+        :param mean_type: numpy array: (n_portfolios,) mean types
+        :return: numpy array: (2, n_portfolios, n_pairs) moving averages on bars -2 and -1
+        """
+        if not np.isin(mean_type, ['simple', 'exp']).all():
+            raise TypeError("Batch backtests support simple and exp mean_type only.")
+
+        n = opens.shape[0]
+        ma = np.empty((2, window.shape[0], opens.shape[1]))
+
+        # Rolling mean, nan until window bars are available
+        cumsum = np.concatenate([np.zeros((1, opens.shape[1])), np.cumsum(opens, axis=0)])
+        for i, end in enumerate([n - 1, n]):
+            start = end - window
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ma[i] = np.where((start >= 0)[:, None], (cumsum[end] - cumsum[np.maximum(start, 0)]) /
+                                 window[:, None], np.nan)
+
+        # Adjusted exponential mean over the whole observation
+        alpha = 2. / (window + 1.)
+        decay = (1 - alpha[:, None]) ** np.arange(n - 1, -1, -1)
+        exp_ma = np.stack([decay[:, 1:].dot(opens[:-1]) / decay[:, 1:].sum(axis=1, keepdims=True),
+                           decay.dot(opens) / decay.sum(axis=1, keepdims=True)])
+
+        return np.where((mean_type == 'exp')[:, None], exp_ma, ma)
+
+    def batch_predict(self, obs, params):
+        """
+        Momentum factor for each parameter set
+        """
+        ohlc, portfolio = obs
+        n_portfolios = portfolio.shape[1]
+        opens = ohlc[:, :, 0]
+
+        mean_type = self.batch_param(params, 'mean_type', self.mean_type, n_portfolios)
+        ma1 = self.batch_ma(opens, self.batch_param(params, 'ma1', self.ma_span[0], n_portfolios).astype(np.int64),
+                            mean_type)
+        ma2 = self.batch_ma(opens, self.batch_param(params, 'ma2', self.ma_span[1], n_portfolios).astype(np.int64),
+                            mean_type)
+        alpha_v = self.batch_param(params, 'alpha_v', self.weights[0], n_portfolios)[:, None]
+        alpha_a = self.batch_param(params, 'alpha_a', self.weights[1], n_portfolios)[:, None]
+
+        p = ma1[-1] - ma2[-1]
+        d = p - (ma1[-2] - ma2[-2])
+
+        # Sample std of the last std_span bars
+        std_span = np.clip(self.batch_param(params, 'std_span', self.std_span, n_portfolios).astype(np.int64),
+                           1, opens.shape[0])
+        cumsum = np.concatenate([np.zeros((1, opens.shape[1])), np.cumsum(opens, axis=0)])
+        cumsum_sq = np.concatenate([np.zeros((1, opens.shape[1])), np.cumsum(opens ** 2, axis=0)])
+        total = cumsum[-1] - cumsum[-std_span - 1]
+        total_sq = cumsum_sq[-1] - cumsum_sq[-std_span - 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(np.maximum(total_sq - total ** 2 / std_span[:, None], 0) / (std_span - 1)[:, None])
+
+        factor = np.zeros((n_portfolios, opens.shape[1] + 1))
+        factor[:, :-1] = alpha_v * (p + alpha_a * d) / (std + self.epsilon)
+
+        return factor / factor.sum(axis=1, keepdims=True) + 1
+
+    def batch_rebalance(self, obs, params):
+        if self.step == 0:
+            return self.batch_initial_vector(obs)
+        else:
+            n_portfolios = obs[1].shape[1]
+            return self.batch_update(obs[1][self.reb], self.batch_predict(obs, params),
+                                     self.batch_param(params, 'sensitivity', self.sensitivity, n_portfolios))
+
+    def batch_update(self, b, x, sensitivity):
+        """
+        Vectorized update
+        :param b: numpy array: (n_portfolios, n_symbols) last portfolio vectors
+        :param x: numpy array: (n_portfolios, n_symbols) price movement predictions
+        :param sensitivity: numpy array: (n_portfolios,) sensitivity values
+        """
+        x_mean = x.mean(axis=1, keepdims=True)
+        portvar = (b * x).sum(axis=1)
+
+        change = (abs(portvar - 1) + abs(x - 1).max(axis=1)) / 2
+
+        lam = np.clip((change - sensitivity) / (((x - x_mean) ** 2).sum(axis=1) + self.epsilon), 0.0, 1e6)
+
+        # update portfolio
+        b = b + lam[:, None] * (x - x_mean)
+
+        # project it onto simplex
+        return self.batch_activation(b)
+
     def rebalance(self, obs):
         try:
             obs = obs.astype(np.float64)
@@ -861,6 +1104,8 @@ class Momentum(APrioriAgent):
         self.mean_type = kwargs['mean_type']
         self.ma_span = [int(kwargs['ma1']), int(kwargs['ma2'])]
         self.std_span = int(kwargs['std_span'])
+        if 'sensitivity' in kwargs:
+            self.sensitivity = kwargs['sensitivity']
 
 
 class ONS(APrioriAgent):
@@ -1134,6 +1379,9 @@ class PAMR(APrioriAgent):
             le = portvar - (1 + self.sensitivity)
         # elif portvar < 1 - self.sensitivity:
         #     le = (1 - self.sensitivity) - portvar
+        else:
+            # No loss, the portfolio is kept
+            le = 0.
 
         if self.variant == 'PAMR0':
             lam = le / (np.linalg.norm(x - x_mean) ** 2 + self.epsilon)
@@ -1153,12 +1401,61 @@ class PAMR(APrioriAgent):
         # project it onto simplex
         return simplex_proj(b)
 
+    def batch_predict(self, obs, params):
+        """
+        Price relative, the same for all parameter sets
+        """
+        ohlc, portfolio = obs
+        price_relative = np.append(ohlc[-2, :, 0] / (ohlc[-1, :, 0] + self.epsilon), [1.])
+        return np.tile(price_relative, (portfolio.shape[1], 1))
+
+    def batch_rebalance(self, obs, params):
+        if self.step == 0:
+            return self.batch_initial_vector(obs)
+        else:
+            n_portfolios = obs[1].shape[1]
+            return self.batch_update(obs[1][-2], self.batch_predict(obs, params),
+                                     self.batch_param(params, 'sensitivity', self.sensitivity, n_portfolios),
+                                     self.batch_param(params, 'C', self.C, n_portfolios).astype(np.float64),
+                                     self.batch_param(params, 'variant', self.variant, n_portfolios))
+
+    def batch_update(self, b, x, sensitivity, C, variant):
+        """
+        Vectorized update
+        :param b: numpy array: (n_portfolios, n_symbols) last portfolio vectors
+        :param x: numpy array: (n_portfolios, n_symbols) price movement predictions
+        :param sensitivity: numpy array: (n_portfolios,) sensitivity values
+        :param C: numpy array: (n_portfolios,) aggressiveness values
+        :param variant: numpy array: (n_portfolios,) variant names
+        """
+        if not np.isin(variant, ['PAMR0', 'PAMR1', 'PAMR2']).all():
+            raise TypeError("Bad variant param.")
+
+        x_mean = x.mean(axis=1, keepdims=True)
+        portvar = (b * x).sum(axis=1)
+        le = np.maximum(portvar - (1 + sensitivity), 0.)
+        norm = ((x - x_mean) ** 2).sum(axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lam = np.select([variant == 'PAMR0', variant == 'PAMR1', variant == 'PAMR2'],
+                            [le / (norm + self.epsilon),
+                             np.minimum(C, le / (norm + self.epsilon)),
+                             le / (norm + 0.5 / C + self.epsilon)])
+
+        # limit lambda to avoid numerical problems
+        lam = np.minimum(100000, lam)
+
+        # update portfolio
+        b = b + lam[:, None] * (x - x_mean)
+
+        # project it onto simplex
+        return batch_simplex_proj(b)
+
     def set_params(self, **kwargs):
         self.sensitivity = kwargs['sensitivity']
         if 'C' in kwargs:
             self.C = kwargs['C']
         self.variant = kwargs['variant']
-        self.alpha = kwargs['alpha']
 
 
 class OLMAR(APrioriAgent):
@@ -1233,6 +1530,57 @@ class OLMAR(APrioriAgent):
         # project it onto simplex
         return np.append(simplex_proj(b), [0])
 
+    def batch_predict(self, obs, params):
+        """
+        Moving average reversion prediction for each window
+        """
+        ohlc, portfolio = obs
+        n_portfolios = portfolio.shape[1]
+        window = self.batch_param(params, 'window', self.window, n_portfolios).astype(np.int64)
+
+        # Mean of the window bars before the last one, clipped to the observation as iloc would
+        opens = ohlc[:, :, 0]
+        end = opens.shape[0] - 1
+        start = np.clip(end - window, 0, end)
+        cumsum = np.concatenate([np.zeros((1, opens.shape[1])), np.cumsum(opens, axis=0)])
+        mean = (cumsum[end] - cumsum[start]) / np.maximum(end - start, 1)[:, None]
+
+        return mean / (opens[-1] + self.epsilon)
+
+    def batch_rebalance(self, obs, params):
+        if self.step == 0:
+            return self.batch_initial_vector(obs)
+        else:
+            n_portfolios = obs[1].shape[1]
+            return self.batch_update(obs[1][-2][:, :-1], self.batch_predict(obs, params),
+                                     self.batch_param(params, 'eps', self.eps, n_portfolios),
+                                     self.batch_param(params, 'smooth', self.smooth, n_portfolios))
+
+    def batch_update(self, b, x, eps, smooth):
+        """
+        Vectorized update
+        :param b: numpy array: (n_portfolios, n_pairs) last portfolio vectors, without fiat
+        :param x: numpy array: (n_portfolios, n_pairs) price movement predictions
+        :param eps: numpy array: (n_portfolios,) threshold values
+        :param smooth: numpy array: (n_portfolios,) smoothing values
+        """
+        x_mean = x.mean(axis=1, keepdims=True)
+        portvar = (b * x).sum(axis=1)
+        norm = ((x - x_mean) ** 2).sum(axis=1) + self.epsilon
+
+        lam = np.where(portvar >= 1, np.maximum(0., (portvar - 1 - eps) / norm),
+                       np.maximum(0., (1 - eps - portvar) / norm))
+
+        # limit lambda to avoid numerical problems
+        lam = np.minimum(100000, lam)
+
+        # update portfolio
+        b = b + (smooth * lam)[:, None] * (x - x_mean)
+
+        # project it onto simplex
+        b = batch_simplex_proj(b)
+        return np.append(b, np.zeros((b.shape[0], 1)), axis=1)
+
     def set_params(self, **kwargs):
         self.eps = kwargs['eps']
         self.window = int(kwargs['window'])
@@ -1311,6 +1659,44 @@ class STMR(APrioriAgent):
         # project it onto simplex
         return self.activation(b)
 
+    def batch_predict(self, obs, params):
+        """
+        Price relative change, the same for all parameter sets
+        """
+        ohlc, portfolio = obs
+        price_relative = np.append(ohlc[-2, :, 0] / (ohlc[-1, :, 0] + self.epsilon) - 1, [0.])
+        return np.tile(price_relative, (portfolio.shape[1], 1))
+
+    def batch_rebalance(self, obs, params):
+        if self.step == 0:
+            return self.batch_initial_vector(obs)
+        else:
+            n_portfolios = obs[1].shape[1]
+            return self.batch_update(obs[1][self.reb], self.batch_predict(obs, params),
+                                     self.batch_param(params, 'sensitivity', self.sensitivity, n_portfolios))
+
+    def batch_update(self, b, x, sensitivity):
+        """
+        Vectorized update
+        :param b: numpy array: (n_portfolios, n_symbols) last portfolio vectors
+        :param x: numpy array: (n_portfolios, n_symbols) price movement predictions
+        :param sensitivity: numpy array: (n_portfolios,) sensitivity values
+        """
+        x_mean = x.mean(axis=1, keepdims=True)
+        portvar = (b * x).sum(axis=1)
+
+        rows = np.arange(x.shape[0])
+        change = abs((portvar + x[rows, np.argmax(abs(x), axis=1)]) / 2)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lam = np.clip((change - sensitivity) / ((x - x_mean) ** 2).sum(axis=1), 0.0, 1e6)
+
+        # update portfolio
+        b = b + lam[:, None] * (x - x_mean)
+
+        # project it onto simplex
+        return self.batch_activation(b)
+
     def set_params(self, **kwargs):
         self.sensitivity = kwargs['sensitivity']
 
@@ -1405,7 +1791,7 @@ class CWMR(APrioriAgent):
             # update mu and sigma
             U_sqroot = 0.5 * (-lam * theta * V + sqrt(lam ** 2 * theta ** 2 * V ** 2 + 4 * V))
             mu = mu - lam * sigma * (x - x_upper) / M
-            sigma = inv(inv(sigma) + theta * lam / U_sqroot * diag(x) ** 2)
+            sigma = inv(inv(sigma) + np.multiply(theta * lam / U_sqroot, diag(np.asarray(x).ravel()) ** 2))
             """
             tmp_sigma = inv(inv(sigma) + theta*lam/U_sqroot*diag(xt)^2);
             % Don't update sigma if results are badly scaled.
@@ -1435,7 +1821,7 @@ class CWMR(APrioriAgent):
 
             # update mu and sigma
             mu = mu - lam * sigma * (x - x_upper) / M
-            sigma = inv(inv(sigma) + 2 * lam * theta * diag(x) ** 2)
+            sigma = inv(inv(sigma) + 2 * lam * theta * diag(np.asarray(x).ravel()) ** 2)
             """
             tmp_sigma = inv(inv(sigma) + theta*lam/U_sqroot*diag(xt)^2);
             % Don't update sigma if results are badly scaled.
@@ -1446,6 +1832,76 @@ class CWMR(APrioriAgent):
 
             return mu, sigma
 
+    def batch_predict(self, obs, params):
+        """
+        Price relative, the same for all parameter sets
+        """
+        ohlc, portfolio = obs
+        price_relative = np.append(ohlc[-2, :, 0] / (ohlc[-1, :, 0] + self.epsilon), [1.])
+        return np.tile(price_relative, (portfolio.shape[1], 1))
+
+    def batch_rebalance(self, obs, params):
+        n_portfolios, n_symbols = obs[1].shape[1:]
+        if self.step:
+            theta = scipy.stats.norm.ppf(self.batch_param(params, 'confidence', scipy.stats.norm.cdf(self.theta),
+                                                          n_portfolios).astype(np.float64))
+            return self.batch_update(obs[1][self.reb], self.batch_predict(obs, params),
+                                     self.batch_param(params, 'eps', self.eps, n_portfolios), theta)
+        else:
+            self.batch_sigma = np.tile(np.eye(n_symbols) / n_symbols ** 2, (n_portfolios, 1, 1))
+            return self.batch_initial_vector(obs)
+
+    def batch_update(self, b, x, eps, theta):
+        """
+        Vectorized update, one distribution per parameter set
+        :param b: numpy array: (n_portfolios, n_symbols) last portfolio vectors
+        :param x: numpy array: (n_portfolios, n_symbols) price relatives
+        :param eps: numpy array: (n_portfolios,) mean reversion thresholds
+        :param theta: numpy array: (n_portfolios,) confidence quantiles
+        """
+        m = x.shape[1]
+        mu = b
+        sigma = self.batch_sigma
+
+        # 4. Calculate the following variables
+        M = (mu * x).sum(axis=1)
+        V = np.einsum('ki,kij,kj->k', x, sigma, x)
+        x_upper = (np.diagonal(sigma, axis1=1, axis2=2) * x).sum(axis=1) / np.trace(sigma, axis1=1, axis2=2)
+        foo = (V - x_upper * (sigma.sum(axis=2) * x).sum(axis=1)) / M ** 2
+
+        # 5. Update the portfolio distribution
+        with np.errstate(invalid='ignore'):
+            if not self.var:
+                foo = foo + V * theta ** 2 / 2.
+                a = foo ** 2 - V ** 2 * theta ** 4 / 4
+                b = 2 * (eps - log(M)) * foo
+                c = (eps - log(M)) ** 2 - V * theta ** 2
+            else:
+                a = 2 * theta * V * foo
+                b = foo + 2 * theta * V * (eps - log(M))
+                c = eps - log(M) - theta * V
+
+            # nan roots are ignored, as max does
+            lam = np.fmax(0, np.fmax((-b + sqrt(b ** 2 - 4 * a * c)) / (2. * a),
+                                     (-b - sqrt(b ** 2 - 4 * a * c)) / (2. * a)))
+        # bound it due to numerical problems
+        lam = np.minimum(lam, 1E+7)
+
+        # update mu and sigma
+        mu = mu - lam[:, None] * np.einsum('kij,kj->ki', sigma, x - x_upper[:, None]) / M[:, None]
+        if not self.var:
+            U_sqroot = 0.5 * (-lam * theta * V + sqrt(lam ** 2 * theta ** 2 * V ** 2 + 4 * V))
+            scale = theta * lam / U_sqroot
+        else:
+            scale = 2 * lam * theta
+        sigma = inv(inv(sigma) + scale[:, None, None] * (np.eye(m) * x[:, None, :] ** 2))
+
+        # 6. Normalize mu and sigma
+        mu = batch_simplex_proj(mu)
+        self.batch_sigma = sigma / (m ** 2 * np.trace(sigma, axis1=1, axis2=2))[:, None, None]
+
+        return mu
+
     def rebalance(self, obs):
         """
         Performs portfolio rebalance within environment
@@ -1531,6 +1987,29 @@ class TCO(APrioriAgent):
         # project it onto simplex
         return simplex_proj(b)
 
+    def batch_rebalance(self, obs, params):
+        if self.step == 0:
+            return self.batch_initial_vector(obs)
+        else:
+            n_portfolios = obs[1].shape[1]
+            return self.batch_update(obs[1][-1], self.predictor.batch_predict(obs, params),
+                                     self.batch_param(params, 'toff', self.toff, n_portfolios))
+
+    def batch_update(self, b, x, toff):
+        """
+        Vectorized update
+        :param b: numpy array: (n_portfolios, n_symbols) last portfolio vectors
+        :param x: numpy array: (n_portfolios, n_symbols) price movement predictions
+        :param toff: numpy array: (n_portfolios,) trade off values
+        """
+        vt = x / ((b * x).sum(axis=1, keepdims=True) + self.epsilon)
+        vt_mean = vt.mean(axis=1, keepdims=True)
+        # update portfolio
+        b = b + np.sign(vt - vt_mean) * np.clip(abs(vt - vt_mean) - toff[:, None], 0, np.inf)
+
+        # project it onto simplex
+        return batch_simplex_proj(b)
+
     def set_params(self, **kwargs):
         self.toff = kwargs['toff']
         self.predictor.set_params(**kwargs)
@@ -1591,7 +2070,8 @@ class FactorTrader(APrioriAgent):
 
     def fit(self, env, nb_steps, batch_size, search_space, constrains=None, action_repetition=1, callbacks=None, verbose=1,
             visualize=False, nb_max_start_steps=0, start_step_policy=None, log_interval=10000,
-            nb_max_episode_steps=None, n_workers=1):
+            nb_max_episode_steps=None, n_workers=1, seed=None):
+        pool = None
         try:
             if verbose:
                 print("Optimizing model for %d steps with batch size %d..." % (nb_steps, batch_size))
@@ -1600,10 +2080,41 @@ class FactorTrader(APrioriAgent):
             t0 = time()
             env.training = True
 
+            if seed is not None:
+                random.seed(seed)
+                np.random.seed(seed)
+
+            factor_weights = {}
+            for factor in self.factors:
+                factor_weights[str(factor) + "_weight"] = [0.00001, 1]
+
+            test_kwargs = dict(action_repetition=action_repetition,
+                               callbacks=callbacks,
+                               visualize=visualize,
+                               nb_max_episode_steps=nb_max_episode_steps,
+                               nb_max_start_steps=nb_max_start_steps,
+                               start_step_policy=start_step_policy)
+
+            # Score whole optimizer generations across a process pool, or in process with seeded evaluations
+            if n_workers > 1:
+                pool = FitPool(self, env, n_workers, batch_size,
+                               seed if seed is not None else np.random.randint(2 ** 31 - 1), **test_kwargs)
+                pmap = GenerationMap(pool, dict(search_space, **factor_weights))
+            elif seed is not None:
+                pool = SeededMap(self, env, batch_size, seed, **test_kwargs)
+                pmap = GenerationMap(pool, dict(search_space, **factor_weights))
+            else:
+                pmap = map
+
             def find_hp(**kwargs):
                 try:
                     nonlocal i, nb_steps, t0, env, nb_max_episode_steps
 
+                    # Return generation score if available
+                    if pmap is not map and pmap.cached(kwargs):
+                        i += 1
+                        return pmap.pop(kwargs)
+
                     self.set_params(**kwargs)
 
                     batch_reward = []
@@ -1643,16 +2154,20 @@ class FactorTrader(APrioriAgent):
                     print("\nOptimization aborted by the user.")
                     raise ot.api.fun.MaximumEvaluationsException(0)
 
-            factor_weights = {}
-            for factor in self.factors:
-                factor_weights[str(factor) + "_weight"] = [0.00001, 1]
-
             opt_params, info, _ = ot.maximize(find_hp,
                                               num_evals=nb_steps,
+                                              pmap=pmap,
                                               **search_space,
                                               **factor_weights
                                               )
 
+            # Report evaluation speed
+            info.stats['evals_per_second'] = info.stats['num_evals'] / info.stats['time']
+            if verbose:
+                print("\n%d evaluations in %.2f s, %.2f evaluations/s" % (info.stats['num_evals'],
+                                                                           info.stats['time'],
+                                                                           info.stats['evals_per_second']))
+
             self.set_params(**opt_params)
             env.training = False
             return opt_params, info
@@ -1662,6 +2177,10 @@ class FactorTrader(APrioriAgent):
             print("\nOptimization interrupted by user.")
             return opt_params, info
 
+        finally:
+            if pool:
+                pool.close()
+
 
 class Anticor(APrioriAgent):
     """ Anticor (anti-correlation) is a heuristic portfolio selection algorithm.
@@ -0,0 +1,173 @@
+"""
+Parallel hyperparameter evaluation for apriori agents
+"""
+import random
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+
+# Worker process state, set on pool start
+worker_state = {}
+
+
+def init_worker(agent, env, batch_size, seed, test_kwargs):
+    worker_state.update(agent=agent, env=env, batch_size=batch_size, seed=seed, test_kwargs=test_kwargs)
+
+
+def evaluate(agent, env, batch_size, seed, params, test_kwargs):
+    """
+    Score one parameter set.
+    Random state is reset before each evaluation, so every parameter set is tested on the same
+    episodes whatever the process it runs on.
+    :param agent: APrioriAgent: Agent to evaluate
+    :param env: BacktestEnvironment: Environment
+    :param batch_size: int: Episodes per evaluation
+    :param seed: int: Random seed
+    :param params: dict: Agent set_params kwargs
+    :param test_kwargs: dict: APrioriAgent.test kwargs
+    :return: float: Average episode reward
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+    agent.set_params(**params)
+    return agent.score(env, batch_size, **test_kwargs)
+
+
+def evaluate_params(params):
+    """ Score one parameter set on the worker environment """
+    return evaluate(worker_state['agent'], worker_state['env'], worker_state['batch_size'], worker_state['seed'],
+                    params, worker_state['test_kwargs'])
+
+
+def stack_params(candidates):
+    """
+    Stack parameter sets into arrays, as batch_test params.
+    Inactive structured params are None, held as nan on numeric arrays.
+    :param candidates: list: Parameter dicts
+    :return: dict: Parameters names and (n_candidates,) arrays of values
+    """
+    params = {}
+    for key in set().union(*candidates):
+        values = [candidate.get(key) for candidate in candidates]
+        if all(value is None or isinstance(value, (int, float)) for value in values):
+            params[key] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        else:
+            params[key] = np.array(values, dtype=object)
+    return params
+
+
+class GenerationMap(object):
+    """
+    optunity pmap scoring a whole solver generation at once.
+
+    Points in the search box, bounds included, that satisfy the constraints are decoded and handed to
+    score in one call. The objective optunity maps afterwards reads the cached scores with pop, so call
+    logs, constraints and evaluation limits behave as in a serial search.
+    """
+    def __init__(self, score, box, tree=None, constraints=None):
+        """
+        :param score: callable: Takes a list of parameter dicts and returns their scores
+        :param box: dict: Search box, as optunity box constraints
+        :param tree: optunity SearchTree: Structured search space decoder. None for plain boxes
+        :param constraints: list: Constraint functions on parameters
+        """
+        self.score = score
+        self.box = box
+        self.tree = tree
+        self.constraints = constraints or []
+        self.scores = {}
+        self.n_evals = 0
+        self.time = 0.
+
+    @staticmethod
+    def key(params):
+        return tuple(sorted(params.items()))
+
+    def cached(self, params):
+        return self.key(params) in self.scores
+
+    def pop(self, params):
+        return self.scores.pop(self.key(params))
+
+    def __call__(self, f, *args):
+        candidates = []
+        for point in args[0]:
+            # Points out of the search box are defaulted by optunity. Points on its bounds are scored here
+            # too, so none falls back to an unseeded evaluation in the calling process
+            if not all(self.box[key][0] <= value <= self.box[key][1] for key, value in point.items()):
+                continue
+            params = self.tree.decode(point) if self.tree else point
+            if all(constraint(**params) for constraint in self.constraints):
+                candidates.append(params)
+
+        if candidates:
+            t0 = time()
+            for params, score in zip(candidates, self.score(candidates)):
+                self.scores[self.key(params)] = score
+            self.n_evals += len(candidates)
+            self.time += time() - t0
+
+        return list(map(f, *args))
+
+
+class FitPool(object):
+    """
+    Process pool scoring agent parameter sets on copies of a backtest environment.
+
+    The environment data feed is moved to shared memory before workers start, so workers map the
+    price arrays instead of receiving them pickled.
+    """
+    def __init__(self, agent, env, n_workers, batch_size, seed, **test_kwargs):
+        """
+        :param agent: APrioriAgent: Agent to evaluate
+        :param env: BacktestEnvironment: Environment, with training flag and benchmark set
+        :param n_workers: int: Number of worker processes
+        :param batch_size: int: Episodes per evaluation
+        :param seed: int: Random seed set before each evaluation
+        :param test_kwargs: APrioriAgent.test kwargs
+        """
+        env.tapi.share_memory()
+        self.pool = Pool(n_workers, initializer=init_worker, initargs=(agent, env, batch_size, seed, test_kwargs))
+
+    def __call__(self, candidates):
+        return self.pool.map(evaluate_params, candidates)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class SeededMap(object):
+    """
+    In process counterpart of FitPool, for seeded serial fits.
+
+    Parameter sets are scored as FitPool workers do, and the caller random state is restored afterwards,
+    so the optimizer draws the same points as on a parallel fit.
+    """
+    def __init__(self, agent, env, batch_size, seed, **test_kwargs):
+        """
+        :param agent: APrioriAgent: Agent to evaluate
+        :param env: BacktestEnvironment: Environment, with training flag and benchmark set
+        :param batch_size: int: Episodes per evaluation
+        :param seed: int: Random seed set before each evaluation
+        :param test_kwargs: APrioriAgent.test kwargs
+        """
+        self.agent = agent
+        self.env = env
+        self.batch_size = batch_size
+        self.seed = seed
+        self.test_kwargs = test_kwargs
+
+    def __call__(self, candidates):
+        state, np_state = random.getstate(), np.random.get_state()
+        try:
+            return [evaluate(self.agent, self.env, self.batch_size, self.seed, params, self.test_kwargs)
+                    for params in candidates]
+        finally:
+            random.setstate(state)
+            np.random.set_state(np_state)
+
+    def close(self):
+        pass
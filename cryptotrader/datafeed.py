@@ -1,20 +1,416 @@
 from functools import wraps as _wraps
-from itertools import chain as _chain
+from itertools import chain as _chain, count as _count
+import asyncio
 import json
-from .utils import convert_to, Logger
+import os
+import shutil
+from .utils import convert_to, Logger, send_array, frame_array, pack_frames, unpack_frames
 from decimal import Decimal
+import numpy as np
 import pandas as pd
-from time import sleep
+from time import sleep, time
 from datetime import datetime
 import zmq
+import zmq.asyncio
+import msgpack
 import threading
-from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+from multiprocessing import Process, RawArray
+import ctypes
 from .exceptions import *
+from .exchange_api.coach import Coach
+from .envs.resample import resample_multi, fill_bars
 
 debug = True
 
+# Candle fields packed on columnar arrays, in field axis order
+OHLC_FIELDS = ['open', 'high', 'low', 'close', 'volume']
+
+# Candle columns of a pair as seen from its reciprocal pair
+RECIPROCAL_PRICES = {'open': 'open', 'high': 'low', 'low': 'high', 'close': 'close',
+                     'weightedAverage': 'weightedAverage'}
+RECIPROCAL_VOLUMES = {'volume': 'quoteVolume', 'quoteVolume': 'volume'}
+
+
+def is_packed(req):
+    """ Whether a raw request is a msgpack map, as opposed to a text request """
+    return len(req) > 0 and (0x80 <= req[0] <= 0x8f or req[0] in (0xde, 0xdf))
+
+
+# Text request positional arguments
+REQUEST_ARGS = {
+    'returnChartData': ['currencyPair', 'period', 'start', 'end'],
+    'returnChartArray': ['currencyPair', 'period', 'start', 'end'],
+    'returnTradeHistory': ['currencyPair', 'start', 'end'],
+    'buy': ['currencyPair', 'rate', 'amount', 'orderType'],
+    'sell': ['currencyPair', 'rate', 'amount', 'orderType'],
+    }
+
+# Binary candles, as framed by FeedDaemon for returnChartArray requests
+CHART_DTYPE = np.dtype([('date', np.int64)] + [(name, np.float64) for name in
+                       ['high', 'low', 'open', 'close', 'volume', 'quoteVolume', 'weightedAverage']])
+
+
+def chart_array(records):
+    """
+    Pack returnChartData records into a typed record array
+    :param records: list: Candles records, prices as numbers or strings
+    :return: numpy record array: (T,) CHART_DTYPE candles. Missing fields are nan
+    """
+    chart = np.empty(len(records), dtype=CHART_DTYPE)
+    if records:
+        for name in CHART_DTYPE.names:
+            if name in records[0]:
+                chart[name] = np.array([record[name] for record in records], dtype=np.float64)
+            else:
+                chart[name] = np.nan if name != 'date' else 0
+    return chart
+
+
+def reciprocal_columns(columns):
+    """
+    Invert candle columns to the reciprocal pair in a few array operations.
+    Prices become their inverses rounded to 8 decimals, as exchange prices, with high and low swapped.
+    Base and quote volumes are swapped. Other columns are kept.
+    :param columns: dict: Column name: values sequence
+    :return: dict: Column name: float64 numpy array for transformed columns, original values otherwise
+    """
+    out = {name: values for name, values in columns.items()
+           if name not in RECIPROCAL_PRICES and name not in RECIPROCAL_VOLUMES}
+
+    with np.errstate(divide='ignore'):
+        for name, target in RECIPROCAL_PRICES.items():
+            if name in columns:
+                prices = np.round(1. / np.asarray(columns[name], dtype=np.float64), 8)
+                prices[~np.isfinite(prices)] = np.nan
+                out[target] = prices
+
+    for name, target in RECIPROCAL_VOLUMES.items():
+        if name in columns:
+            out[target] = np.asarray(columns[name], dtype=np.float64)
+
+    return out
+
+
+# Binary candle store
+def save_candles(df, path, **meta):
+    """
+    Write a candles frame as a columnar binary file plus a JSON header.
+    The data file holds the int64 dates array followed by one float64 array per field.
+    Files are replaced atomically, so frames still mapping a previous version stay valid.
+    :param df: pandas DataFrame: Candles with a date column
+    :param path: str: Files path, without extension
+    :param meta: Extra header entries
+    :return: None
+    """
+    fields = [field for field in df.columns if field != 'date']
+    dates = df['date'].values.astype('<i8')
+    values = np.ascontiguousarray(df[fields].values.astype('<f8').T)
+
+    with open(path + '.bin.tmp', 'wb') as file:
+        file.write(dates.tobytes())
+        file.write(values.tobytes())
+    os.replace(path + '.bin.tmp', path + '.bin')
+
+    save_header(path, dict(meta, length=dates.shape[0], fields=fields))
+
+
+def save_header(path, header):
+    """
+    Write a binary candles file header atomically
+    :param path: str: Files path, without extension
+    :param header: dict: Header entries
+    :return: None
+    """
+    with open(path + '.header.json.tmp', 'w') as file:
+        json.dump(header, file)
+    os.replace(path + '.header.json.tmp', path + '.header.json')
+
+
+def load_header(path):
+    """
+    Read a binary candles file header
+    :param path: str: Files path, without extension
+    :return: dict: Header entries
+    """
+    with open(path + '.header.json') as file:
+        return json.load(file)
+
+
+def load_candles(path):
+    """
+    Map a binary candles file written by save_candles.
+    Fields are copy on write memory maps, so loading reads no data and processes mapping the same file
+    share its pages.
+    :param path: str: Files path, without extension
+    :return: pandas DataFrame: Candles indexed by date, with a date column
+    """
+    header = load_header(path)
+    length, fields = header['length'], header['fields']
+    if not length:
+        return pd.DataFrame(columns=['date'] + fields, index=pd.Index([], dtype=np.int64, name='date'))
+
+    dates = np.memmap(path + '.bin', dtype='<i8', mode='c', shape=(length,))
+    values = np.memmap(path + '.bin', dtype='<f8', mode='c', offset=dates.nbytes, shape=(len(fields), length))
+
+    # Fields block maps the file, pandas keeps it without copying
+    df = pd.DataFrame(values.T, index=pd.Index(dates, name='date'), columns=fields, copy=False)
+    df.insert(0, 'date', dates)
+    return df
+
+
+def save_arrays(dates, ohlc, synthetic, path, **meta):
+    """
+    Write a feed columnar arrays as one binary file plus a JSON header.
+    The data file holds the int64 dates array, the (time, pair, field) float64 ohlc array and the
+    (time, pair) synthetic bars mask, in the layout BacktestDataFeed keeps them in memory.
+    :param dates: numpy array: (T,) epoch dates
+    :param ohlc: numpy array: (T, pair, field) candles
+    :param synthetic: numpy array: (T, pair) synthetic bars mask
+    :param path: str: Files path, without extension
+    :param meta: Extra header entries
+    :return: None
+    """
+    with open(path + '.bin.tmp', 'wb') as file:
+        file.write(np.asarray(dates, dtype='<i8').tobytes())
+        file.write(np.ascontiguousarray(ohlc, dtype='<f8').tobytes())
+        file.write(np.ascontiguousarray(synthetic, dtype=bool).tobytes())
+    os.replace(path + '.bin.tmp', path + '.bin')
+
+    save_header(path, dict(meta, length=ohlc.shape[0], n_pairs=ohlc.shape[1], fields=OHLC_FIELDS))
+
+
+def load_arrays(path):
+    """
+    Map a feed arrays file written by save_arrays.
+    Arrays are copy on write memory maps, so loading reads no data and processes mapping the same file
+    share its pages.
+    :param path: str: Files path, without extension
+    :return: tuple: (T,) dates, (T, pair, field) ohlc and (T, pair) synthetic memory maps
+    """
+    header = load_header(path)
+    length, n_pairs, n_fields = header['length'], header['n_pairs'], len(header['fields'])
+
+    dates = np.memmap(path + '.bin', dtype='<i8', mode='c', shape=(length,))
+    ohlc = np.memmap(path + '.bin', dtype='<f8', mode='c', offset=dates.nbytes, shape=(length, n_pairs, n_fields))
+    synthetic = np.memmap(path + '.bin', dtype=bool, mode='c', offset=dates.nbytes + ohlc.nbytes,
+                          shape=(length, n_pairs))
+    return dates, ohlc, synthetic
+
+
+class CandleWriter(object):
+    """
+    Stream candle batches into a binary candle file.
+    Dates and fields are spooled to one temporary file each and joined on close, so the file layout matches
+    save_candles without holding the whole series in memory. Nothing replaces the previous file until close.
+    """
+    def __init__(self, path, fields=OHLC_FIELDS, **meta):
+        """
+        :param path: str: Files path, without extension
+        :param fields: list: Field names, in values column order
+        :param meta: Extra header entries
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.meta = meta
+        self.length = 0
+        self.files = [open(self.spool(i), 'wb') for i in range(len(self.fields) + 1)]
+
+    def spool(self, i):
+        return self.path + '.%d.tmp' % i
+
+    def write(self, dates, values):
+        """
+        Append a batch of candles
+        :param dates: numpy array: (n,) int64 epoch dates
+        :param values: numpy array: (n, field) candles
+        :return: None
+        """
+        values = np.asarray(values, dtype='<f8')
+        assert values.shape == (len(dates), len(self.fields)), "values must be shaped (n, field)."
+        self.files[0].write(np.asarray(dates, dtype='<i8').tobytes())
+        for file, column in zip(self.files[1:], values.T):
+            file.write(np.ascontiguousarray(column).tobytes())
+        self.length += len(dates)
+
+    def close(self):
+        """
+        Join the spooled arrays into the candle file and write its header
+        :return: int: Number of candles written
+        """
+        for file in self.files:
+            file.close()
+        with open(self.path + '.bin.tmp', 'wb') as out:
+            for i in range(len(self.files)):
+                with open(self.spool(i), 'rb') as file:
+                    shutil.copyfileobj(file, out)
+        os.replace(self.path + '.bin.tmp', self.path + '.bin')
+        self.discard()
+
+        save_header(self.path, dict(self.meta, length=self.length, fields=self.fields))
+        return self.length
+
+    def discard(self):
+        for i, file in enumerate(self.files):
+            file.close()
+            if os.path.exists(self.spool(i)):
+                os.remove(self.spool(i))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class CandleCache(object):
+    """
+    Local candle store keyed by (exchange, pair, period).
+
+    Each key is a binary candles file whose header also records the time ranges already requested from the
+    exchange, including ranges that returned no candles. Updates fetch only the parts of a request that are
+    not covered yet, paging through them in bounded chunks, and merge the new candles into the store.
+    """
+    def __init__(self, cache_dir, exchange, period, chunk_size=5000):
+        """
+        :param cache_dir: str: Store directory
+        :param exchange: str: Exchange name
+        :param period: int: Candle period in minutes
+        :param chunk_size: int: Maximum candles per exchange request
+        """
+        self.cache_dir = cache_dir
+        self.exchange = exchange
+        self.period = period
+        self.chunk_size = chunk_size
+
+    def path(self, pair):
+        return os.path.join(self.cache_dir, self.exchange, str(pair) + '_' + str(self.period) + 'min')
+
+    def load(self, pair):
+        """
+        Stored candles and covered ranges
+        :param pair: str: Pair name
+        :return: tuple: pandas DataFrame candles, or None if empty, and list of [start, end] ranges
+        """
+        path = self.path(pair)
+        if not os.path.exists(path + '.header.json'):
+            return None, []
+        return load_candles(path), load_header(path).get('ranges', [])
+
+    @staticmethod
+    def merge_ranges(ranges, gap=1):
+        """
+        Sort and coalesce time ranges
+        :param ranges: list: [start, end] ranges, in seconds, ends included
+        :param gap: int: Largest distance between merged ranges
+        :return: list: Disjoint sorted ranges
+        """
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + gap:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    @staticmethod
+    def missing_ranges(ranges, start, end):
+        """
+        Parts of [start, end] not covered by ranges
+        :param ranges: list: Disjoint sorted [start, end] ranges
+        :param start: int: Request start timestamp
+        :param end: int: Request end timestamp
+        :return: list: Missing [start, end] ranges
+        """
+        missing = []
+        for range_start, range_end in ranges:
+            if range_end < start:
+                continue
+            if range_start > end:
+                break
+            if range_start > start:
+                missing.append([start, range_start - 1])
+            start = max(start, range_end + 1)
+        if start <= end:
+            missing.append([start, end])
+        return missing
+
+    def requests(self, ranges, start, end):
+        """
+        Exchange requests completing ranges over [start, end], in bounded chunks
+        :param ranges: list: Covered [start, end] ranges
+        :param start: int: Start timestamp
+        :param end: int: End timestamp
+        :return: list: [start, end] requests
+        """
+        step = self.chunk_size * self.period * 60
+        return [[chunk_start, min(chunk_start + step - 1, missing_end)]
+                for missing_start, missing_end in self.missing_ranges(ranges, start, end)
+                for chunk_start in range(missing_start, missing_end + 1, step)]
+
+    def merge(self, pair, df, ranges, requests, chunks):
+        """
+        Merge downloaded chunks into the store.
+        Coverage is recorded up to the last closed candle, so the candle still open is requested again on updates.
+        :param pair: str: Pair name
+        :param df: pandas DataFrame: Stored candles, or None
+        :param ranges: list: Stored ranges
+        :param requests: list: Downloaded [start, end] ranges
+        :param chunks: list: Downloaded candles DataFrames
+        :return: pandas DataFrame: Updated store candles
+        """
+        frames = [] if df is None else [df]
+        for chunk in chunks:
+            # Empty answers come as a single zero dated candle
+            if 'date' in chunk:
+                frames.append(chunk[chunk['date'] > 0])
+
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['date'])
+        df = df.drop_duplicates('date', keep='last').sort_values('date')
+        df = df.astype({field: np.float64 for field in df.columns if field != 'date'})
+        df['date'] = df['date'].astype(np.int64)
+
+        # Candles dated from the current period start are still open
+        period = self.period * 60
+        closed = int(time()) // period * period - 1
+        requests = [[start, min(end, closed)] for start, end in requests if start <= closed]
+
+        os.makedirs(os.path.dirname(self.path(pair)), exist_ok=True)
+        save_candles(df, self.path(pair), ranges=self.merge_ranges(ranges + requests))
+        return self.load(pair)[0]
+
+    @staticmethod
+    def select(df, start, end):
+        dates = df['date'].values
+        return df.iloc[np.searchsorted(dates, start):np.searchsorted(dates, end, side='right')]
+
+    def update(self, pair, fetch, start, end):
+        """
+        Bring the store up to date on [start, end] and return its candles on that range
+        :param pair: str: Pair name
+        :param fetch: callable: Takes pair, start and end timestamps and returns a candles DataFrame
+        :param start: int: Start timestamp
+        :param end: int: End timestamp
+        :return: pandas DataFrame: Candles indexed by date, with a date column
+        """
+        df, ranges = self.load(pair)
+        requests = self.requests(ranges, start, end)
+
+        if requests:
+            df = self.merge(pair, df, ranges, requests, [fetch(pair, *request) for request in requests])
+
+        return self.select(df, start, end)
+
+
 # Base classes
 class ExchangeConnection(object):
+    # Whether feed methods may be called from many threads at once
+    thread_safe = True
+
     def __init__(self, period, pairs=[]):
         """
         :param tapi: exchange api instance: Exchange api instance
@@ -24,6 +420,12 @@ class ExchangeConnection(object):
         self.period = period
         self.pairs = pairs
 
+        # Pairs served from their reciprocal pair
+        self._inverted = set()
+
+        # Rate limiter shared by all concurrent requests of this connection
+        self.coach = Coach()
+
     # Feed methods
     @property
     def balance(self):
@@ -41,6 +443,29 @@ class ExchangeConnection(object):
     def returnChartData(self, currencyPair, period, start=None, end=None):
         return NotImplementedError("This class is not intended to be used directly.")
 
+    def returnChartArray(self, currencyPair, period, start=None, end=None):
+        """
+        Return pair OHLC data as a typed record array
+        :param currencyPair: str: Desired pair str
+        :param period: int: Candle period
+        :param start: str: UNIX timestamp to start from
+        :param end:  str: UNIX timestamp to end returned data
+        :return: numpy record array: (T,) CHART_DTYPE candles
+        """
+        return chart_array(self.returnChartData(currencyPair, period, start, end))
+
+    def get_charts(self, pairs, period, start=None, end=None, n_threads=1):
+        """
+        Return pairs OHLC data as typed record arrays
+        :param pairs: list: Pair symbols
+        :param period: int: Candle period
+        :param start: str: UNIX timestamp to start from
+        :param end:  str: UNIX timestamp to end returned data
+        :param n_threads: int: Concurrent requests
+        :return: list: numpy record arrays in pairs order
+        """
+        return self.map_requests(self.returnChartArray, [(pair, period, start, end) for pair in pairs], n_threads)
+
     # Trade execution methods
     def sell(self, currencyPair, rate, amount, orderType=False):
         return NotImplementedError("This class is not intended to be used directly.")
@@ -48,27 +473,163 @@ class ExchangeConnection(object):
     def buy(self, currencyPair, rate, amount, orderType=False):
         return NotImplementedError("This class is not intended to be used directly.")
 
+    def map_requests(self, func, calls, n_threads=1):
+        """
+        Run exchange requests over a thread pool, results in calls order.
+        All threads share one rate limiter: the exchange api coach when it has one, the connection coach otherwise.
+        Requests run in sequence when this connection or its api is not thread safe, as zmq DataFeed sockets.
+        :param func: callable: Request function
+        :param calls: list: func positional arguments tuples
+        :param n_threads: int: Concurrent requests. 1 runs them in sequence
+        :return: list: func results
+        """
+        tapi = getattr(self, 'tapi', None)
+        if n_threads <= 1 or len(calls) <= 1 or not self.thread_safe or not getattr(tapi, 'thread_safe', True):
+            return [func(*call) for call in calls]
+
+        coach = None if getattr(tapi, 'coach', None) else self.coach
+
+        def request(call):
+            if coach:
+                coach.wait()
+            return func(*call)
+
+        with ThreadPoolExecutor(n_threads) as executor:
+            return list(executor.map(request, calls))
+
     def pair_reciprocal(self, df):
-        df[['open', 'high', 'low', 'close']] = df.apply(
-            {col: lambda x: str((Decimal('1') / convert_to.decimal(x)).quantize(Decimal('0E-8')))
-             for col in ['open', 'low', 'high', 'close']}, raw=True).rename(columns={'low': 'high',
-                                                                                     'high': 'low'}
-                                                                            )
-        return df.rename(columns={'quoteVolume': 'volume', 'volume': 'quoteVolume'})
+        """
+        Reciprocal pair candles, on numeric columns
+        :param df: pandas DataFrame: Candles
+        :return: pandas DataFrame: Inverted candles
+        """
+        columns = reciprocal_columns({name: df[name].values for name in df.columns})
+        return pd.DataFrame(columns, index=df.index, columns=[name for name in df.columns if name in columns] +
+                                                              [name for name in columns if name not in df.columns])
+
+    def reciprocal_records(self, records):
+        """
+        Reciprocal pair candles, on records format
+        :param records: list: Candles records, as returned by returnChartData
+        :return: list: Inverted candles records
+        """
+        if not isinstance(records, list) or not records:
+            return records
+        columns = reciprocal_columns({name: [record[name] for record in records] for name in records[0]})
+        columns = {name: values.tolist() if isinstance(values, np.ndarray) else values
+                   for name, values in columns.items()}
+        return [{name: values[i] for name, values in columns.items()} for i in range(len(records))]
+
+    def reciprocal_array(self, chart):
+        """
+        Reciprocal pair candles, on record array format
+        :param chart: numpy record array: Candles, as returned by returnChartArray
+        :return: numpy record array: Inverted candles
+        """
+        if not isinstance(chart, np.ndarray):
+            return chart
+        columns = reciprocal_columns({name: chart[name] for name in chart.dtype.names})
+        out = np.empty(chart.shape, dtype=chart.dtype)
+        for name in chart.dtype.names:
+            out[name] = columns[name]
+        return out
+
+    @staticmethod
+    def reciprocal_pair(pair):
+        symbols = pair.split('_')
+        return symbols[1] + '_' + symbols[0]
 
 
 ## Feed daemon
+# Response cache
+class ResponseCache(object):
+    """
+    Thread safe TTL cache for exchange responses.
+
+    Identical requests arriving while one is in flight wait on its result instead of calling the api again,
+    so any number of concurrent clients cost one upstream call. Errors are shared by the waiting requests
+    and never cached. The least recently used entries are dropped past max_size.
+    """
+    def __init__(self, max_size=4096, clock=time):
+        """
+        :param max_size: int: Cached responses limit
+        :param clock: callable: Time source, in seconds
+        """
+        self.max_size = max_size
+        self.clock = clock
+        self.lock = threading.Lock()
+        self._data = OrderedDict()
+        self._inflight = {}
+        self.hits = self.misses = 0
+
+    def get(self, key, func, ttl=None):
+        """
+        Return the cached response for key, calling func on miss
+        :param key: hashable: Request key
+        :param func: callable: Upstream call
+        :param ttl: float: Seconds the response stays valid. None keeps it until evicted, 0 only coalesces
+        :return: func response
+        """
+        with self.lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > self.clock()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = func()
+        except Exception as e:
+            with self.lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise e
+
+        with self.lock:
+            del self._inflight[key]
+            if ttl is None or ttl > 0:
+                self._data[key] = (None if ttl is None else self.clock() + ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+
+
 # Server
 class FeedDaemon(Process):
     """
     Data Feed server
     """
-    def __init__(self, api={}, addr='ipc://feed.ipc', n_workers=4):
+    def __init__(self, api={}, addr='ipc://feed.ipc', n_workers=4, ttl={}, cache_size=4096, pub_addr=None,
+                 channels={}, pub_period=300, pub_interval=1.):
         """
 
         :param api: dict: exchange name: api instance
         :param addr: str: client side address
         :param n_workers: int: n threads
+        :param ttl: dict: command: response cache seconds, overriding the defaults. 0 disables caching,
+        None caches until evicted
+        :param cache_size: int: Cached responses limit
+        :param pub_addr: str: Market data broadcast address. None disables broadcasting
+        :param channels: dict: exchange name: pairs whose candles are broadcast along the exchange ticker
+        :param pub_period: int: Broadcast candles period, in seconds
+        :param pub_interval: float: Seconds between ticker broadcasts. Candles are broadcast once closed
         """
         super(FeedDaemon, self).__init__()
         self.api = api
@@ -76,12 +637,45 @@ class FeedDaemon(Process):
         self.n_workers = n_workers
         self.addr = addr
 
+        # Market data broadcast
+        self.pub_addr = pub_addr
+        self.channels = channels
+        self.pub_period = pub_period
+        self.pub_interval = pub_interval
+
         self.MINUTE, self.HOUR, self.DAY = 60, 60 * 60, 60 * 60 * 24
         self.WEEK, self.MONTH = self.DAY * 7, self.DAY * 30
         self.YEAR = self.DAY * 365
 
+        # Response cache seconds per command. Charts and trades cover closed windows forever, open ones
+        # for their ttl. Orders are never cached nor coalesced
+        self.ttl = {
+            'returnTicker': 0.5,
+            'returnChartData': 1,
+            'returnChartArray': 1,
+            'returnTradeHistory': 1,
+            'returnCurrencies': self.HOUR,
+            'returnFeeInfo': self.HOUR,
+            'returnBalances': 0,
+            }
+        self.ttl.update(ttl)
+        self.cache_size = cache_size
+
+        # Response cache and batch executor are made by setup, in the serving process
+        self.cache = None
+        self.executor = None
+
         self._nonce = int("{:.6f}".format(datetime.utcnow().timestamp()).replace('.', ''))
 
+    def setup(self):
+        """
+        Make the response cache and the executor running batch requests parts concurrently.
+        Called by run, so locks and threads belong to the daemon process instead of being copied from its parent
+        :return: None
+        """
+        self.cache = ResponseCache(self.cache_size)
+        self.executor = ThreadPoolExecutor(self.n_workers)
+
     @property
     def nonce(self):
         """ Increments the nonce"""
@@ -89,7 +683,11 @@ class FeedDaemon(Process):
         return self._nonce
 
     def handle_req(self, req):
-
+        """
+        Parse a text request, exchange command and positional arguments separated by spaces
+        :param req: str: Text request
+        :return: tuple: call, False or None for bad requests
+        """
         req = req.split(' ')
 
         if req[0] == '' or len(req) == 1:
@@ -98,54 +696,137 @@ class FeedDaemon(Process):
         elif len(req) == 2:
             return req[0], req[1]
 
-        else:
-            # Candle data
-            if req[1] == 'returnChartData':
-
-                if req[4] == 'None':
-                    req[4] = datetime.utcnow().timestamp() - self.DAY
-                if req[5] == 'None':
-                    req[5] = datetime.utcnow().timestamp()
-
-                call = (
-                    req[0],
-                    req[1],
-                    {
-                        'currencyPair': str(req[2]).upper(),
-                        'period': str(req[3]),
-                        'start': str(req[4]),
-                        'end': str(req[5])
-                        }
-                    )
-                return call
-
-            if req[1] == 'returnTradeHistory':
-                args = {'currencyPair': str(req[2]).upper()}
-                if req[3] != 'None':
-                    args['start'] = req[3]
-                if req[4] != 'None':
-                    args['end'] = req[4]
-
-                return req[0], req[1], args
-
-            # Buy and sell orders
-            if req[1] == 'buy' or req[1] == 'sell':
-                args = {
-                    'currencyPair': str(req[2]).upper(),
-                    'rate': str(req[3]),
-                    'amount': str(req[4]),
-                    }
-                # order type specified?
-                try:
-                    possTypes = ['fillOrKill', 'immediateOrCancel', 'postOnly']
-                    # check type
-                    if not req[5] in possTypes:
-                        raise ExchangeError('Invalid orderType')
-                    args[req[5]] = 1
-                except IndexError:
-                    pass
+        elif req[1] in REQUEST_ARGS:
+            return self.handle_call(req[0], req[1], {name: value for name, value in zip(REQUEST_ARGS[req[1]], req[2:])
+                                                     if value != 'None'})
+
+    def handle_call(self, exchange, command, args={}):
+        """
+        Build an api call from named arguments
+        :param exchange: str: Exchange name
+        :param command: str: Api command
+        :param args: dict: Command arguments
+        :return: tuple: call
+        """
+        if not args and command not in REQUEST_ARGS:
+            return exchange, command
+
+        try:
+            return self._handle_call(exchange, command, args)
+        except KeyError as e:
+            raise ExchangeError("Missing %s argument" % str(e))
+
+    def _handle_call(self, exchange, command, args):
+        # Candle data, returnChartArray replies a binary record array
+        if command in ('returnChartData', 'returnChartArray'):
+            return exchange, command, {
+                'currencyPair': str(args['currencyPair']).upper(),
+                'period': str(args['period']),
+                'start': str(args['start'] if args.get('start') is not None else
+                             datetime.utcnow().timestamp() - self.DAY),
+                'end': str(args['end'] if args.get('end') is not None else datetime.utcnow().timestamp())
+                }
+
+        if command == 'returnTradeHistory':
+            call_args = {'currencyPair': str(args['currencyPair']).upper()}
+            for name in ('start', 'end'):
+                if args.get(name) is not None:
+                    call_args[name] = args[name]
+
+            return exchange, command, call_args
+
+        # Buy and sell orders
+        if command == 'buy' or command == 'sell':
+            call_args = {
+                'currencyPair': str(args['currencyPair']).upper(),
+                'rate': str(args['rate']),
+                'amount': str(args['amount']),
+                }
+            # order type specified?
+            if args.get('orderType') not in (None, False, 'False'):
+                possTypes = ['fillOrKill', 'immediateOrCancel', 'postOnly']
+                # check type
+                if not args['orderType'] in possTypes:
+                    raise ExchangeError('Invalid orderType')
+                call_args[args['orderType']] = 1
+
+            return exchange, command, call_args
+
+        return exchange, command, dict(args)
+
+    def get_ttl(self, call):
+        """
+        Response cache seconds for a call
+        :param call: tuple: Handled request
+        :return: float: ttl, None for responses that never change, False for uncacheable calls
+        """
+        command = call[1]
+        if command not in self.ttl:
+            return False
 
-                return req[0], req[1], args
+        if command in ('returnChartData', 'returnChartArray', 'returnTradeHistory') and len(call) > 2 and \
+                'end' in call[2]:
+            # Windows closed a full period ago do not change anymore
+            period = float(call[2].get('period', self.MINUTE))
+            if float(call[2]['end']) + period <= time():
+                return None
+
+        return self.ttl[command]
+
+    def call_api(self, call):
+        self.api[call[0]].nonce = self.nonce
+        if call[1] == 'returnChartArray':
+            rep = self.api[call[0]].__call__('returnChartData', *call[2:])
+            if isinstance(rep, list):
+                # Packed once, the cached array is shared by every reply
+                rep = chart_array(rep)
+                rep.flags.writeable = False
+            return rep
+        return self.api[call[0]].__call__(*call[1:])
+
+    def request(self, req, call):
+        """
+        Serve a call from the response cache, calling the api on miss
+        :param req: str: Raw request, the cache key
+        :param call: tuple: Handled request
+        :return: api response
+        """
+        ttl = self.get_ttl(call)
+        if ttl is False:
+            return self.call_api(call)
+        return self.cache.get(req, lambda: self.call_api(call), ttl)
+
+    def serve_call(self, part):
+        """
+        Serve a structured request part
+        :param part: dict: exchange, command and named args
+        :return: api response, the error message if it fails
+        """
+        try:
+            if not isinstance(part, dict):
+                raise TypeError("Bad call format.")
+            args = part.get('args') or {}
+            call = self.handle_call(part['exchange'], part['command'], args)
+            return self.request((part['exchange'], part['command'], tuple(sorted(args.items()))), call)
+        except (ExchangeError, KeyError, TypeError, AttributeError) as e:
+            return e.__str__()
+
+    def serve_batch(self, req):
+        """
+        Serve a msgpack request, a single part or a batch of them run concurrently
+        :param req: bytes: msgpack request
+        :return: list: pack_frames reply frames. Malformed requests get the error message
+        """
+        try:
+            req = msgpack.unpackb(req, raw=False)
+        except Exception as e:
+            return pack_frames("Bad request: %s" % str(e))
+
+        if not isinstance(req, dict) or 'batch' not in req:
+            return pack_frames(self.serve_call(req))
+        if not isinstance(req['batch'], (list, tuple)):
+            return pack_frames("Bad batch format.")
+        return pack_frames(list(self.executor.map(self.serve_call, req['batch'])))
 
     def worker(self):
         # Init socket
@@ -155,7 +836,14 @@ class FeedDaemon(Process):
         while True:
             try:
                 # Wait for request
-                req = sock.recv_string()
+                req = sock.recv()
+
+                # Structured requests are msgpack maps, text requests start with the exchange name
+                if is_packed(req):
+                    sock.send_multipart(self.serve_batch(req), copy=False)
+                    continue
+
+                req = req.decode()
 
                 Logger.debug(FeedDaemon.worker, req)
 
@@ -165,16 +853,18 @@ class FeedDaemon(Process):
                 # Send request to api
                 if call:
                     try:
-                        self.api[call[0]].nonce = self.nonce
-                        rep = self.api[call[0]].__call__(*call[1:])
+                        rep = self.request(req, call)
                     except ExchangeError as e:
                         rep = e.__str__()
 
                     if debug:
                         Logger.debug(FeedDaemon.worker, rep)
 
-                    # send reply back to client
-                    sock.send_json(rep)
+                    # send reply back to client. Arrays go on a metadata frame and a raw buffer frame
+                    if isinstance(rep, np.ndarray):
+                        send_array(sock, rep)
+                    else:
+                        sock.send_json(rep)
                 else:
                     raise TypeError("Bad call format.")
 
@@ -182,9 +872,67 @@ class FeedDaemon(Process):
                 sock.close()
                 raise e
 
+    def publish(self, sock, last):
+        """
+        Broadcast exchanges tickers and channel pairs newly closed candles, one upstream fetch for every subscriber.
+        Candles are requested only once their period is over, and again on later calls until the exchange has them.
+        :param sock: zmq PUB socket
+        :param last: dict: (exchange, pair): last broadcast candle date
+        """
+        for exchange, pairs in self.channels.items():
+            req = exchange + ' returnTicker'
+            try:
+                rep = self.request(req, self.handle_req(req))
+                if isinstance(rep, dict):
+                    sock.send_string(req, zmq.SNDMORE)
+                    sock.send_json(rep)
+            except ExchangeError as e:
+                Logger.error(FeedDaemon.publish, "%s: %s" % (req, str(e)))
+
+            # Last closed candle date
+            closed = int(time()) // self.pub_period * self.pub_period - self.pub_period
+            for pair in pairs:
+                start = last.get((exchange, pair), closed - self.pub_period) + self.pub_period
+                if start > closed:
+                    continue
+
+                topic = "%s returnChartArray %s %d" % (exchange, pair, self.pub_period)
+                req = "%s %d %d" % (topic, start, closed + self.pub_period - 1)
+                try:
+                    rep = self.request(req, self.handle_req(req))
+                    if isinstance(rep, np.ndarray):
+                        rep = rep[(rep['date'] >= start) & (rep['date'] <= closed)]
+                        if rep.size:
+                            sock.send_string(topic, zmq.SNDMORE)
+                            send_array(sock, rep)
+                            last[(exchange, pair)] = int(rep['date'][-1])
+                except ExchangeError as e:
+                    Logger.error(FeedDaemon.publish, "%s: %s" % (req, str(e)))
+
+    def publisher(self):
+        # Init socket
+        sock = self.context.socket(zmq.PUB)
+        sock.bind(self.pub_addr)
+
+        last = {}
+        while True:
+            try:
+                t0 = time()
+                self.publish(sock, last)
+                sleep(max(self.pub_interval - time() + t0, 0))
+
+            except Exception as e:
+                sock.close()
+                raise e
+
     def run(self):
         try:
             Logger.info(FeedDaemon, "Starting Feed Daemon...")
+            self.setup()
+
+            if self.pub_addr:
+                threading.Thread(target=self.publisher, args=()).start()
+                Logger.info(FeedDaemon.run, "Broadcasting on %s" % self.pub_addr)
 
             # Socket to talk to clients
             clients = self.context.socket(zmq.ROUTER)
@@ -216,6 +964,9 @@ class DataFeed(ExchangeConnection):
     # TODO WRITE TESTS
     retryDelays = [2 ** i for i in range(4)]
 
+    # Requests go over a single REQ socket
+    thread_safe = False
+
     def __init__(self, period, pairs=[], exchange='', addr='', timeout=30):
         """
 
@@ -265,26 +1016,37 @@ class DataFeed(ExchangeConnection):
 
         return retrying
 
-    def get_response(self, req):
+    def reset_socket(self):
+        # Socket is confused. Close and remove it.
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.close()
+        self.poll.unregister(self.sock)
 
-        req = self.exchange + ' ' + req
+        # Create new connection
+        self.sock = self.context.socket(zmq.REQ)
+        self.sock.connect(self.addr)
+        self.poll.register(self.sock, zmq.POLLIN)
+
+    def close(self):
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.close()
+        self.context.term()
 
+    def send_request(self, msg, name):
+        """
+        Send a raw request and wait for its reply frames
+        :param msg: bytes: Request
+        :param name: str: Request description for logging
+        :return: list: zmq Frames
+        """
         # Send request
         try:
-            self.sock.send_string(req)
+            self.sock.send(msg)
         except zmq.ZMQError as e:
             if 'Operation cannot be accomplished in current state' == e.__str__():
                 # If request timeout, restart socket
-                Logger.error(DataFeed.get_response, "%s request timeout." % req)
-                # Socket is confused. Close and remove it.
-                self.sock.setsockopt(zmq.LINGER, 0)
-                self.sock.close()
-                self.poll.unregister(self.sock)
-
-                # Create new connection
-                self.sock = self.context.socket(zmq.REQ)
-                self.sock.connect(self.addr)
-                self.poll.register(self.sock, zmq.POLLIN)
+                Logger.error(DataFeed.get_response, "%s request timeout." % name)
+                self.reset_socket()
 
                 raise DataFeedException
 
@@ -292,23 +1054,36 @@ class DataFeed(ExchangeConnection):
         socks = dict(self.poll.poll(self.timeout))
         if socks.get(self.sock) == zmq.POLLIN:
             # If response, return
-            return self.sock.recv_json()
+            return self.sock.recv_multipart(copy=False)
 
         else:
             # If request timeout, restart socket
-            Logger.error(DataFeed.get_response, "%s request timeout." % req)
-            # Socket is confused. Close and remove it.
-            self.sock.setsockopt(zmq.LINGER, 0)
-            self.sock.close()
-            self.poll.unregister(self.sock)
-
-            # Create new connection
-            self.sock = self.context.socket(zmq.REQ)
-            self.sock.connect(self.addr)
-            self.poll.register(self.sock, zmq.POLLIN)
+            Logger.error(DataFeed.get_response, "%s request timeout." % name)
+            self.reset_socket()
 
             raise DataFeedException
 
+    def get_response(self, req):
+
+        req = self.exchange + ' ' + req
+
+        frames = self.send_request(req.encode(), req)
+        rep = json.loads(frames[0].bytes.decode())
+        if len(frames) > 1:
+            # Binary reply, rep is the array metadata
+            return frame_array(rep, frames[1])
+        return rep
+
+    def get_batch(self, calls):
+        """
+        Request many calls on one round trip, the daemon runs them concurrently
+        :param calls: list: (command, named args dict) tuples
+        :return: list: Replies in calls order, the error message for failed calls
+        """
+        msg = msgpack.packb({'batch': [{'exchange': self.exchange, 'command': command, 'args': args}
+                                       for command, args in calls]}, use_bin_type=True)
+        return unpack_frames(self.send_request(msg, "batch of %d calls" % len(calls)))
+
     @retry
     def returnTicker(self):
         try:
@@ -372,27 +1147,23 @@ class DataFeed(ExchangeConnection):
         :return: list: List containing desired asset data in "records" format
         """
         try:
-            call = "returnChartData %s %s %s %s" % (str(currencyPair),
-                                                    str(period),
-                                                    str(start),
-                                                    str(end))
-            rep = self.get_response(call)
-
-            if 'Invalid currency pair.' in rep:
-                try:
-                    symbols = currencyPair.split('_')
-                    pair = symbols[1] + '_' + symbols[0]
+            if currencyPair not in self._inverted:
+                call = "returnChartData %s %s %s %s" % (str(currencyPair),
+                                                        str(period),
+                                                        str(start),
+                                                        str(end))
+                rep = self.get_response(call)
 
-                    call = "returnChartData %s %s %s %s" % (str(pair),
-                                                            str(period),
-                                                            str(start),
-                                                            str(end))
+                if 'Invalid currency pair.' in rep:
+                    self._inverted.add(currencyPair)
 
-                    rep =  json.loads(
-                        self.pair_reciprocal(pd.DataFrame.from_records(self.get_response(call))).to_json(
-                            orient='records'))
-                except Exception as e:
-                    raise e
+            # Inverted pairs skip the failing request on later calls
+            if currencyPair in self._inverted:
+                call = "returnChartData %s %s %s %s" % (self.reciprocal_pair(currencyPair),
+                                                        str(period),
+                                                        str(start),
+                                                        str(end))
+                rep = self.reciprocal_records(self.get_response(call))
 
             assert isinstance(rep, list)
             return rep
@@ -400,6 +1171,76 @@ class DataFeed(ExchangeConnection):
         except AssertionError:
             raise DataFeedException("Unexpected response from DataFeed.returnChartData")
 
+    @retry
+    def returnChartArray(self, currencyPair, period, start=None, end=None):
+        """
+        Return pair OHLC data, framed by the daemon as a binary record array
+        :param currencyPair: str: Desired pair str
+        :param period: int: Candle period. Must be in [300, 900, 1800, 7200, 14400, 86400]
+        :param start: str: UNIX timestamp to start from
+        :param end:  str: UNIX timestamp to end returned data
+        :return: numpy record array: (T,) CHART_DTYPE candles over the received buffer
+        """
+        try:
+            if currencyPair not in self._inverted:
+                call = "returnChartArray %s %s %s %s" % (str(currencyPair),
+                                                         str(period),
+                                                         str(start),
+                                                         str(end))
+                rep = self.get_response(call)
+
+                if isinstance(rep, str) and 'Invalid currency pair.' in rep:
+                    self._inverted.add(currencyPair)
+
+            # Inverted pairs skip the failing request on later calls
+            if currencyPair in self._inverted:
+                call = "returnChartArray %s %s %s %s" % (self.reciprocal_pair(currencyPair),
+                                                         str(period),
+                                                         str(start),
+                                                         str(end))
+                rep = self.reciprocal_array(self.get_response(call))
+
+            assert isinstance(rep, np.ndarray)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from DataFeed.returnChartArray")
+
+    @retry
+    def get_charts(self, pairs, period, start=None, end=None, n_threads=1):
+        """
+        Return pairs OHLC data on a single request
+        :param pairs: list: Pair symbols
+        :param period: int: Candle period
+        :param start: str: UNIX timestamp to start from
+        :param end:  str: UNIX timestamp to end returned data
+        :param n_threads: int: Unused, the daemon runs the batch concurrently
+        :return: list: numpy record arrays in pairs order
+        """
+        def chart_calls(symbols):
+            return [('returnChartArray', {'currencyPair': symbol, 'period': period, 'start': start, 'end': end})
+                    for symbol in symbols]
+
+        try:
+            reps = self.get_batch(chart_calls([self.reciprocal_pair(pair) if pair in self._inverted else pair
+                                               for pair in pairs]))
+
+            # Pairs the exchange lists inverted
+            retry = [i for i, rep in enumerate(reps) if isinstance(rep, str) and 'Invalid currency pair.' in rep
+                     and pairs[i] not in self._inverted]
+            if retry:
+                self._inverted.update(pairs[i] for i in retry)
+                for i, rep in zip(retry, self.get_batch(chart_calls([self.reciprocal_pair(pairs[i])
+                                                                     for i in retry]))):
+                    reps[i] = rep
+
+            charts = [self.reciprocal_array(rep) if pair in self._inverted else rep for pair, rep in zip(pairs, reps)]
+            assert all(isinstance(chart, np.ndarray) for chart in charts)
+            return charts
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from DataFeed.get_charts")
+
     @retry
     def returnTradeHistory(self, currencyPair='all', start=None, end=None):
         try:
@@ -475,19 +1316,441 @@ class DataFeed(ExchangeConnection):
             raise DataFeedException("Unexpected response from DataFeed.buy")
 
 
+class SubscriberDataFeed(DataFeed):
+    """
+    DataFeed keeping rolling windows of the FeedDaemon market data broadcast.
+    Ticker and chart arrays are served from the local windows when they cover the request, from the daemon
+    otherwise. Windows are seeded by those requests. Other calls go to the daemon as in DataFeed.
+    Windows hold closed candles only, the candle still open is left for the env to fill from the last close.
+    """
+    def __init__(self, period, pairs=[], exchange='', addr='', sub_addr='', timeout=30, window=1000, max_age=60):
+        """
+
+        :param sub_addr: str: FeedDaemon broadcast address
+        :param window: int: Candles kept per pair
+        :param max_age: float: Seconds without ticker broadcasts before falling back to requests
+        """
+        super(SubscriberDataFeed, self).__init__(period, pairs, exchange, addr, timeout)
+        self.sub_addr = sub_addr
+        self.window = window
+        self.max_age = max_age
+
+        # Local market data, with their last update time
+        self.ticker = {}
+        self.charts = {}
+        self.updated = {}
+
+        self.sub = self.context.socket(zmq.SUB)
+        self.sub.connect(sub_addr)
+        self.sub.setsockopt_string(zmq.SUBSCRIBE, exchange + ' returnTicker')
+        for pair in pairs:
+            for symbol in (pair, self.reciprocal_pair(pair)):
+                self.sub.setsockopt_string(zmq.SUBSCRIBE, "%s returnChartArray %s " % (exchange, symbol))
+
+    def update(self, timeout=0):
+        """
+        Read the broadcast arrived since the last call
+        :param timeout: int: Milliseconds to wait for the first message
+        :return: int: Messages read
+        """
+        n = 0
+        while self.sub.poll(timeout if n == 0 else 0):
+            frames = self.sub.recv_multipart(copy=False)
+            topic = frames[0].bytes.decode().split(' ')
+            n += 1
+
+            if topic[1] == 'returnTicker':
+                self.ticker = json.loads(frames[1].bytes.decode())
+                self.updated['returnTicker'] = time()
+
+            elif topic[1] == 'returnChartArray':
+                chart = frame_array(json.loads(frames[1].bytes.decode()), frames[2])
+                if topic[2] in self.pairs:
+                    self.merge((topic[2], int(topic[3])), chart)
+                if self.reciprocal_pair(topic[2]) in self.pairs:
+                    self.merge((self.reciprocal_pair(topic[2]), int(topic[3])), self.reciprocal_array(chart))
+        return n
+
+    def merge(self, key, chart):
+        """
+        Put candles on a pair window, replacing bars from the first new date on
+        :param key: tuple: pair, period
+        :param chart: numpy record array: CHART_DTYPE candles
+        """
+        # The open candle is not final yet
+        chart = chart[chart['date'] < int(time()) // key[1] * key[1]]
+        if not chart.size:
+            return
+        window = self.charts.get(key, chart[:0])
+        dates = window['date']
+        window = np.concatenate([window[dates < chart['date'][0]], chart, window[dates > chart['date'][-1]]])
+
+        # Keep the last gapless run, broadcasts may have been missed
+        gaps = np.nonzero(np.diff(window['date']) != key[1])[0]
+        if gaps.size:
+            window = window[gaps[-1] + 1:]
+
+        self.charts[key] = window[-self.window:]
+        self.updated[key] = time()
+
+    def close(self):
+        self.sub.setsockopt(zmq.LINGER, 0)
+        self.sub.close()
+        super(SubscriberDataFeed, self).close()
+
+    def is_fresh(self, key):
+        return time() - self.updated.get(key, -np.inf) < self.max_age
+
+    def returnTicker(self):
+        self.update()
+        if self.ticker and self.is_fresh('returnTicker'):
+            return self.ticker
+        return super(SubscriberDataFeed, self).returnTicker()
+
+    def local_chart(self, currencyPair, period, start=None, end=None):
+        """ Candles from the local window, None if it does not cover the range """
+        key = (currencyPair, int(period))
+        chart = self.charts.get(key)
+
+        if chart is None or not chart.size or start is None or end is None:
+            return None
+
+        # Covered up to the last closed candle on the range, windows stop being so when broadcasts stop
+        period = int(period)
+        needed = min(float(end) // period * period, time() // period * period - period)
+        if chart['date'][0] < float(start) + period and chart['date'][-1] >= needed:
+            dates = chart['date']
+            return chart[(dates >= float(start)) & (dates <= float(end))]
+
+    def returnChartArray(self, currencyPair, period, start=None, end=None):
+        self.update()
+        chart = self.local_chart(currencyPair, period, start, end)
+        if chart is not None:
+            return chart
+
+        rep = super(SubscriberDataFeed, self).returnChartArray(currencyPair, period, start, end)
+        self.merge((currencyPair, int(period)), rep)
+        return rep
+
+    def get_charts(self, pairs, period, start=None, end=None, n_threads=1):
+        self.update()
+        charts = {pair: self.local_chart(pair, period, start, end) for pair in pairs}
+
+        # Uncovered pairs go on one request
+        missing = [pair for pair in pairs if charts[pair] is None]
+        if missing:
+            for pair, chart in zip(missing, super(SubscriberDataFeed, self).get_charts(missing, period, start, end)):
+                self.merge((pair, int(period)), chart)
+                charts[pair] = chart
+
+        return [charts[pair] for pair in pairs]
+
+
+class AsyncDataFeed(ExchangeConnection):
+    """
+    Pipelined asyncio data feed client.
+    Requests go over a DEALER socket, each under its own request id, so many of them can be in flight at once.
+    The FeedDaemon REP workers echo the id back on the reply envelope.
+    Feed methods are coroutines, with the same names and returns as DataFeed ones.
+    """
+    retryDelays = [2 ** i for i in range(4)]
+
+    # Sockets belong to the event loop thread
+    thread_safe = False
+
+    def __init__(self, period, pairs=[], exchange='', addr='', timeout=30):
+        """
+
+        :param period: int: Data sampling period
+        :param pairs: list: Pair symbols to trade
+        :param exchange: str: FeedDaemon exchange to query
+        :param addr: str: Client socked address
+        :param timeout: float: Seconds to wait for each reply
+        """
+        super(AsyncDataFeed, self).__init__(period, pairs)
+
+        # Sock objects
+        self.context = zmq.asyncio.Context()
+        self.addr = addr
+        self.exchange = exchange
+        self.timeout = timeout
+
+        self.sock = self.context.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(addr)
+
+        # Request id: reply future
+        self._pending = {}
+        self._ids = _count()
+        self._reader = None
+
+    # Retry decorator
+    def retry(func):
+        """ Retry decorator """
+
+        @_wraps(func)
+        async def retrying(*args, **kwargs):
+            problems = []
+            for delay in _chain(AsyncDataFeed.retryDelays, [None]):
+                try:
+                    # attempt call
+                    return await func(*args, **kwargs)
+
+                # we need to try again
+                except DataFeedException as problem:
+                    problems.append(problem)
+                    if delay is None:
+                        Logger.debug(AsyncDataFeed, problems)
+                        raise DataFeedRetryException('retryDelays exhausted ' + str(problem))
+                    else:
+                        # log exception and wait
+                        Logger.debug(AsyncDataFeed, problem)
+                        Logger.error(AsyncDataFeed, "-- delaying for %ds" % delay)
+                        await asyncio.sleep(delay)
+
+        return retrying
+
+    async def read_replies(self):
+        """ Route replies to their request futures. Replies of timed out requests are dropped """
+        while True:
+            frames = await self.sock.recv_multipart(copy=False)
+            future = self._pending.pop(frames[0].bytes, None)
+            if future is None or future.done():
+                continue
+
+            # Skip the envelope delimiter. Binary replies carry the array metadata and buffer
+            if len(frames) > 3:
+                future.set_result(frame_array(json.loads(frames[2].bytes.decode()), frames[3]))
+            else:
+                future.set_result(json.loads(frames[2].bytes.decode()))
+
+    async def get_response(self, req, timeout=None):
+        """
+        Send a request and wait for its reply, other requests can be sent meanwhile
+        :param req: str: Request, without the exchange name
+        :param timeout: float: Seconds to wait for the reply. None uses self.timeout
+        :return: Daemon reply
+        """
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.ensure_future(self.read_replies())
+
+        req = self.exchange + ' ' + req
+        rid = ('%x' % next(self._ids)).encode()
+        future = asyncio.get_event_loop().create_future()
+        self._pending[rid] = future
+
+        try:
+            await self.sock.send_multipart([rid, b'', req.encode()])
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+
+        except asyncio.TimeoutError:
+            Logger.error(AsyncDataFeed.get_response, "%s request timeout." % req)
+            raise DataFeedException("%s request timeout." % req)
+
+        finally:
+            self._pending.pop(rid, None)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self.sock.close()
+
+    @retry
+    async def returnTicker(self):
+        try:
+            rep = await self.get_response('returnTicker')
+            assert isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnTicker")
+
+    @retry
+    async def returnBalances(self):
+        """
+        Return balance from exchange. API KEYS NEEDED!
+        :return: dict:
+        """
+        try:
+            rep = await self.get_response('returnBalances')
+            assert isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnBalances")
+
+    @retry
+    async def returnFeeInfo(self):
+        try:
+            rep = await self.get_response('returnFeeInfo')
+            assert isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnFeeInfo")
+
+    @retry
+    async def returnCurrencies(self):
+        try:
+            rep = await self.get_response('returnCurrencies')
+            assert isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnCurrencies")
+
+    async def get_chart(self, command, currencyPair, period, start=None, end=None):
+        """
+        Chart request, from the reciprocal pair if the exchange does not list the pair
+        :param command: str: returnChartData or returnChartArray
+        :return: list or numpy record array: Candles
+        """
+        if currencyPair not in self._inverted:
+            rep = await self.get_response("%s %s %s %s %s" % (command, str(currencyPair), str(period),
+                                                               str(start), str(end)))
+
+            if isinstance(rep, str) and 'Invalid currency pair.' in rep:
+                self._inverted.add(currencyPair)
+
+        # Inverted pairs skip the failing request on later calls
+        if currencyPair in self._inverted:
+            rep = await self.get_response("%s %s %s %s %s" % (command, self.reciprocal_pair(currencyPair),
+                                                               str(period), str(start), str(end)))
+            rep = self.reciprocal_array(rep) if command == 'returnChartArray' else self.reciprocal_records(rep)
+
+        return rep
+
+    @retry
+    async def returnChartData(self, currencyPair, period, start=None, end=None):
+        """
+        Return pair OHLC data
+        :param currencyPair: str: Desired pair str
+        :param period: int: Candle period. Must be in [300, 900, 1800, 7200, 14400, 86400]
+        :param start: str: UNIX timestamp to start from
+        :param end:  str: UNIX timestamp to end returned data
+        :return: list: List containing desired asset data in "records" format
+        """
+        try:
+            rep = await self.get_chart('returnChartData', currencyPair, period, start, end)
+            assert isinstance(rep, list)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnChartData")
+
+    @retry
+    async def returnChartArray(self, currencyPair, period, start=None, end=None):
+        """
+        Return pair OHLC data, framed by the daemon as a binary record array
+        :return: numpy record array: (T,) CHART_DTYPE candles over the received buffer
+        """
+        try:
+            rep = await self.get_chart('returnChartArray', currencyPair, period, start, end)
+            assert isinstance(rep, np.ndarray)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnChartArray")
+
+    async def get_charts(self, pairs, period, start=None, end=None, n_threads=1):
+        """
+        Request all pairs candles at once. Takes about as long as the slowest request
+        :param pairs: list: Pair symbols
+        :param n_threads: int: Unused, requests are pipelined
+        :return: list: numpy record arrays in pairs order
+        """
+        return await asyncio.gather(*[self.returnChartArray(pair, period, start, end) for pair in pairs])
+
+    @retry
+    async def returnTradeHistory(self, currencyPair='all', start=None, end=None):
+        try:
+            rep = await self.get_response("returnTradeHistory %s %s %s" % (str(currencyPair),
+                                                                           str(start),
+                                                                           str(end)))
+            assert isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.returnTradeHistory")
+
+    async def order(self, command, currencyPair, rate, amount, orderType=False):
+        call = "%s %s %s %s %s" % (command, str(currencyPair), str(rate), str(amount), str(orderType))
+        rep = await self.get_response(call)
+
+        if 'Invalid currency pair.' in rep:
+            call = "%s %s %s %s %s" % (command, self.reciprocal_pair(currencyPair), str(rate), str(amount),
+                                       str(orderType))
+            rep = await self.get_response(call)
+
+        return rep
+
+    @retry
+    async def sell(self, currencyPair, rate, amount, orderType=False):
+        try:
+            rep = await self.order('sell', currencyPair, rate, amount, orderType)
+            assert isinstance(rep, str) or isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.sell")
+
+    @retry
+    async def buy(self, currencyPair, rate, amount, orderType=False):
+        try:
+            rep = await self.order('buy', currencyPair, rate, amount, orderType)
+            assert isinstance(rep, str) or isinstance(rep, dict)
+            return rep
+
+        except AssertionError:
+            raise DataFeedException("Unexpected response from AsyncDataFeed.buy")
+
+
 # Test datafeeds
 class BacktestDataFeed(ExchangeConnection):
     """
     Data feeder for backtesting with TradingEnvironment.
     """
     # TODO WRITE TESTS
-    def __init__(self, tapi, period, pairs=[], balance={}, load_dir=None):
+    def __init__(self, tapi, period, pairs=[], balance={}, load_dir=None, cache_dir=None):
+        """
+        :param cache_dir: str: Local candle store directory used by download_data. None downloads every call
+        """
         super().__init__(period, pairs)
         self.tapi = tapi
         self.ohlc_data = {}
         self._balance = balance
         self.data_length = 0
         self.load_dir = load_dir
+        self.cache_dir = cache_dir
+
+        # Columnar data
+        self.dates = np.empty(0, dtype=np.int64)
+        self.ohlc_array = np.empty((0, len(self.pairs), len(OHLC_FIELDS)), dtype=np.float64)
+        self.synthetic = np.empty((0, len(self.pairs)), dtype=bool)
+        self._price_relatives = None
+        self._shared = None
+        self._mapped = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shared is not None or self._mapped is not None:
+            # Price data travels on shared memory or is mapped again from its file
+            state['ohlc_data'] = state['dates'] = state['ohlc_array'] = state['synthetic'] = None
+            state['_price_relatives'] = None
+        # Locks do not pickle
+        state['coach'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.coach = Coach()
+        if self._shared is not None:
+            self.attach_shared()
+        elif self._mapped is not None:
+            self.map_arrays(self._mapped)
 
     def returnBalances(self):
         return self._balance
@@ -509,75 +1772,358 @@ class BacktestDataFeed(ExchangeConnection):
         else:
             return self.tapi.returnCurrencies()
 
-    def download_data(self, start=None, end=None):
-        # TODO WRITE TEST
+    def fetch_candles(self, pair, start=None, end=None):
+        """
+        Download pair candles, from the reciprocal pair if the exchange does not list it
+        :param pair: str: Pair name
+        :param start: int: Start timestamp
+        :param end: int: End timestamp
+        :return: pandas DataFrame: Candles
+        """
+        if pair not in self._inverted:
+            try:
+                return pd.DataFrame.from_records(self.tapi.returnChartData(pair, period=self.period * 60,
+                                                                           start=start, end=end))
+            except ExchangeError as e:
+                # Other errors, as rate limits or connection issues, say nothing about the pair
+                if 'Invalid currency pair.' not in str(e):
+                    raise e
+                self._inverted.add(pair)
+
+        return self.pair_reciprocal(pd.DataFrame.from_records(
+            self.tapi.returnChartData(self.reciprocal_pair(pair), period=self.period * 60, start=start, end=end)))
+
+    def download_data(self, start=None, end=None, n_threads=1):
+        """
+        Download pairs candles on [start, end].
+        With a cache directory set, only the candles missing from the local store are downloaded.
+        :param start: int: Start timestamp. Defaults to one day before end
+        :param end: int: End timestamp. Defaults to now
+        :param n_threads: int: Concurrent exchange requests, across pairs and pages
+        :return: None
+        """
         self.ohlc_data = {}
         self.data_length = None
-        for pair in self.pairs:
-            try:
-                ohlc_df = pd.DataFrame.from_records(self.tapi.returnChartData(pair, period=self.period * 60,
-                                                                   start=start, end=end
-                                                                  ))
 
-                self.ohlc_data[pair] = ohlc_df
+        if self.cache_dir:
+            end = int(end or time())
+            start = int(start or end - 24 * 60 * 60)
+            cache = CandleCache(self.cache_dir, self.tapi.__class__.__name__.lower(), self.period)
 
-            except ExchangeError:
-                try:
-                    symbols = pair.split('_')
-                    self.ohlc_data[pair] = self.pair_reciprocal(pd.DataFrame.from_records(
-                        self.tapi.returnChartData(symbols[1] + '_' + symbols[0], period=self.period * 60,
-                                                   start=start, end=end
-                                                  )))
-                except ExchangeError as e:
-                    raise e
+            # Plan every pair missing pages, download them together and merge back per pair
+            stored = [cache.load(pair) for pair in self.pairs]
+            requests = [cache.requests(ranges, start, end) for _, ranges in stored]
+            chunks = iter(self.map_requests(self.fetch_candles, [(pair, request_start, request_end)
+                                                                 for pair, pair_requests in zip(self.pairs, requests)
+                                                                 for request_start, request_end in pair_requests],
+                                            n_threads))
+
+            for pair, (df, ranges), pair_requests in zip(self.pairs, stored, requests):
+                if pair_requests:
+                    df = cache.merge(pair, df, ranges, pair_requests, [next(chunks) for _ in pair_requests])
+                self.ohlc_data[pair] = cache.select(df, start, end)
+
+        else:
+            for pair, df in zip(self.pairs, self.map_requests(self.fetch_candles,
+                                                              [(pair, start, end) for pair in self.pairs], n_threads)):
+                self.ohlc_data[pair] = df
 
         for key in self.ohlc_data:
             if not self.data_length or self.ohlc_data[key].shape[0] < self.data_length:
                 self.data_length = self.ohlc_data[key].shape[0]
 
+        # Align pairs on the shortest history
         for key in self.ohlc_data:
-            if self.ohlc_data[key].shape[0] != self.data_length:
-                self.ohlc_data[key] = pd.DataFrame.from_records(self.tapi.returnChartData(key, period=self.period * 60,
-                                                               start=self.ohlc_data[key].date.iloc[-self.data_length],
-                                                               end=end
-                                                               ))
-
-            self.ohlc_data[key].set_index('date', inplace=True, drop=False)
+            df = self.ohlc_data[key]
+            df = df.iloc[df.shape[0] - self.data_length:]
+            df.index = pd.Index(df['date'].values, name='date')
+            self.ohlc_data[key] = df
 
+        self.build_arrays()
 
         print("%d intervals, or %d days of data at %d minutes period downloaded." % (self.data_length, (self.data_length * self.period) /\
                                                                 (24 * 60), self.period))
 
-    def save_data(self, dir=None):
+    def save_data(self, dir=None, binary=False):
         """
         Save data to disk
         :param dir: str: directory relative to ./; eg './data/train
+        :param binary: bool: Save memory mappable columnar files instead of JSON records. The gap filled
+        columnar arrays are saved too, so loading maps them instead of building them again
         :return:
         """
         for item in self.ohlc_data:
-            self.ohlc_data[item].to_json(dir+'/'+str(item)+'_'+str(self.period)+'min.json', orient='records')
+            path = dir + '/' + str(item) + '_' + str(self.period) + 'min'
+            if binary:
+                save_candles(self.ohlc_data[item], path)
+            else:
+                self.ohlc_data[item].to_json(path + '.json', orient='records')
+
+        if binary and self.data_length:
+            save_arrays(self.dates, self.ohlc_array, self.synthetic, dir + '/arrays_' + str(self.period) + 'min',
+                        period=self.period, pairs=list(self.pairs))
 
     def load_data(self, dir):
         """
         Load data form disk.
-        JSON like data expected.
+        Binary candle files are memory mapped when present, JSON like data is expected otherwise.
+        Columnar arrays saved for the same pairs are mapped as they are, see map_arrays.
         :param dir: str: directory relative to self.load_dir; eg: './self.load_dir/dir'
         :return: None
         """
+        path = self.load_dir + dir + '/arrays_' + str(self.period) + 'min'
+        if os.path.exists(path + '.header.json') and load_header(path).get('pairs') == list(self.pairs):
+            return self.map_arrays(self.load_dir + dir)
+
         self.ohlc_data = {}
         self.data_length = None
         for key in self.pairs:
-            self.ohlc_data[key] = pd.read_json(self.load_dir + dir +'/'+str(key)+'_'+str(self.period)+'min.json', convert_dates=False,
-                                                orient='records', date_unit='s', keep_default_dates=False, dtype=False)
-            self.ohlc_data[key].set_index('date', inplace=True, drop=False)
+            path = self.load_dir + dir + '/' + str(key) + '_' + str(self.period) + 'min'
+            if os.path.exists(path + '.header.json'):
+                self.ohlc_data[key] = load_candles(path)
+            else:
+                self.ohlc_data[key] = pd.read_json(path + '.json', convert_dates=False, orient='records',
+                                                   date_unit='s', keep_default_dates=False, dtype=False)
+                self.ohlc_data[key].set_index('date', inplace=True, drop=False)
             if not self.data_length:
                 self.data_length = self.ohlc_data[key].shape[0]
             else:
                 assert self.data_length == self.ohlc_data[key].shape[0]
 
+        self.build_arrays()
+
+    def map_arrays(self, dir):
+        """
+        Map the columnar arrays saved by save_data in binary mode.
+        ohlc_array, dates and synthetic are copy on write views over the file, so processes mapping it share
+        its pages, and ohlc_data frames are built over ohlc_array without copying. Fields other than
+        OHLC_FIELDS are read from the pair candle files. Pickled copies of the feed carry the directory only
+        and map the file again.
+        :param dir: str: Data directory
+        :return: None
+        """
+        self.dates, self.ohlc_array, self.synthetic = load_arrays(dir + '/arrays_' + str(self.period) + 'min')
+        self.data_length = self.dates.shape[0]
+        self._price_relatives = None
+        self._shared = None
+        self._mapped = dir
+
+        self.build_frames()
+        for i, pair in enumerate(self.pairs):
+            self.fill_fields(pair, load_candles(dir + '/' + str(pair) + '_' + str(self.period) + 'min'),
+                             self.synthetic[:, i])
+
+    def build_arrays(self):
+        """
+        Pack ohlc_data into a contiguous (time, pair, field) float64 array.
+        Fields follow OHLC_FIELDS order and pairs follow self.pairs order.
+        Gaps are filled here, once per loaded data set: missing periods are inserted and bars without prices
+        repeat the previous close with zero volume. self.synthetic marks those bars, and ohlc_data is rebuilt
+        from the arrays when anything was filled. Rebuilt frames keep the other numeric fields, as quoteVolume
+        and weightedAverage: synthetic bars get zero quoteVolume and their close as weightedAverage.
+        :return: None
+        """
+        self.dates = self.ohlc_data[self.pairs[0]]['date'].values[-self.data_length:].astype(np.int64)
+        self.ohlc_array = np.empty((self.data_length, len(self.pairs), len(OHLC_FIELDS)), dtype=np.float64)
+        for i, pair in enumerate(self.pairs):
+            df = self.ohlc_data[pair].iloc[-self.data_length:]
+            assert (df['date'].values.astype(np.int64) == self.dates).all(), "Pairs dates are not aligned."
+            self.ohlc_array[:, i, :] = df[OHLC_FIELDS].values.astype(np.float64)
+        self._price_relatives = None
+        self._shared = None
+        self._mapped = None
+
+        if self.data_length:
+            if (np.diff(self.dates) > 0).all() and ((self.dates - self.dates[0]) % (self.period * 60) == 0).all():
+                dates, self.ohlc_array, self.synthetic = fill_bars(self.dates, self.ohlc_array, self.period)
+            else:
+                # Dates off the period grid are kept, only missing values are filled
+                dates = self.dates
+                _, self.ohlc_array, self.synthetic = fill_bars(np.arange(self.data_length) * 60, self.ohlc_array, 1)
+
+            if dates.shape[0] != self.data_length or self.synthetic.any():
+                frames = {pair: self.ohlc_data[pair].iloc[-self.data_length:] for pair in self.pairs}
+                self.dates = dates
+                self.data_length = dates.shape[0]
+                self.build_frames()
+                for i, pair in enumerate(self.pairs):
+                    self.fill_fields(pair, frames[pair], self.synthetic[:, i])
+        else:
+            self.synthetic = np.empty((0, len(self.pairs)), dtype=bool)
+
+    def fill_fields(self, pair, frame, synthetic):
+        """
+        Carry a loaded frame fields other than date and OHLC_FIELDS over to the rebuilt pair frame
+        :param pair: str: Pair name
+        :param frame: pandas DataFrame: Loaded pair frame
+        :param synthetic: numpy array: (data_length,) pair synthetic bars mask
+        :return: None
+        """
+        df = self.ohlc_data[pair]
+        rows = np.searchsorted(self.dates, frame['date'].values.astype(np.int64))
+        for field in frame.columns:
+            if field == 'date' or field in OHLC_FIELDS:
+                continue
+            values = np.full(self.data_length, np.nan)
+            values[rows] = frame[field].values.astype(np.float64)
+            if field == 'quoteVolume':
+                values[synthetic] = 0.
+            elif field == 'weightedAverage':
+                values[synthetic] = df['close'].values[synthetic]
+            df[field] = values
+
+    @property
+    def price_relatives(self):
+        """
+        Open price relatives, computed once per loaded data set.
+        Row t holds open[t] / open[t - 1] for each pair. The first row and relatives of missing prices are ones.
+        :return: numpy array: (data_length, n_pairs) price relatives
+        """
+        if self._price_relatives is None:
+            opens = self.ohlc_array[:, :, 0]
+            relatives = np.ones_like(opens)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(opens[1:], opens[:-1], out=relatives[1:])
+            relatives[~np.isfinite(relatives)] = 1.
+            self._price_relatives = relatives
+        return self._price_relatives
+
+    def share_memory(self):
+        """
+        Move columnar arrays to shared memory.
+        Pickled copies of the feed, as sent to worker processes on start, carry the shared buffers
+        instead of the price data and rebuild ohlc_data from them. Fields other than OHLC_FIELDS, as
+        quoteVolume, are shared as floats too, and ohlc_data is rebuilt here the same way, so every
+        process sees equal frames. Feeds mapping their arrays from file already share its pages.
+        :return: None
+        """
+        if self._shared is None and self._mapped is None:
+            frames = [self.ohlc_data[pair].iloc[-self.data_length:] for pair in self.pairs]
+            fields = [field for field in frames[0].columns if field != 'date' and field not in OHLC_FIELDS]
+
+            dates = RawArray(ctypes.c_int64, self.dates.shape[0])
+            ohlc = RawArray(ctypes.c_double, self.ohlc_array.size)
+            synthetic = RawArray(ctypes.c_bool, self.synthetic.size)
+            extra = RawArray(ctypes.c_double, self.data_length * len(self.pairs) * len(fields))
+            np.frombuffer(dates, dtype=np.int64)[:] = self.dates
+            np.frombuffer(ohlc, dtype=np.float64)[:] = self.ohlc_array.ravel()
+            np.frombuffer(synthetic, dtype=bool)[:] = self.synthetic.ravel()
+            extra_array = np.frombuffer(extra, dtype=np.float64).reshape(self.data_length, len(self.pairs),
+                                                                          len(fields))
+            extra_array[:] = np.nan
+            for i, frame in enumerate(frames):
+                for j, field in enumerate(fields):
+                    if field in frame:
+                        extra_array[:, i, j] = frame[field].values.astype(np.float64)
+            self._shared = (dates, ohlc, synthetic, extra, fields)
+
+            self.attach_shared()
+
+    def attach_shared(self):
+        """
+        Map columnar arrays over the shared buffers and rebuild ohlc_data from them
+        :return: None
+        """
+        dates, ohlc, synthetic, extra, fields = self._shared
+        self.dates = np.frombuffer(dates, dtype=np.int64)
+        self.ohlc_array = np.frombuffer(ohlc, dtype=np.float64).reshape(self.dates.shape[0], len(self.pairs),
+                                                                        len(OHLC_FIELDS))
+        self.synthetic = np.frombuffer(synthetic, dtype=bool).reshape(self.dates.shape[0], len(self.pairs))
+        self.build_frames()
+
+        extra = np.frombuffer(extra, dtype=np.float64).reshape(self.dates.shape[0], len(self.pairs), len(fields))
+        for i, pair in enumerate(self.pairs):
+            for j, field in enumerate(fields):
+                self.ohlc_data[pair][field] = extra[:, i, j]
+
+    def build_frames(self):
+        """
+        Rebuild ohlc_data from the columnar arrays. Frames prices are views over ohlc_array
+        :return: None
+        """
+        self.ohlc_data = {}
+        for i, pair in enumerate(self.pairs):
+            df = pd.DataFrame(self.ohlc_array[:, i], index=pd.Index(self.dates, name='date'), columns=OHLC_FIELDS,
+                              copy=False)
+            df.insert(0, 'date', self.dates)
+            self.ohlc_data[pair] = df
+
+    def resample(self, *periods):
+        """
+        Derive coarser period feeds from this feed columnar arrays, all timeframes in one pass.
+        Bins partially covered at the data edges are dropped, so periods without a complete bin get empty feeds.
+        :param periods: int: Target periods in minutes, multiples of the feed period
+        :return: dict: period: BacktestDataFeed
+        """
+        feeds = {}
+        for period, (dates, ohlc) in resample_multi(self.dates, self.ohlc_array, self.period, periods).items():
+            # Edge bins must hold every base bar
+            first = 0 if self.dates[0] % (period * 60) == 0 else 1
+            last = dates.shape[0] if (self.dates[-1] + self.period * 60) % (period * 60) == 0 else -1
+
+            feed = BacktestDataFeed(self.tapi, period, pairs=self.pairs, balance=self._balance,
+                                    load_dir=self.load_dir, cache_dir=self.cache_dir)
+            feed.dates = dates[first:last]
+            feed.ohlc_array = np.ascontiguousarray(ohlc[first:last])
+            feed.data_length = feed.dates.shape[0]
+
+            # Bins made of synthetic bars only are synthetic
+            if feed.data_length:
+                rows = np.searchsorted(self.dates, [feed.dates[0], feed.dates[-1] + period * 60])
+                starts = np.searchsorted(self.dates, feed.dates) - rows[0]
+                feed.synthetic = np.logical_and.reduceat(self.synthetic[rows[0]:rows[1]], starts, axis=0)
+            else:
+                feed.synthetic = np.empty((0, len(self.pairs)), dtype=bool)
+            feed.build_frames()
+            feeds[period] = feed
+
+        return feeds
+
+    def get_window(self, end, length):
+        """
+        Return a zero-copy view over the columnar data
+        :param end: int: Last row index, inclusive
+        :param length: int: Number of rows
+        :return: tuple: dates view, (length, pair, field) ohlc view
+        """
+        start = end - length + 1
+        assert start >= 0, "Not enough data for the requested window."
+        return self.dates[start:end + 1], self.ohlc_array[start:end + 1]
+
+    def get_rows(self, start=None, end=None):
+        """
+        Map epoch bounds to a row slice by binary search on the sorted dates array
+        :param start: int: First timestamp, included. None from the first row
+        :param end: int: Last timestamp, included. None up to the last row
+        :return: slice: Rows
+        """
+        return slice(None if start is None else int(np.searchsorted(self.dates, start)),
+                     None if end is None else int(np.searchsorted(self.dates, end, side='right')))
+
+    def get_range(self, currencyPair, start=None, end=None):
+        """
+        Return a zero-copy view over one pair columnar data between epoch bounds
+        :param currencyPair: str: Pair name
+        :param start: int: First timestamp, included
+        :param end: int: Last timestamp, included
+        :return: tuple: dates view, (n_rows, field) ohlc view with fields in OHLC_FIELDS order
+        """
+        rows = self.get_rows(start, end)
+        return self.dates[rows], self.ohlc_array[rows, self.pairs.index(currencyPair)]
+
+    def get_synthetic(self, currencyPair, start=None, end=None):
+        """
+        Return a zero-copy view over one pair synthetic bars mask between epoch bounds
+        :param currencyPair: str: Pair name
+        :param start: int: First timestamp, included
+        :param end: int: Last timestamp, included
+        :return: numpy array: (n_rows,) True on bars filled at load time
+        """
+        return self.synthetic[self.get_rows(start, end), self.pairs.index(currencyPair)]
+
     def returnChartData(self, currencyPair, period, start=None, end=None):
         try:
-            data = json.loads(self.ohlc_data[currencyPair].loc[start:end, :].to_json(orient='records'))
+            data = json.loads(self.ohlc_data[currencyPair].iloc[self.get_rows(start, end)].to_json(orient='records'))
 
             return data
 
@@ -629,23 +2175,16 @@ class PaperTradingDataFeed(ExchangeConnection):
         :param end:  str: UNIX timestamp to end returned data
         :return: list: List containing desired asset data in "records" format
         """
-        try:
-            return self.tapi.returnChartData(currencyPair, period, start=start, end=end)
-        except ExchangeError as error:
-            if 'Invalid currency pair.' == error.__str__():
-                try:
-                    symbols = currencyPair.split('_')
-                    pair = symbols[1] + '_' + symbols[0]
-                    return json.loads(
-                        self.pair_reciprocal(pd.DataFrame.from_records(self.tapi.returnChartData(pair, period,
-                                                                                                 start=start,
-                                                                                                 end=end
-                                                                                                 ))).to_json(
-                            orient='records'))
-                except Exception as e:
-                    raise e
-            else:
-                raise error
+        if currencyPair not in self._inverted:
+            try:
+                return self.tapi.returnChartData(currencyPair, period, start=start, end=end)
+            except ExchangeError as error:
+                if 'Invalid currency pair.' != error.__str__():
+                    raise error
+                self._inverted.add(currencyPair)
+
+        return self.reciprocal_records(self.tapi.returnChartData(self.reciprocal_pair(currencyPair), period,
+                                                                 start=start, end=end))
 
 
 # Live datafeeds
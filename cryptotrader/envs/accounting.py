@@ -0,0 +1,260 @@
+"""
+Fixed point accounting backend for simulated trading environments
+"""
+from decimal import Decimal, ROUND_HALF_EVEN, ROUND_UP, localcontext
+
+import numpy as np
+
+from ..utils import dec_con
+
+# Portfolio weights and fee rates are held as integer parts per 10 ** WEIGHT_PRECISION
+WEIGHT_PRECISION = 8
+WEIGHT_SCALE = 10 ** WEIGHT_PRECISION
+
+
+def mul_div(a, b, d, round_up=False):
+    """
+    Exact integer a * b / d, rounded down or up.
+    Products that may overflow int64 are computed with python integers.
+    :param a: int or numpy array: int64 multiplicand
+    :param b: int or numpy array: int64 multiplier
+    :param d: int or numpy array: int64 positive divisor
+    :param round_up: bool: Round result towards +inf instead of -inf
+    :return: numpy array: int64 result
+    """
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    d = np.asarray(d, dtype=np.int64)
+
+    bound = np.abs(a.astype(np.float64)) * np.abs(b.astype(np.float64))
+    if not bound.size or bound.max() < 2. ** 62:
+        prod = a * b
+    else:
+        prod = a.astype(object) * b.astype(object)
+        d = d.astype(object)
+
+    if round_up:
+        out = -((-prod) // d)
+    else:
+        out = prod // d
+
+    return np.asarray(out).astype(np.int64)
+
+
+def rebalance(holdings, prices, weights, fees):
+    """
+    Vectorized portfolio rebalance, as simulated by TradingEnvironment.simulate_trade.
+
+    Pairs with decreasing weight are sold first at the initial portfolio value. Pairs with increasing
+    weight are then bought with the portfolio value left after sell fees. When fiat runs short it is
+    clipped at zero and the shortfall is deduced from the portfolio value used by that and the
+    following purchases. Fees are rounded up under Decimal arithmetic.
+
+    Works on float arrays or Decimal object arrays. Leading axes are batch axes, so many portfolios
+    can be rebalanced in one call.
+    :param holdings: numpy array: (..., n + 1) symbols amounts, fiat last
+    :param prices: numpy array: (..., n) pairs prices in fiat
+    :param weights: numpy array: (..., n + 1) target portfolio vector, fiat last
+    :param fees: numpy array: (..., n) pairs fee rates
+    :return: tuple: (..., n + 1) post trade holdings, (..., n) fees paid in fiat
+    """
+    holdings, prices, weights, fees = np.asarray(holdings), np.asarray(prices), np.asarray(weights), \
+                                      np.asarray(fees)
+
+    values = holdings[..., :-1] * prices
+    portval = np.asarray(values.sum(axis=-1) + holdings[..., -1])[..., None]
+    change = weights[..., :-1] - values / portval
+    sell = (change < 0).astype(bool)
+    buy = (change > 0).astype(bool)
+
+    # Sell assets first
+    sold = portval * np.where(sell, -change, 0)
+    with localcontext() as ctx:
+        ctx.rounding = ROUND_UP
+        sell_fee = sold * fees
+    crypto = np.where(sell, portval * weights[..., :-1] / prices, holdings[..., :-1])
+    fiat = np.asarray(holdings[..., -1] + (sold - sell_fee).sum(axis=-1))
+
+    # Then buy some goods with the value left after fees
+    portval = np.asarray((crypto * prices).sum(axis=-1) + fiat)[..., None]
+    cost = np.where(buy, change, 0)
+    left = fiat[..., None] - portval * np.cumsum(cost, axis=-1)
+
+    # Fiat is non increasing, so purchases from the first short one on are clipped
+    short = (left < 0).astype(bool)
+    first = short & ~np.concatenate([np.zeros_like(short[..., :1]), short[..., :-1]], axis=-1)
+    shortfall = np.asarray(np.where(first, left, 0).sum(axis=-1))[..., None]
+    buy_portval = np.where(short, (portval + shortfall) * np.cumprod(np.where(short & ~first, 1 - cost, 1),
+                                                                     axis=-1), portval)
+    bought = buy_portval * cost
+    with localcontext() as ctx:
+        ctx.rounding = ROUND_UP
+        buy_fee = bought * fees
+    crypto = np.where(buy, (buy_portval * weights[..., :-1] - buy_fee) / prices, crypto)
+    fiat = np.where(short[..., -1], 0, left[..., -1])
+
+    return np.concatenate([crypto, fiat[..., None]], axis=-1), sell_fee + np.where(buy, buy_fee, 0)
+
+
+class FixedPointAccount(object):
+    """
+    Portfolio balance held as int64 counts of the smallest unit of each asset.
+
+    Symbols follow environment order, pairs symbols first and fiat last. Prices are expressed
+    in fiat units per whole asset, so holding values are integer fiat units. Fees are rounded up
+    and purchased amounts rounded down, so the account never creates value from rounding.
+    """
+    def __init__(self, symbols, precision=8):
+        """
+        :param symbols: list: Symbols names, fiat last
+        :param precision: int or dict: Decimal places kept for each symbol
+        """
+        self.symbols = list(symbols)
+        self._index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+        if isinstance(precision, dict):
+            self.precision = np.array([precision[symbol] for symbol in self.symbols], dtype=np.int64)
+        else:
+            self.precision = np.full(len(self.symbols), precision, dtype=np.int64)
+        assert ((self.precision >= 0) & (self.precision <= 18)).all(), "Precision must be in [0, 18]."
+
+        self.scale = 10 ** self.precision
+        self.units = np.zeros(len(self.symbols), dtype=np.int64)
+
+    # Conversions
+    @staticmethod
+    def quantize(value, precision, rounding=ROUND_HALF_EVEN):
+        """
+        Convert a number to integer units at given precision
+        :param value: Decimal, str or float: Amount
+        :param precision: int: Decimal places
+        :param rounding: str: Decimal rounding mode
+        :return: int:
+        """
+        if not isinstance(value, Decimal):
+            value = dec_con.create_decimal(str(value))
+        return int(value.scaleb(int(precision)).to_integral_value(rounding))
+
+    @staticmethod
+    def to_decimal(units, precision):
+        """
+        Convert integer units to Decimal
+        :param units: int: Amount in units
+        :param precision: int: Decimal places
+        :return: Decimal:
+        """
+        return Decimal(int(units)).scaleb(-int(precision))
+
+    def price_units(self, prices):
+        """
+        Convert prices to fiat units
+        :param prices: array like: Float prices, one per pair
+        :return: numpy array: int64 prices
+        """
+        prices = np.rint(np.asarray(prices, dtype=np.float64) * self.scale[-1]).astype(np.int64)
+        assert (prices > 0).all(), "Prices must be positive. Prices: %s" % str(prices)
+        return prices
+
+    def rate_units(self, rates):
+        """
+        Convert fee rates to parts per WEIGHT_SCALE
+        :param rates: array like: Fee rates, one per pair
+        :return: numpy array: int64 rates
+        """
+        return np.array([self.quantize(rate, WEIGHT_PRECISION) for rate in rates], dtype=np.int64)
+
+    def to_weights(self, action):
+        """
+        Convert an action vector to integer weights summing exactly to WEIGHT_SCALE.
+        Rounding residual is assigned to fiat.
+        :param action: array like: Desired portfolio vector
+        :return: numpy array: int64 weights
+        """
+        action = np.asarray(action, dtype=np.float64)
+        assert action.shape == self.units.shape, "Action shape mismatch. Shape: %s" % str(action.shape)
+        assert np.isfinite(action).all() and (action >= 0).all() and action.sum() > 0, \
+            "Invalid action vector: %s" % str(action)
+
+        weights = np.floor(action / action.sum() * WEIGHT_SCALE).astype(np.int64)
+        weights[-1] += WEIGHT_SCALE - weights.sum()
+        return weights
+
+    # Balance
+    def set(self, symbol, value):
+        self.units[self._index[symbol]] = self.quantize(value, self.precision[self._index[symbol]])
+
+    def get(self, symbol):
+        i = self._index[symbol]
+        return self.to_decimal(self.units[i], self.precision[i])
+
+    def balance(self):
+        """
+        :return: dict: Decimal amount for each symbol
+        """
+        return {symbol: self.get(symbol) for symbol in self.symbols}
+
+    def values(self, prices):
+        """
+        Holdings value
+        :param prices: numpy array: int64 prices
+        :return: numpy array: int64 value of each holding in fiat units, fiat last
+        """
+        return np.append(mul_div(self.units[:-1], prices, self.scale[:-1]), self.units[-1])
+
+    def portval(self, prices):
+        """
+        :param prices: numpy array: int64 prices
+        :return: int: Portfolio value in fiat units
+        """
+        return int(self.values(prices).sum())
+
+    def weights(self, prices):
+        """
+        :param prices: numpy array: int64 prices
+        :return: numpy array: int64 current portfolio weights
+        """
+        values = self.values(prices)
+        portval = values.sum()
+        if portval <= 0:
+            return np.zeros_like(values)
+        return mul_div(values, WEIGHT_SCALE, portval)
+
+    def rebalance(self, weights, prices, rates):
+        """
+        Rebalance holdings to target weights.
+
+        Sells are executed first at the initial portfolio value. Buys are then sized on the
+        value left after sell fees. Whenever fiat runs short, the shortfall is deduced from
+        the portfolio value used for that purchase and fiat is clipped at zero.
+        :param weights: numpy array: int64 target weights, fiat last
+        :param prices: numpy array: int64 prices
+        :param rates: numpy array: int64 fee rates
+        :return: numpy array: int64 fees paid for each pair, in fiat units
+        """
+        values = self.values(prices)
+        portval = values.sum()
+        if portval <= 0:
+            return np.zeros(prices.shape[0], dtype=np.int64)
+
+        change = mul_div(portval, weights, WEIGHT_SCALE)[:-1] - values[:-1]
+        sell = change < 0
+        buy = change > 0
+
+        # Sell assets first
+        sold = np.where(sell, -change, 0)
+        sell_fee = mul_div(sold, rates, WEIGHT_SCALE, round_up=True)
+        target = mul_div(portval, weights[:-1], WEIGHT_SCALE)
+        self.units[:-1] = np.where(sell, mul_div(target, self.scale[:-1], prices), self.units[:-1])
+        self.units[-1] += (sold - sell_fee).sum()
+
+        # Then buy, scaling changes to the value left after fees
+        new_portval = self.portval(prices)
+        bought = np.where(buy, mul_div(change, new_portval, portval), 0)
+        fiat = self.units[-1] - np.cumsum(bought)
+        buy_portval = new_portval + np.minimum(fiat, 0)
+        buy_fee = mul_div(bought, rates, WEIGHT_SCALE, round_up=True)
+        target = np.maximum(mul_div(buy_portval, weights[:-1], WEIGHT_SCALE) - buy_fee, 0)
+        self.units[:-1] = np.where(buy, mul_div(target, self.scale[:-1], prices), self.units[:-1])
+        self.units[-1] = max(fiat[-1], 0)
+
+        return sell_fee + np.where(buy, buy_fee, 0)
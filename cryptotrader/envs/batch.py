@@ -0,0 +1,160 @@
+"""
+Vectorized multi portfolio backtest
+"""
+import numpy as np
+
+from ..utils import Logger
+from .accounting import rebalance
+from .trading import BacktestEnvironment
+
+
+class BatchBacktestEnvironment(object):
+    """
+    Backtest many portfolios at once over one BacktestEnvironment price history.
+
+    Portfolios are held as a (n_portfolios, n_symbols) float holdings matrix, fiat last, and all of them
+    step together over the data feed columnar arrays. Trades follow TradingEnvironment.simulate_trade
+    through the rebalance kernel and rewards follow TradingEnvironment.get_reward, so scoring K parameter
+    sets of an array agent costs one vectorized replay instead of K serial backtests.
+
+    Observations are tuples (ohlc, portfolio): the (obs_steps, pair, field) ohlc window ending at the
+    current bar, shared by all portfolios, and the (2, n_portfolios, n_symbols) portfolio vectors on the
+    last two window bars, so portfolio[-2] and portfolio[-1] match APrioriAgent.get_portfolio_vector indexes.
+    As BacktestEnvironment.step observations, ohlc windows returned by step carry float32 precision.
+    """
+    def __init__(self, env):
+        """
+        :param env: BacktestEnvironment: Environment providing data feed, pairs, fees, balance and benchmark
+        """
+        assert isinstance(env, BacktestEnvironment), "env must be a BacktestEnvironment instance."
+        self.env = env
+        self.obs_steps = env.obs_steps
+        self.index = None
+        self.data_length = None
+        self.n_portfolios = 0
+        self.reset_status()
+
+    @property
+    def symbols(self):
+        return self.env.symbols
+
+    def reset_status(self):
+        self.status = {'OOD': False}
+
+    def get_portval(self, row):
+        """
+        Portfolios value at bar open price
+        :param row: int: Data feed row
+        :return: numpy array: (n_portfolios,) portfolio values
+        """
+        return self.holdings[:, :-1].dot(self.open[row]) + self.holdings[:, -1]
+
+    def get_portfolio_vector(self, row):
+        """
+        Portfolios vectors at bar open price
+        :param row: int: Data feed row
+        :return: numpy array: (n_portfolios, n_symbols) portfolio vectors
+        """
+        values = np.append(self.holdings[:, :-1] * self.open[row], self.holdings[:, -1:], axis=1)
+        return values / values.sum(axis=1, keepdims=True)
+
+    def get_observation(self, single=False):
+        ohlc = (self.ohlc_single if single else self.ohlc)[self.index - self.obs_steps + 1:self.index + 1]
+        portfolio = np.stack([self.get_portfolio_vector(self.index - 1), self.get_portfolio_vector(self.index)])
+        return ohlc, portfolio
+
+    def portval_std(self):
+        """
+        Standard deviation of each portfolio value history, as TradingEnvironment.portfolio_df.portval.std()
+        :return: numpy array: (n_portfolios,) standard deviations
+        """
+        if self._count < 2:
+            return np.full(self.n_portfolios, np.nan)
+        return np.sqrt(self._m2 / (self._count - 1))
+
+    def log_portval(self, portval):
+        # Welford update, so the running std costs constant time per step
+        self._count += 1
+        delta = portval - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (portval - self._mean)
+        self.portval = portval
+
+    def reset(self, n_portfolios):
+        """
+        Setup n_portfolios with the environment initial balance
+        :param n_portfolios: int: Number of portfolios
+        :return: tuple: Initial observation
+        """
+        try:
+            assert n_portfolios > 0, "n_portfolios must be positive."
+            tapi = self.env.tapi
+            self.n_portfolios = n_portfolios
+            self.data_length = tapi.data_length
+
+            # Same start as BacktestEnvironment.reset
+            if self.env.training:
+                self.index = np.random.random_integers(self.obs_steps, self.data_length - 3)
+            else:
+                self.index = self.obs_steps
+            self.index += 1
+
+            # Price tensor in environment pairs order
+            pair_index = [tapi.pairs.index(pair) for pair in self.env.pairs]
+            self.ohlc = tapi.ohlc_array[:, pair_index]
+            self.open = np.ascontiguousarray(self.ohlc[:, :, 0])
+            self.ohlc_single = self.ohlc.astype(np.float32).astype(np.float64)
+            self.relatives = np.append(tapi.price_relatives[:, pair_index], np.ones((self.data_length, 1)), axis=1)
+            self.fees = np.array([float(self.env.get_fee(symbol)) for symbol in self.env._crypto])
+            self.benchmark = np.asarray(self.env.benchmark, dtype=np.float64)
+
+            balance = self.env.get_balance()
+            self.holdings = np.tile(np.array([float(balance[symbol]) for symbol in self.symbols]),
+                                    (n_portfolios, 1))
+
+            self._count = 0
+            self._mean = np.zeros(n_portfolios)
+            self._m2 = np.zeros(n_portfolios)
+            self.log_portval(self.get_portval(self.index))
+
+            self.reset_status()
+            return self.get_observation()
+
+        except Exception as e:
+            Logger.error(BatchBacktestEnvironment.reset, self.env.parse_error(e))
+            raise e
+
+    def step(self, action):
+        """
+        Rebalance all portfolios at current bar open
+        :param action: numpy array: (n_portfolios, n_symbols) desired portfolio vectors
+        :return: tuple: observation, (n_portfolios,) rewards, done flag and status
+        """
+        try:
+            action = np.asarray(action, dtype=np.float64)
+            assert action.shape == self.holdings.shape, "Action shape mismatch. Shape: %s" % str(action.shape)
+            assert (action.sum(axis=1) > 0).all(), "Invalid action vector."
+            action = action / action.sum(axis=1, keepdims=True)
+
+            prev_portval = self.portval
+            self.holdings, _ = rebalance(self.holdings, self.open[self.index], action, self.fees)
+            self.log_portval(self.get_portval(self.index))
+
+            if self.index >= self.data_length - 2:
+                done = True
+                self.status["OOD"] += 1
+            else:
+                done = False
+
+            # Regret, as in TradingEnvironment.get_reward
+            pr = self.relatives[self.index]
+            pr_max = pr.max()
+            reward = np.log(self.portval / prev_portval / pr_max) - np.log(self.benchmark.dot(pr) / pr_max)
+
+            self.index += 1
+
+            return self.get_observation(True), reward, done, self.status
+
+        except Exception as e:
+            Logger.error(BatchBacktestEnvironment.step, self.env.parse_error(e))
+            raise e
@@ -0,0 +1,103 @@
+"""
+Best constant rebalanced portfolio solver
+"""
+import numpy as np
+
+
+def crp_log_wealth(hindsight, portfolios):
+    """
+    Log wealth of constant rebalanced portfolios, many candidates in one matrix product
+    :param hindsight: numpy array: (T, n) price relatives, fiat last
+    :param portfolios: numpy array: (..., n) portfolio vectors
+    :return: numpy array: (...) summed log returns
+    """
+    hindsight = np.asarray(hindsight, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        return np.log(np.asarray(portfolios, dtype=np.float64).dot(hindsight.T)).sum(axis=-1)
+
+
+def bcrp(hindsight, max_iter=100, tol=1e-10, gap=1e-11):
+    """
+    Best constant rebalanced portfolio: maximizes log wealth over the simplex.
+
+    The objective is concave, so an active set projected Newton method converges in a few
+    iterations. Each iteration solves the Newton system restricted to the free assets under
+    the budget constraint, then steps back to the simplex boundary when an asset would go short.
+    Optimality follows the KKT conditions: gradients equal T on held assets and at most T elsewhere.
+    As the gradient dot b is T for any portfolio, max(gradient) - T bounds the log wealth left to
+    gain. Iterations go on until that bound is within gap, or until log wealth stops increasing at
+    float precision.
+    :param hindsight: numpy array: (T, n) price relatives, fiat last
+    :param max_iter: int: Newton iterations limit
+    :param tol: float: KKT violation tolerance on held assets, relative to T
+    :param gap: float: Optimal log wealth accuracy
+    :return: numpy array: (n,) portfolio vector
+    """
+    hindsight = np.asarray(hindsight, dtype=np.float64)
+    T, n = hindsight.shape
+    b = np.full(n, 1. / n)
+    f = crp_log_wealth(hindsight, b)
+
+    for _ in range(max_iter):
+        r = hindsight.dot(b)
+        grad = hindsight.T.dot(1. / r)
+
+        # Stop on KKT conditions and duality gap
+        held = b > 0
+        if np.abs(grad[held] - T).max() <= T * tol and grad.max() - T <= gap:
+            break
+
+        # Held assets and those worth buying are free
+        free = held | (grad > T + gap)
+        while True:
+            step = newton_step(hindsight[:, free] / r[:, None], grad[free], n, free)
+
+            # Empty assets can not be sold, fix them at zero
+            blocked = free & ~held & (step < 0)
+            if not blocked.any():
+                break
+            free &= ~blocked
+
+        # Longest feasible step, clipped at 1
+        shrink = np.flatnonzero(step < 0)
+        limits = b[shrink] / -step[shrink]
+        t = min(1., limits.min()) if shrink.size else 1.
+
+        # Backtrack until log wealth increases. None does at float precision past the optimum
+        while t > 1e-12:
+            new_b = np.maximum(b + t * step, 0.)
+            # Assets reaching the boundary are sold out exactly, round off would keep them held
+            new_b[shrink[limits <= t]] = 0.
+            new_b /= new_b.sum()
+            new_f = crp_log_wealth(hindsight, new_b)
+            if new_f > f:
+                break
+            t /= 2
+        else:
+            break
+
+        b, f = new_b, new_f
+
+    return b
+
+
+def newton_step(x, grad, n, free):
+    """
+    Newton ascent step on free assets under the budget constraint
+    :param x: numpy array: (T, n_free) price relatives over portfolio returns
+    :param grad: numpy array: (n_free,) log wealth gradient
+    :param n: int: Number of assets
+    :param free: numpy array: (n,) free assets mask
+    :return: numpy array: (n,) step, zero on fixed assets
+    """
+    # Negative hessian, regularized for collinear assets
+    hess = x.T.dot(x)
+    hess += np.eye(hess.shape[0]) * 1e-12 * np.trace(hess)
+
+    kkt = np.ones((hess.shape[0] + 1, hess.shape[0] + 1))
+    kkt[:-1, :-1] = hess
+    kkt[-1, -1] = 0.
+
+    step = np.zeros(n)
+    step[free] = np.linalg.lstsq(kkt, np.append(grad, 0.), rcond=None)[0][:-1]
+    return step
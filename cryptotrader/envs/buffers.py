@@ -0,0 +1,348 @@
+"""
+Preallocated array buffers for trading environments
+"""
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+
+from ..datafeed import OHLC_FIELDS
+
+
+class RollingWindow(object):
+    """
+    Fixed length observation window backed by a mirrored ring buffer.
+
+    Each row is written twice, at position i and i + length, so the ordered window
+    is always a contiguous view over the buffer. Column layout matches
+    TradingEnvironment.get_history(portfolio_vector=True): for each pair, its OHLC fields
+    followed by the pair symbol amount, then the fiat amount.
+    """
+    def __init__(self, pairs, fiat, length, period):
+        """
+        :param pairs: list: Pairs names
+        :param fiat: str: Fiat symbol
+        :param length: int: Window length
+        :param period: int: Bar period in minutes
+        """
+        self.pairs = pairs
+        self.fiat = fiat
+        self.length = length
+        self.period = period
+        self.n_fields = len(OHLC_FIELDS) + 1
+
+        self.columns = pd.MultiIndex.from_tuples([(pair, field) for pair in pairs
+                                                  for field in OHLC_FIELDS + [pair.split('_')[1]]] +
+                                                 [(fiat, fiat)])
+
+        # Portfolio columns in symbols order, pairs first and fiat last
+        self.portfolio_cols = np.append(np.arange(len(pairs)) * self.n_fields + len(OHLC_FIELDS),
+                                        [len(pairs) * self.n_fields])
+
+        self._data = np.full((2 * length, self.columns.shape[0]), np.nan, dtype=np.float64)
+        self._dates = np.zeros(2 * length, dtype=np.int64)
+        self.clear()
+
+    def clear(self):
+        self._head = 0
+        self.size = 0
+
+    @property
+    def values(self):
+        """ Ordered window values, oldest row first """
+        return self._data[self._head:self._head + self.length]
+
+    @property
+    def dates(self):
+        """ Ordered window epoch dates, in seconds """
+        return self._dates[self._head:self._head + self.length]
+
+    @property
+    def last_date(self):
+        return self._dates[self._head + self.length - 1]
+
+    def fill(self, obs):
+        """
+        Fill the window from an observation DataFrame
+        :param obs: pandas DataFrame: get_history like observation with at least length rows
+        :return: None
+        """
+        obs = obs.iloc[-self.length:]
+        assert obs.shape[0] == self.length, "Observation is to small. Shape: %s" % str(obs.shape)
+        self._data[:self.length] = self._data[self.length:] = obs.values.astype(np.float64)
+        self._dates[:self.length] = self._dates[self.length:] = obs.index.asi8 // 10 ** 9
+        self._head = 0
+        self.size = self.length
+
+    def push(self, date, ohlc):
+        """
+        Push one bar into the window. If date is the last window date, the bar is refreshed in place;
+        otherwise it is appended, carrying the last portfolio amounts forward.
+        :param date: int: Bar epoch date
+        :param ohlc: numpy array: (pair, field) bar values
+        :return: None
+        """
+        if date != self.last_date:
+            pos = self._head
+            last = self._head + self.length - 1
+            self._data[pos] = self._data[pos + self.length] = self._data[last]
+            self._dates[pos] = self._dates[pos + self.length] = date
+            self._head = (self._head + 1) % self.length
+
+        pos = self._head + self.length - 1
+        row = self._data[pos, :-1].reshape(len(self.pairs), self.n_fields)
+        row[:, :-1] = ohlc
+        self._data[(pos + self.length) % (2 * self.length)] = self._data[pos]
+
+    def set_portfolio(self, date, col, value):
+        """
+        Write a portfolio amount on the bar containing date and carry it forward
+        :param date: int: Epoch date
+        :param col: int: Symbol index, pairs symbols first and fiat last
+        :param value: float: Amount
+        :return: None
+        """
+        row = max(np.searchsorted(self.dates, date, side='right') - 1, 0)
+        pos = np.arange(self._head + row, self._head + self.length)
+        self._data[pos, self.portfolio_cols[col]] = value
+        self._data[(pos + self.length) % (2 * self.length), self.portfolio_cols[col]] = value
+
+    def to_frame(self):
+        """
+        Return window as a DataFrame over the buffer view
+        :return: pandas DataFrame:
+        """
+        index = pd.DatetimeIndex(self.dates * 10 ** 9, freq="%dT" % self.period).tz_localize(timezone.utc)
+        return pd.DataFrame(self.values, index=index, columns=self.columns, copy=False)
+
+
+class Ledger(object):
+    """
+    Time indexed log table backed by preallocated arrays.
+
+    Writes follow DataFrame.at semantics: an unknown timestamp appends a row, an unknown column
+    adds a column and unset cells hold NaN. Capacity doubles when full, so appending costs
+    amortized constant time regardless of the ledger length. The last valid value of each column
+    is tracked on write, so current state reads never scan the table.
+    """
+    def __init__(self, length=1024, dtype=object):
+        """
+        :param length: int: Preallocated rows
+        :param dtype: numpy dtype: Cells dtype
+        """
+        self.dtype = dtype
+        self._data = np.full((max(length, 1), 8), np.nan, dtype=dtype)
+        self._dates = np.zeros(max(length, 1), dtype=np.int64)
+        self.clear()
+
+    @classmethod
+    def from_frame(cls, df, length=1024, dtype=object):
+        """
+        Build a ledger from a time indexed DataFrame
+        :param df: pandas DataFrame: Initial rows
+        :param length: int: Preallocated rows
+        :param dtype: numpy dtype: Cells dtype
+        :return: Ledger
+        """
+        ledger = cls(max(length, df.shape[0]), dtype)
+        for timestamp, row in zip(df.index, df.itertuples(index=False)):
+            for column, value in zip(df.columns, row):
+                ledger.set(timestamp, column, value)
+        return ledger
+
+    def clear(self):
+        self.columns = []
+        self.tz = None
+        self.size = 0
+        self._cols = {}
+        self._rows = {}
+        self._last = {}
+        self._last_row = {}
+        self._frame = None
+
+    def __len__(self):
+        return self.size
+
+    def _add_row(self, timestamp):
+        if self.size == self._data.shape[0]:
+            self._data = np.concatenate([self._data, np.full_like(self._data, np.nan)])
+            self._dates = np.concatenate([self._dates, np.zeros_like(self._dates)])
+
+        if not self.size:
+            self.tz = timestamp.tz
+
+        row = self.size
+        self._data[row] = np.nan
+        self._dates[row] = timestamp.value
+        self._rows[timestamp.value] = row
+        self.size += 1
+        return row
+
+    def _add_column(self, column):
+        col = len(self.columns)
+        if col == self._data.shape[1]:
+            self._data = np.concatenate([self._data, np.full_like(self._data, np.nan)], axis=1)
+
+        self._data[:self.size, col] = np.nan
+        self.columns.append(column)
+        self._cols[column] = col
+        return col
+
+    def set(self, timestamp, column, value):
+        """
+        Write a cell
+        :param timestamp: datetime.datetime: Row time
+        :param column: str: Column name
+        :param value: Cell value
+        :return: None
+        """
+        timestamp = pd.Timestamp(timestamp)
+        row = self._rows.get(timestamp.value)
+        if row is None:
+            row = self._add_row(timestamp)
+
+        col = self._cols.get(column)
+        if col is None:
+            col = self._add_column(column)
+
+        self._data[row, col] = value
+        self._frame = None
+
+        if row >= self._last_row.get(column, -1) and value == value:
+            self._last[column] = value
+            self._last_row[column] = row
+
+    def get(self, timestamp, column):
+        return self._data[self._rows[pd.Timestamp(timestamp).value], self._cols[column]]
+
+    def last_valid(self, column):
+        """
+        Return the column value on the last row where it is not NaN
+        :param column: str: Column name
+        :return: Cell value
+        """
+        return self._last[column]
+
+    def iget(self, i, column):
+        """
+        Read a cell by row position
+        :param i: int: Row position, negative from the end
+        :param column: str: Column name
+        :return: Cell value
+        """
+        if not -self.size <= i < self.size:
+            raise IndexError("Ledger row out of range: %d" % i)
+        return self._data[i % self.size, self._cols[column]]
+
+    def timestamp(self, i):
+        """
+        :param i: int: Row position, negative from the end
+        :return: pandas Timestamp: Row time
+        """
+        if not -self.size <= i < self.size:
+            raise IndexError("Ledger row out of range: %d" % i)
+        return pd.Timestamp(self._dates[i % self.size], tz='UTC').tz_convert(self.tz) if self.tz else \
+            pd.Timestamp(self._dates[i % self.size])
+
+    @property
+    def index(self):
+        index = pd.DatetimeIndex(self._dates[:self.size])
+        if self.tz:
+            index = index.tz_localize(timezone.utc).tz_convert(self.tz)
+        return index
+
+    def sample(self, period, start=None, end=None):
+        """
+        Last valid value of each column per period, as DataFrame.resample(period).last() over the rows
+        between start and end, computed on the int64 dates array.
+        Bins are anchored on the first row day start and periods without rows hold NaN.
+        :param period: int: Sampling period in minutes
+        :param start: datetime.datetime: First row time, included. None starts at the first row
+        :param end: datetime.datetime: Last row time, included. None ends at the last row
+        :return: pandas DataFrame:
+        """
+        dates = self._dates[:self.size]
+        if (np.diff(dates) < 0).any():
+            return self.to_frame().loc[start:end].resample("%dmin" % period).last()
+
+        lo = 0 if start is None else np.searchsorted(dates, pd.Timestamp(start).value, 'left')
+        hi = self.size if end is None else np.searchsorted(dates, pd.Timestamp(end).value, 'right')
+        if hi <= lo:
+            return pd.DataFrame(index=self.make_index(np.empty(0, dtype=np.int64), period), columns=self.columns)
+
+        day, step = 86400 * 10 ** 9, period * 60 * 10 ** 9
+        origin = dates[lo] - dates[lo] % day
+        bins = (dates[lo:hi] - origin) // step
+        data = self._data[lo:hi, :len(self.columns)]
+
+        out = np.full((bins[-1] - bins[0] + 1, len(self.columns)), np.nan, dtype=self.dtype)
+        for col in range(len(self.columns)):
+            rows = np.flatnonzero(data[:, col] == data[:, col])
+            if rows.shape[0]:
+                # Rows are in time order, so the last valid row of each bin ends its run
+                last = rows[np.append(bins[rows][1:] != bins[rows][:-1], True)]
+                out[bins[last] - bins[0], col] = data[last, col]
+
+        index = self.make_index(origin + (bins[0] + np.arange(out.shape[0])) * step, period)
+        return pd.DataFrame(out, index=index, columns=list(self.columns))
+
+    def sample_filled(self, period, dates, columns):
+        """
+        Sampled columns on period bins starting at dates, forward then backward filled, as
+        sample(period, dates[0], dates[-1]).reindex(index)[columns].ffill().bfill() without building frames.
+        :param period: int: Sampling period in minutes
+        :param dates: numpy array: (n,) int64 epoch nanoseconds, consecutive bin starts
+        :param columns: list: Column names
+        :return: numpy array: (n, len(columns)) values. None when rows are out of order or no row falls within
+        dates, as sample has nothing to offer there
+        """
+        size = self.size
+        ledger_dates = self._dates[:size]
+        if (np.diff(ledger_dates) < 0).any() or any(column not in self._cols for column in columns):
+            return None
+
+        lo = np.searchsorted(ledger_dates, dates[0], 'left')
+        hi = np.searchsorted(ledger_dates, dates[-1], 'right')
+        day, step = 86400 * 10 ** 9, period * 60 * 10 ** 9
+        # Bins are anchored on the first row day start, dates must fall on them
+        if hi <= lo or ((dates - (ledger_dates[lo] - ledger_dates[lo] % day)) % step).any():
+            return None
+
+        pos = np.searchsorted(dates, ledger_dates[lo:hi], 'right') - 1
+        data = self._data[lo:hi, [self._cols[column] for column in columns]]
+
+        out = np.full((dates.shape[0], len(columns)), np.nan, dtype=self.dtype)
+        filled = np.full((dates.shape[0], len(columns)), -1, dtype=np.int64)
+        for col in range(len(columns)):
+            rows = np.flatnonzero((data[:, col] == data[:, col]) & (ledger_dates[lo:hi] < dates[pos] + step))
+            if rows.shape[0]:
+                last = rows[np.append(pos[rows][1:] != pos[rows][:-1], True)]
+                out[pos[last], col] = data[last, col]
+                filled[pos[last], col] = pos[last]
+
+        # Forward then backward fill
+        filled = np.maximum.accumulate(filled, axis=0)
+        first = filled.max(axis=0) >= 0
+        filled = np.where(filled >= 0, filled, np.argmax(filled >= 0, axis=0))
+        out = out[filled, np.arange(len(columns))]
+        out[:, ~first] = np.nan
+        return out
+
+    def make_index(self, dates, period):
+        index = pd.DatetimeIndex(dates, freq="%dT" % period)
+        if self.tz:
+            index = index.tz_localize(timezone.utc).tz_convert(self.tz)
+        return index
+
+    def to_frame(self):
+        """
+        Return ledger as a DataFrame over the buffer view. The frame is cached until next write.
+        :return: pandas DataFrame:
+        """
+        if self._frame is None:
+            if self.size and self.columns:
+                self._frame = pd.DataFrame(self._data[:self.size, :len(self.columns)], index=self.index,
+                                           columns=self.columns, copy=False)
+            else:
+                self._frame = pd.DataFrame(index=self.index if self.size else None, columns=self.columns)
+        return self._frame
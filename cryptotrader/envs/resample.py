@@ -0,0 +1,310 @@
+"""
+Vectorized OHLCV resampling
+"""
+from itertools import islice
+import numpy as np
+import pandas as pd
+
+
+def resample_ohlc(dates, ohlc, period):
+    """
+    Aggregate bars into coarser period bars with segmented reductions.
+
+    Bins are aligned on epoch multiples of the period and dated by their start, as exchange candles.
+    High, low and volume reductions skip NaN values; open and close come from the first and last bar of each bin.
+    :param dates: numpy array: (T,) sorted int64 epoch dates, in seconds
+    :param ohlc: numpy array: (T, ..., field) bars with fields in OHLC_FIELDS order
+    :param period: int: Target period in minutes
+    :return: tuple: (n_bins,) bin dates, (n_bins, ..., field) bars
+    """
+    dates = np.asarray(dates, dtype=np.int64)
+    ohlc = np.asarray(ohlc, dtype=np.float64)
+    if not dates.shape[0]:
+        return dates.copy(), np.empty((0,) + ohlc.shape[1:])
+
+    bins = dates // (period * 60)
+    starts = np.append([0], np.flatnonzero(np.diff(bins)) + 1)
+    ends = np.append(starts[1:], [dates.shape[0]]) - 1
+
+    out = np.empty((starts.shape[0],) + ohlc.shape[1:])
+    out[..., 0] = ohlc[starts, ..., 0]
+    out[..., 1] = np.fmax.reduceat(ohlc[..., 1], starts, axis=0)
+    out[..., 2] = np.fmin.reduceat(ohlc[..., 2], starts, axis=0)
+    out[..., 3] = ohlc[ends, ..., 3]
+    out[..., 4] = np.add.reduceat(np.nan_to_num(ohlc[..., 4]), starts, axis=0)
+
+    return bins[starts] * period * 60, out
+
+
+def resample_multi(dates, ohlc, base_period, periods):
+    """
+    Build several coarser timeframes from one base series.
+    Each timeframe is reduced from the coarsest one already built that divides it, so 30 minutes bars
+    become 120 minutes bars and those become 240 minutes bars, and the base series is read only once.
+    :param dates: numpy array: (T,) sorted int64 epoch dates, in seconds
+    :param ohlc: numpy array: (T, ..., field) base bars with fields in OHLC_FIELDS order
+    :param base_period: int: Base period in minutes
+    :param periods: list: Target periods in minutes, multiples of base_period
+    :return: dict: period: (bin dates, bars) tuples
+    """
+    assert all(period % base_period == 0 for period in periods), "Periods must be multiples of the base period."
+
+    built = {base_period: (np.asarray(dates, dtype=np.int64), np.asarray(ohlc, dtype=np.float64))}
+    for period in sorted(set(periods)):
+        if period not in built:
+            source = max(built_period for built_period in built if period % built_period == 0)
+            built[period] = resample_ohlc(*built[source], period)
+
+    return {period: built[period] for period in periods}
+
+
+class OHLCResampler(object):
+    """
+    Incremental multi timeframe resampler.
+
+    Coarser bars are kept on preallocated arrays that double when full. Appending base bars resamples only
+    the new bars, merges their first bin into the last, possibly partial, stored bin and appends the others,
+    so keeping all timeframes up to date costs time proportional to the new data.
+    """
+    def __init__(self, base_period, periods, length=1024):
+        """
+        :param base_period: int: Base period in minutes
+        :param periods: list: Target periods in minutes, multiples of base_period
+        :param length: int: Preallocated bars per timeframe
+        """
+        assert all(period % base_period == 0 for period in periods), "Periods must be multiples of the base period."
+        self.base_period = base_period
+        self.periods = list(periods)
+        self.length = length
+        self.clear()
+
+    def clear(self):
+        self.last_date = None
+        self.size = {period: 0 for period in self.periods}
+        self._dates = {period: None for period in self.periods}
+        self._data = {period: None for period in self.periods}
+
+    def get(self, period):
+        """
+        Bars of one timeframe. The last bar is partial until its bin is complete.
+        :param period: int: Timeframe in minutes
+        :return: tuple: (n_bars,) dates view, (n_bars, ..., field) bars view
+        """
+        if self._dates[period] is None:
+            return np.empty(0, dtype=np.int64), np.empty((0,))
+        return self._dates[period][:self.size[period]], self._data[period][:self.size[period]]
+
+    def update(self, dates, ohlc):
+        """
+        Append new base bars
+        :param dates: numpy array: (T,) sorted int64 epoch dates, after the last appended bar
+        :param ohlc: numpy array: (T, ..., field) base bars with fields in OHLC_FIELDS order
+        :return: None
+        """
+        dates = np.asarray(dates, dtype=np.int64)
+        if not dates.shape[0]:
+            return
+        assert self.last_date is None or dates[0] > self.last_date, "Base bars must be appended in time order."
+
+        for period, (bin_dates, bars) in resample_multi(dates, ohlc, self.base_period, self.periods).items():
+            size = self.size[period]
+
+            # First bin continues the last stored bar
+            if size and bin_dates[0] == self._dates[period][size - 1]:
+                last = self._data[period][size - 1]
+                last[..., 1] = np.fmax(last[..., 1], bars[0, ..., 1])
+                last[..., 2] = np.fmin(last[..., 2], bars[0, ..., 2])
+                last[..., 3] = bars[0, ..., 3]
+                last[..., 4] += bars[0, ..., 4]
+                bin_dates, bars = bin_dates[1:], bars[1:]
+
+            self._append(period, bin_dates, bars)
+
+        self.last_date = dates[-1]
+
+    def _append(self, period, dates, bars):
+        size = self.size[period]
+        if self._data[period] is None:
+            self._dates[period] = np.zeros(max(self.length, dates.shape[0]), dtype=np.int64)
+            self._data[period] = np.full((self._dates[period].shape[0],) + bars.shape[1:], np.nan)
+
+        capacity = self._dates[period].shape[0]
+        if size + dates.shape[0] > capacity:
+            capacity = max(2 * capacity, size + dates.shape[0])
+            self._dates[period] = np.resize(self._dates[period], capacity)
+            self._data[period] = np.resize(self._data[period], (capacity,) + bars.shape[1:])
+
+        self._dates[period][size:size + dates.shape[0]] = dates
+        self._data[period][size:size + dates.shape[0]] = bars
+        self.size[period] = size + dates.shape[0]
+
+
+def fill_gaps(dates, bars, period, start=None, close=np.nan):
+    """
+    Insert flat bars on periods without data. Filled bars repeat the previous close with zero volume.
+    :param dates: numpy array: (T,) sorted int64 bin dates, in seconds
+    :param bars: numpy array: (T, field) bars with fields in OHLC_FIELDS order
+    :param period: int: Bars period in minutes
+    :param start: int: First date of the filled series, defaults to dates[0]
+    :param close: float: Close price before start
+    :return: tuple: (n_bins,) contiguous bin dates, (n_bins, field) bars
+    """
+    step = period * 60
+    start = dates[0] if start is None else start
+    grid = np.arange(start, dates[-1] + step, step, dtype=np.int64)
+    if grid.shape[0] == dates.shape[0]:
+        return dates, bars
+
+    pos = np.searchsorted(grid, dates)
+    held = np.zeros(grid.shape[0], dtype=bool)
+    held[pos] = True
+
+    # Last held bin at or before each bin, shifted by one so -1 picks the previous close
+    closes = np.full(grid.shape[0] + 1, close)
+    closes[pos + 1] = bars[:, 3]
+    last = np.maximum.accumulate(np.where(held, np.arange(grid.shape[0]), -1))
+
+    out = np.empty((grid.shape[0],) + bars.shape[1:])
+    out[pos] = bars
+    out[~held, :4] = closes[last[~held] + 1][:, None]
+    out[~held, 4] = 0.
+    return grid, out
+
+
+def fill_bars(dates, ohlc, period, start=None, end=None):
+    """
+    Put bars on a regular time grid and fill the missing ones.
+
+    Bars missing from the grid or without a close price are synthetic: their prices repeat the previous
+    close, or the first known close before any, and their volume is zero. Other missing fields on real
+    bars take the bar close and zero volume.
+    :param dates: numpy array: (T,) sorted int64 epoch dates, in seconds
+    :param ohlc: numpy array: (T, ..., field) bars with fields in OHLC_FIELDS order
+    :param period: int: Bars period in minutes
+    :param start: int: First grid date, defaults to dates[0]
+    :param end: int: Last grid date, defaults to dates[-1]
+    :return: tuple: (n,) grid dates, (n, ..., field) filled bars, (n, ...) synthetic bars mask
+    """
+    dates = np.asarray(dates, dtype=np.int64)
+    ohlc = np.asarray(ohlc, dtype=np.float64)
+    step = period * 60
+    start = dates[0] if start is None else start
+    end = dates[-1] if end is None else end
+    grid = np.arange(start, end + step, step, dtype=np.int64)
+
+    if grid.shape[0] == dates.shape[0] and (grid == dates).all():
+        out = ohlc.copy()
+    else:
+        out = np.full((grid.shape[0],) + ohlc.shape[1:], np.nan)
+        # Dates off the grid are dropped, as on a reindex
+        keep = (dates >= start) & (dates <= end) & ((dates - start) % step == 0)
+        out[(dates[keep] - start) // step] = ohlc[keep]
+
+    synthetic = np.isnan(out[..., 3])
+    if not np.isnan(out).any():
+        return grid, out, synthetic
+
+    # Previous known close, or the first one before any
+    known = np.where(synthetic, -1, np.arange(grid.shape[0]).reshape((-1,) + (1,) * (synthetic.ndim - 1)))
+    last = np.maximum.accumulate(known, axis=0)
+    first = np.argmax(~synthetic, axis=0)
+    last = np.where(last < 0, first, last)
+    closes = out[..., 3].reshape(grid.shape[0], -1)
+    closes = closes[last.reshape(grid.shape[0], -1), np.arange(closes.shape[1])].reshape(last.shape)
+
+    for i in range(3):
+        out[..., i] = np.where(np.isnan(out[..., i]), closes, out[..., i])
+    out[..., 3] = closes
+    out[..., 4] = np.where(synthetic | np.isnan(out[..., 4]), 0., out[..., 4])
+    return grid, out, synthetic
+
+
+def trade_dates(dates):
+    """
+    Epoch seconds from trade dates
+    :param dates: list: Date strings, datetimes or epoch numbers. Naive dates are taken as UTC
+    :return: numpy array: int64 epoch dates
+    """
+    if isinstance(dates[0], (int, float, np.number)):
+        return np.asarray(dates, dtype=np.int64)
+    return pd.to_datetime(dates).values.astype(np.int64) // 10 ** 9
+
+
+def stream_resample(batches, period):
+    """
+    Resample a stream of bar batches.
+
+    Each batch is reduced on its own and the last, possibly open, bin carries to the next batch,
+    so memory use is bounded by the batch size whatever the stream length.
+    Periods without data give flat bars on the previous close with zero volume.
+    :param batches: iterable: (n,) sorted int64 epoch dates, (n, field) bars in OHLC_FIELDS order
+    :param period: int: Target period in minutes
+    :return: generator: (n_bins,) int64 epoch dates, (n_bins, field) bars, finalized bins only
+    """
+    step = period * 60
+    last_date = None
+    # Open bin and last emitted bin
+    pending, pending_date = None, None
+    emitted_date, emitted_close = None, np.nan
+
+    for dates, ohlc in batches:
+        if not len(dates):
+            continue
+        assert (np.diff(dates) >= 0).all() and (last_date is None or dates[0] >= last_date), \
+            "Batches must be in time order."
+        last_date = dates[-1]
+
+        bin_dates, bars = resample_ohlc(dates, ohlc, period)
+
+        # First bin continues the open one
+        if pending is not None and bin_dates[0] == pending_date:
+            pending[1] = np.fmax(pending[1], bars[0, 1])
+            pending[2] = np.fmin(pending[2], bars[0, 2])
+            pending[3] = bars[0, 3]
+            pending[4] += bars[0, 4]
+            bin_dates, bars = bin_dates[1:], bars[1:]
+
+        if not bin_dates.shape[0]:
+            continue
+
+        # Every bin but the last one is final
+        if pending is not None:
+            bin_dates = np.append([pending_date], bin_dates)
+            bars = np.concatenate([pending[None], bars])
+        pending_date, pending = bin_dates[-1], bars[-1].copy()
+
+        if bin_dates.shape[0] > 1:
+            start = None if emitted_date is None else emitted_date + step
+            out_dates, out = fill_gaps(bin_dates[:-1], bars[:-1], period, start, emitted_close)
+            emitted_date, emitted_close = out_dates[-1], out[-1, 3]
+            yield out_dates, out
+
+    if pending is not None:
+        start = None if emitted_date is None else emitted_date + step
+        yield fill_gaps(np.array([pending_date]), pending[None], period, start, emitted_close)
+
+
+def trade_batches(trades, batch_size):
+    trades = iter(trades)
+    while True:
+        batch = list(islice(trades, batch_size))
+        if not batch:
+            break
+        dates = trade_dates([trade['date'] for trade in batch])
+        rates = np.array([float(trade['rate']) for trade in batch])
+        amounts = np.array([float(trade['amount']) for trade in batch])
+        yield dates, np.stack([rates, rates, rates, rates, amounts], axis=-1)
+
+
+def aggregate_trades(trades, period, batch_size=10000):
+    """
+    Stream trades into OHLCV bars.
+    Trades are consumed in batches of bounded size, so memory use does not depend on the number of trades.
+    :param trades: iterable: Trade mappings with date, rate and amount keys, in time order.
+    Any iterable works: a pymongo cursor, decoded JSON lines or a list.
+    :param period: int: Bars period in minutes
+    :param batch_size: int: Trades read per batch
+    :return: generator: (n_bars,) int64 epoch dates, (n_bars, field) bars in OHLC_FIELDS order, finalized bars only
+    """
+    assert batch_size > 0, "batch_size must be positive."
+    return stream_resample(trade_batches(trades, batch_size), period)
@@ -8,16 +8,19 @@ from ..spaces import *
 from .utils import *
 from ..utils import *
 from ..core import Env
+from .buffers import RollingWindow, Ledger
+from .accounting import FixedPointAccount, WEIGHT_PRECISION, rebalance
+from .bcrp import bcrp, crp_log_wealth
+from .resample import fill_bars
 
 import os
 import smtplib
 from socket import gaierror
 from datetime import datetime, timedelta, timezone
 from decimal import localcontext, ROUND_UP, Decimal
-from time import sleep
+from time import sleep, time
 import pandas as pd
 import empyrical as ec
-import optunity as ot
 from bokeh.layouts import column
 from bokeh.palettes import inferno
 from bokeh.plotting import figure, show
@@ -32,7 +35,13 @@ class TradingEnvironment(Env):
     Trading environment base class
     """
     ## Setup methods
-    def __init__(self, period, obs_steps, tapi, fiat="USDT", name="TradingEnvironment"):
+    def __init__(self, period, obs_steps, tapi, fiat="USDT", name="TradingEnvironment", rolling=False,
+                 precision=None):
+        """
+        :param rolling: bool: Keep a rolling observation window and append only new bars each step
+        :param precision: int or dict: Simulate trades on int64 fixed point balances with this many decimal
+        places per symbol. None keeps Decimal accounting.
+        """
         assert isinstance(name, str), "Name must be a string"
         self.name = name
 
@@ -48,11 +57,25 @@ class TradingEnvironment(Env):
         self._fiat = None
         self.tax = {}
 
+        # Concurrent pair requests on history retrieval. Feeds that are not thread safe run them in sequence
+        self.n_threads = 1
+
+        # Synthetic bars mask of the last ohlc read, per pair
+        self.synthetic = {}
+
         # Dataframes
         self.obs_df = pd.DataFrame()
         self.portfolio_df = pd.DataFrame()
         self.action_df = pd.DataFrame()
 
+        # Rolling observation
+        self.rolling = rolling
+        self.obs_window = None
+
+        # Fixed point accounting
+        self.precision = precision
+        self.account = None
+
         # Logging and debugging
         self.status = {'OOD': False,
                        'Error': False,
@@ -118,15 +141,7 @@ class TradingEnvironment(Env):
     @property
     def fiat(self):
         try:
-            i = -1
-            fiat = self.portfolio_df.get_value(self.portfolio_df.index[i], self._fiat)
-            while not convert_to.decimal(fiat.is_finite()):
-                i -= 1
-                fiat = self.portfolio_df.get_value(self.portfolio_df.index[-i], self._fiat)
-            return fiat
-        except IndexError:
-            Logger.error(TradingEnvironment.crypto, "No valid value on portfolio dataframe.")
-            raise KeyError
+            return self.portfolio_ledger.last_valid(self._fiat)
         except KeyError as e:
             Logger.error(TradingEnvironment.fiat, "You must specify a fiat symbol first.")
             raise e
@@ -148,14 +163,14 @@ class TradingEnvironment(Env):
                 self._crypto = symbols
 
             elif isinstance(value, Decimal) or isinstance(value, float) or isinstance(value, int):
-                self.portfolio_df.at[self.timestamp, self._fiat] = convert_to.decimal(value)
+                self.update_portfolio(self.timestamp, self._fiat, value)
 
             elif isinstance(value, dict):
                 try:
                     timestamp = value['timestamp']
                 except KeyError:
                     timestamp = self.timestamp
-                self.portfolio_df.at[timestamp, self._fiat] = convert_to.decimal(value[self._fiat])
+                self.update_portfolio(timestamp, self._fiat, value[self._fiat])
 
         except IndexError:
             raise AssertionError('You must enter pairs before set fiat.')
@@ -180,16 +195,8 @@ class TradingEnvironment(Env):
 
     def get_crypto(self, symbol):
         try:
-            i = -1
-            value = self.portfolio_df.get_value(self.portfolio_df.index[i], symbol)
-            while not convert_to.decimal(value).is_finite():
-                i -= 1
-                value = self.portfolio_df.get_value(self.portfolio_df.index[i], symbol)
-            return value
+            return self.portfolio_ledger.last_valid(symbol)
 
-        except IndexError:
-            Logger.error(TradingEnvironment.crypto, "No valid value on portfolio dataframe.")
-            raise KeyError
         except KeyError as e:
             Logger.error(TradingEnvironment.crypto, "No valid value on portfolio dataframe.")
             raise e
@@ -207,7 +214,7 @@ class TradingEnvironment(Env):
                 timestamp = self.timestamp
             for symbol, value in values.items():
                 if symbol not in [self._fiat, 'timestamp']:
-                    self.portfolio_df.at[timestamp, symbol] = convert_to.decimal(value)
+                    self.update_portfolio(timestamp, symbol, value)
 
         except TypeError:
             raise AssertionError("Crypto value must be a dictionary containing the currencies balance.")
@@ -233,12 +240,35 @@ class TradingEnvironment(Env):
                 timestamp = self.timestamp
             for symbol, value in values.items():
                 if symbol is not 'timestamp':
-                    self.portfolio_df.at[timestamp, symbol] = convert_to.decimal(value)
+                    self.update_portfolio(timestamp, symbol, value)
 
         except Exception as e:
             Logger.error(TradingEnvironment.balance, self.parse_error(e))
             raise e
 
+    @property
+    def portfolio_df(self):
+        return self.portfolio_ledger.to_frame()
+
+    @portfolio_df.setter
+    def portfolio_df(self, df):
+        self.portfolio_ledger = Ledger.from_frame(df, self.get_ledger_length())
+
+    @property
+    def action_df(self):
+        return self.action_ledger.to_frame()
+
+    @action_df.setter
+    def action_df(self, df):
+        self.action_ledger = Ledger.from_frame(df, self.get_ledger_length())
+
+    def get_ledger_length(self):
+        """
+        Return portfolio and action ledgers preallocated length
+        :return: int:
+        """
+        return 1024
+
     @property
     def portval(self):
         return self.calc_total_portval()
@@ -246,11 +276,11 @@ class TradingEnvironment(Env):
     @portval.setter
     def portval(self, value):
         try:
-            self.portfolio_df.at[value['timestamp'], 'portval'] = convert_to.decimal(value['portval'])
+            self.portfolio_ledger.set(value['timestamp'], 'portval', convert_to.decimal(value['portval']))
         except KeyError:
-            self.portfolio_df.at[self.timestamp, 'portval'] = convert_to.decimal(value['portval'])
+            self.portfolio_ledger.set(self.timestamp, 'portval', convert_to.decimal(value['portval']))
         except TypeError:
-            self.portfolio_df.at[self.timestamp, 'portval'] = convert_to.decimal(value)
+            self.portfolio_ledger.set(self.timestamp, 'portval', convert_to.decimal(value))
 
         except Exception as e:
             Logger.error(TradingEnvironment.portval, self.parse_error(e))
@@ -270,87 +300,57 @@ class TradingEnvironment(Env):
                                      dec_con.create_decimal(n_pairs)), [dec_zero])
 
     def optimize_benchmark(self, nb_steps, verbose=False):
-        # Init var
-        i = 0
-
-        ## Acquire hindsight
-        # Save env obs_steps
-        obs_steps = self.obs_steps
-
-        # Change it so you can recover all the data
-        self.obs_steps = self.tapi.data_length
-
-        # Pull the entire data set
-        hindsight = self.get_observation().xs('open', level=1,
-                                             axis=1).rolling(2, min_periods=2).apply(
-            lambda x: (safe_div(x[-1], x[-2]))).dropna().astype('f')
-        hindsight[self._fiat] = 1.0
-
-        hindsight = hindsight.apply(lambda x: safe_div(x, x.max()), axis=1)
-
-        # Change env obs_steps back
-        self.obs_steps = obs_steps
+        """
+        Set the environment benchmark to the best constant rebalanced portfolio in hindsight
+        :param nb_steps: int: Solver iterations limit
+        :param verbose: bool: Print optimization results
+        :return: numpy array: Benchmark portfolio vector
+        """
+        # Price relatives matrix, fiat last, rows scaled by its max as in get_reward
+        hindsight = self.get_price_relatives()[1:]
+        hindsight /= hindsight.max(axis=1, keepdims=True)
 
-        # Calculate benchmark return
         # Benchmark: Equally distributed constant rebalanced portfolio
-        ed_crp = array_normalize(np.append(np.ones(len(self.symbols) - 1), [0.0]))
-        ed_crp_returns = np.dot(hindsight, ed_crp)
-
-        ## Define params
-        # Constraints declaration
-        # bench_constraints = [lambda **kwargs: sum([kwargs[key] for key in kwargs]) <= 1]
-
-        ## Define benchmark optimization routine
-        # @ot.constraints.constrained(bench_constrains)
-        # @ot.constraints.violations_defaulted(-10)
-        def find_bench(**kwargs):
-            try:
-                # Init variables
-                nonlocal i, nb_steps, hindsight, ed_crp_returns
-
-                # Best constant rebalance portfolio
-                b_crp = array_normalize(np.array([kwargs[key] for key in kwargs]))
-
-                # Best constant rebalance portfolio returns
-                b_crp_returns = np.dot(hindsight, b_crp)
-
-                # Calculate sharpe regret
-                reward = safe_div(np.log(b_crp_returns).sum(), b_crp_returns.std()) - \
-                         safe_div(np.log(ed_crp_returns).sum(), ed_crp_returns.std())
+        ed_crp = np.append(np.ones(len(self.symbols) - 1), [0.0]) / (len(self.symbols) - 1)
 
-                # Increment counter
-                i += 1
-
-                # Update progress
-                if verbose and i % 10 == 0:
-                    print("Benchmark optimization step {0}/{1}, step reward: {2}".format(i,
-                                                                                         nb_steps,
-                                                                                         float(reward)),
-                          end="\r")
-
-                return reward
-
-            except KeyboardInterrupt:
-                raise ot.api.fun.MaximumEvaluationsException(0)
-
-        # Search space declaration
-        n_assets = len(self.symbols)
-        bench_search_space = {str(i): j for i, j in zip(np.arange(n_assets), [[0, 1] for _ in range(n_assets)])}
         print("Optimizing benchmark...")
+        b_crp = bcrp(hindsight, max_iter=int(nb_steps))
 
-        # Call optimizer to benchmark
-        BCR, info, _ = ot.maximize_structured(
-            find_bench,
-            num_evals=int(nb_steps),
-            search_space=bench_search_space
-            )
+        self.benchmark = convert_to.decimal(array_normalize(b_crp))
 
-        self.benchmark = convert_to.decimal(array_normalize(np.array([BCR[key] for key in BCR])))
-        print("\nOptimum benchmark reward: %f" % info.optimum)
-        print("Best Constant Rebalance portfolio found in %d optimization rounds:\n" % i, self.benchmark.astype(float))
+        if verbose:
+            # Log wealth regret of the equally distributed portfolio, both scored in one product
+            wealth = crp_log_wealth(hindsight, np.stack([b_crp, ed_crp]))
+            print("Optimum benchmark reward: %f" % (wealth[0] - wealth[1]))
+            print("Best Constant Rebalance portfolio found:\n", self.benchmark.astype(float))
 
         return self.benchmark
 
+    def get_price_relatives(self, start=None, end=None):
+        """
+        Hindsight open price relatives, fiat last
+        :param start: datetime: First bar. None for the whole data set
+        :param end: datetime: Last bar
+        :return: numpy array: (n_bars, n_symbols) price relatives, first row ones
+        """
+        if start is None:
+            # Pull the entire data set
+            obs_steps = self.obs_steps
+            self.obs_steps = self.tapi.data_length
+            try:
+                obs = self.get_observation()
+            finally:
+                self.obs_steps = obs_steps
+        else:
+            obs = self.get_history(start, end)
+
+        opens = obs.xs('open', level=1, axis=1).values.astype(np.float64)
+        relatives = np.ones((opens.shape[0], len(self.symbols)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(opens[1:], opens[:-1], out=relatives[1:, :-1])
+        relatives[~np.isfinite(relatives)] = 1.
+        return relatives
+
     def add_pairs(self, *args):
         """
         Add pairs for tradeable symbol universe
@@ -380,9 +380,20 @@ class TradingEnvironment(Env):
     ## Data feed methods
     @property
     def timestamp(self):
-        # return floor_datetime(datetime.now(timezone.utc) - timedelta(minutes=self.period), self.period)
+        """
+        Current bar time as an utc datetime, derived from epoch
+        :return: datetime.datetime:
+        """
+        return datetime.fromtimestamp(self.epoch, timezone.utc)
+
+    @property
+    def epoch(self):
+        """
+        Current bar time as epoch seconds, for time bookkeeping
+        :return: int:
+        """
         # Poloniex returns utc timestamp delayed one full bar
-        return datetime.now(timezone.utc) - timedelta(minutes=self.period)
+        return int(time()) - self.period * 60
 
     # Exchange data getters
     def get_balance(self):
@@ -516,34 +527,86 @@ class TradingEnvironment(Env):
                 end = index[-1]
 
                 # Call for data
-                ohlc_df = pd.DataFrame.from_records(self.tapi.returnChartData(symbol,
-                                                                                period=self.period * 60,
-                                                                                start=datetime.timestamp(start),
-                                                                                end=datetime.timestamp(end)),
-                                                                                nrows=index.shape[0])
-                # TODO 1 FIND A BETTER WAY
-                # TODO: FIX TIMESTAMP
-
-                # Set index
-                ohlc_df.set_index(ohlc_df.date.transform(lambda x: datetime.fromtimestamp(x).astimezone(timezone.utc)),
-                                  inplace=True, drop=True)
-
-                # Get right values to fill nans
-                # TODO: FIND A BETTER PERFORMANCE METHOD
-                last_close = ohlc_df.get_value(ohlc_df.close.last_valid_index(), 'close')
-                fill_dict = {col: last_close for col in ['open', 'high', 'low', 'close']}
-                fill_dict.update({'volume': '0E-16'})
-                # Reindex with desired time range and fill nans
-                ohlc_df = ohlc_df[['open','high','low','close',
-                                   'volume']].reindex(index).asfreq("%dT" % self.period).fillna(fill_dict)
-
-                return ohlc_df.astype(str)#.fillna('0.0')
+                return self.frame_chart(symbol, index, self.tapi.returnChartArray(symbol,
+                                                                                  period=self.period * 60,
+                                                                                  start=datetime.timestamp(start),
+                                                                                  end=datetime.timestamp(end)))
 
             except DataFeedRetryException:
                 Logger.error(TradingEnvironment.get_ohlc, "Retries exhausted. Waiting for connection...")
                 sleep(5)
 
+    def frame_chart(self, symbol, index, chart):
+        """
+        Put pair chart data on the desired time range
+        :param symbol: str: Pair symbol
+        :param index: pandas DatetimeIndex: Time span for data retrieval
+        :param chart: numpy record array: CHART_DTYPE candles
+        :return: pandas DataFrame: OHLC symbol data
+        """
+        chart = chart[:index.shape[0]]
+        dates = chart['date'].astype(np.int64)
+        ohlc = np.empty((chart.shape[0], len(OHLC_FIELDS)), dtype=np.float64)
+        for i, name in enumerate(OHLC_FIELDS):
+            ohlc[:, i] = chart[name]
+
+        return self.frame_ohlc(symbol, index, dates, ohlc)
+
+    def frame_ohlc(self, symbol, index, dates, ohlc, synthetic=None):
+        """
+        Put pair bars on the desired time range, filling gaps with the previous close and zero volume.
+        The synthetic bars mask is kept on self.synthetic[symbol].
+        :param symbol: str: Pair symbol
+        :param index: pandas DatetimeIndex: Time span for data retrieval
+        :param dates: numpy array: (T,) int64 epoch dates
+        :param ohlc: numpy array: (T, field) bars with fields in OHLC_FIELDS order
+        :param synthetic: numpy array: (T,) bars already filled by the data feed
+        :return: pandas DataFrame: OHLC symbol data
+        """
+        start, end = index.asi8[0] // 10 ** 9, index.asi8[-1] // 10 ** 9
+        grid, ohlc, mask = fill_bars(dates, ohlc, self.period, start, end)
+        if synthetic is not None and synthetic.any():
+            mask |= np.in1d(grid, dates[synthetic])
+
+        if index.freqstr != "%dT" % self.period or index.shape[0] != grid.shape[0]:
+            index = pd.date_range(start=index[0], periods=grid.shape[0], freq="%dT" % self.period)
+        self.synthetic[symbol] = pd.Series(mask, index=index)
+
+        return pd.DataFrame(ohlc, index=index, columns=OHLC_FIELDS).astype(str)
+
     # Observation maker
+    def get_dates(self, end=None):
+        """
+        Return observation bars epoch dates: the last obs_steps period multiples up to end ceiling
+        :param end: int: Last bar epoch seconds. Defaults to current epoch
+        :return: numpy array: (obs_steps,) int64 epoch dates
+        """
+        if end is None:
+            end = self.epoch
+        step = self.period * 60
+        return -(-end // step) * step - step * np.arange(self.obs_steps - 1, -1, -1, dtype=np.int64)
+
+    def dates_index(self, dates):
+        """
+        Convert epoch dates to an utc observation index
+        :param dates: numpy array: (T,) int64 epoch dates, period spaced
+        :return: pandas DatetimeIndex:
+        """
+        return pd.DatetimeIndex(dates * 10 ** 9, freq="%dT" % self.period).tz_localize(timezone.utc)
+
+    def get_index(self, end=None):
+        """
+        Return observation index with obs_steps bars
+        :param end: datetime.datetime: Last bar time. Defaults to current epoch
+        :return: pandas DatetimeIndex: utc, or on end timezone when given. Naive end gives a naive index
+        """
+        if not end:
+            return self.dates_index(self.get_dates())
+
+        end = pd.Timestamp(end)
+        index = self.dates_index(self.get_dates(-(-end.value // 10 ** 9)))
+        return index.tz_convert(end.tz) if end.tz else index.tz_localize(None)
+
     def get_history(self, start=None, end=None, portfolio_vector=False):
         try:
             obs_list = []
@@ -552,17 +615,13 @@ class TradingEnvironment(Env):
             # Make desired index
             is_bounded = True
             if not end:
-                end = self.timestamp
                 is_bounded = False
             if not start:
-                start = end - timedelta(minutes=self.period * self.obs_steps)
-                index = pd.date_range(start=start,
-                                      end=end,
-                                      freq="%dT" % self.period).ceil("%dT" % self.period)[-self.obs_steps:]
+                index = self.get_index(end)
                 is_bounded = False
             else:
                 index = pd.date_range(start=start,
-                                      end=end,
+                                      end=end or self.timestamp,
                                       freq="%dT" % self.period).ceil("%dT" % self.period)
 
             if portfolio_vector:
@@ -573,10 +632,8 @@ class TradingEnvironment(Env):
                     port_vec.index = [index[0]]
 
                 # Get pairs history
-                for pair in self.pairs:
+                for pair, history in zip(self.pairs, self.get_pairs_ohlc(index)):
                     keys.append(pair)
-                    history = self.get_ohlc(pair, index)
-
                     history = pd.concat([history, port_vec[pair.split('_')[1]]], axis=1)
                     obs_list.append(history)
 
@@ -597,9 +654,8 @@ class TradingEnvironment(Env):
                 return obs.apply(convert_to.decimal, raw=True)
             else:
                 # Get history
-                for pair in self.pairs:
+                for pair, history in zip(self.pairs, self.get_pairs_ohlc(index)):
                     keys.append(pair)
-                    history = self.get_ohlc(pair, index)
                     obs_list.append(history)
 
                 # Concatenate
@@ -622,7 +678,10 @@ class TradingEnvironment(Env):
         :return: pandas DataFrame:
         """
         try:
-            self.obs_df = self.get_history(portfolio_vector=portfolio_vector)
+            if self.rolling and portfolio_vector:
+                self.obs_df = self.roll_observation()
+            else:
+                self.obs_df = self.get_history(portfolio_vector=portfolio_vector)
             return self.obs_df
 
         # except ExchangeError:
@@ -634,6 +693,83 @@ class TradingEnvironment(Env):
             Logger.error(TradingEnvironment.get_observation, self.parse_error(e))
             raise e
 
+    def get_bars(self, index):
+        """
+        Return pairs bars for the desired index
+        :param index: pandas DatetimeIndex: Bars time
+        :return: numpy array: (time, pair, field) float64 array
+        """
+        return np.stack([ohlc.values.astype(np.float64) for ohlc in self.get_pairs_ohlc(index)], axis=1)
+
+    def get_pairs_ohlc(self, index):
+        """
+        Return OHLC data for all pairs, on a single data feed call. Feeds without batch requests run it over
+        n_threads under the data feed rate limit
+        :param index: pandas DatetimeIndex: Bars time
+        :return: list: pandas DataFrames in pairs order
+        """
+        while True:
+            try:
+                charts = self.tapi.get_charts(self.pairs, self.period * 60, datetime.timestamp(index[0]),
+                                              datetime.timestamp(index[-1]), self.n_threads)
+                return [self.frame_chart(pair, index, chart) for pair, chart in zip(self.pairs, charts)]
+
+            except DataFeedRetryException:
+                Logger.error(TradingEnvironment.get_pairs_ohlc, "Retries exhausted. Waiting for connection...")
+                sleep(5)
+
+    def roll_observation(self):
+        """
+        Update rolling observation window with the bars arrived since last call.
+        The last known bar is refreshed, as it may have been sampled before closing.
+        Window is rebuilt from get_history when empty or out of range.
+        :return: pandas DataFrame: Observation with portfolio vector
+        """
+        try:
+            if self.obs_window is None:
+                self.obs_window = RollingWindow(self.pairs, self._fiat, self.obs_steps, self.period)
+
+            dates = self.get_dates()
+
+            if not self.obs_window.size or dates[0] > self.obs_window.last_date or \
+                    dates[-1] < self.obs_window.last_date:
+                self.obs_window.fill(self.get_history(portfolio_vector=True))
+
+            else:
+                new = dates >= self.obs_window.last_date
+                for date, bar in zip(dates[new], self.get_bars(self.dates_index(dates[new]))):
+                    self.obs_window.push(date, bar)
+
+            return self.obs_window.to_frame()
+
+        except Exception as e:
+            Logger.error(TradingEnvironment.roll_observation, self.parse_error(e))
+            raise e
+
+    def roll_portfolio(self, timestamp, symbol, value):
+        """
+        Write portfolio change to rolling observation window
+        :param timestamp: datetime.datetime: Change time
+        :param symbol: str: Symbol name
+        :param value: Decimal: Symbol amount
+        :return: None
+        """
+        if self.obs_window is not None and self.obs_window.size and symbol in self.symbols:
+            self.obs_window.set_portfolio(int(timestamp.timestamp()), self.symbols.index(symbol), float(value))
+
+    def update_portfolio(self, timestamp, symbol, value):
+        """
+        Write symbol amount to portfolio df, rolling window and fixed point account
+        :param timestamp: datetime.datetime: Change time
+        :param symbol: str: Symbol name
+        :param value: Decimal: Symbol amount
+        :return: None
+        """
+        self.portfolio_ledger.set(timestamp, symbol, convert_to.decimal(value))
+        self.roll_portfolio(timestamp, symbol, value)
+        if self.account is not None and symbol in self.symbols:
+            self.account.set(symbol, value)
+
     def get_sampled_portfolio(self, index=None):
         """
         Return sampled portfolio df
@@ -641,18 +777,12 @@ class TradingEnvironment(Env):
         :return:
         """
         if index is None:
-            start = self.portfolio_df.index[0]
-            end = self.portfolio_df.index[-1]
+            return self.portfolio_ledger.sample(self.period)
 
+        if index[0] != index[-1]:
+            return self.portfolio_ledger.sample(self.period, index[0], index[-1])
         else:
-            start = index[0]
-            end = index[-1]
-
-        # TODO 1 FIND A BETTER WAY
-        if start != end:
-            return self.portfolio_df.loc[start:end].resample("%dmin" % self.period).last()
-        else:
-            return self.portfolio_df.loc[:end].resample("%dmin" % self.period).last()
+            return self.portfolio_ledger.sample(self.period, end=index[-1])
 
     def get_sampled_actions(self, index=None):
         """
@@ -661,15 +791,14 @@ class TradingEnvironment(Env):
         :return:
         """
         if index is None:
-            start = self.portfolio_df.index[0]
-            end = self.portfolio_df.index[-1]
+            start = self.portfolio_ledger.timestamp(0)
+            end = self.portfolio_ledger.timestamp(-1)
 
         else:
             start = index[0]
             end = index[-1]
 
-        # TODO 1 FIND A BETTER WAY
-        return self.action_df.loc[start:end].resample("%dmin" % self.period).last()
+        return self.action_ledger.sample(self.period, start, end)
 
     ## Trading methods
     def get_open_price(self, symbol, timestamp=None):
@@ -681,7 +810,15 @@ class TradingEnvironment(Env):
         """
         if not timestamp:
             timestamp = self.obs_df.index[-1]
-        return self.obs_df.get_value(timestamp, ("%s_%s" % (self._fiat, symbol), 'open'))
+        return convert_to.decimal(str(self.obs_df.get_value(timestamp, ("%s_%s" % (self._fiat, symbol), 'open'))))
+
+    def get_account_prices(self, timestamp=None):
+        """
+        Get pairs open prices as fixed point account units
+        :param timestamp: datetime.datetime:
+        :return: numpy array: int64 prices
+        """
+        return self.account.price_units([self.get_open_price(symbol, timestamp) for symbol in self._crypto])
 
     def calc_total_portval(self, timestamp=None):
         """
@@ -689,6 +826,10 @@ class TradingEnvironment(Env):
         :param timestamp: datetime.datetime:
         :return: Decimal: Portfolio value in fiat units
         """
+        if self.account is not None:
+            return self.account.to_decimal(self.account.portval(self.get_account_prices(timestamp)),
+                                           self.account.precision[-1])
+
         portval = dec_zero
 
         for symbol in self._crypto:
@@ -714,6 +855,10 @@ class TradingEnvironment(Env):
         Return portfolio position vector
         :return: numpy array:
         """
+        if self.account is not None:
+            weights = self.account.weights(self.get_account_prices())
+            return np.array([self.account.to_decimal(w, WEIGHT_PRECISION) for w in weights], dtype=Decimal)
+
         portfolio = np.empty(len(self.symbols), dtype=Decimal)
         portval = self.calc_total_portval()
         for i, symbol in enumerate(self.symbols):
@@ -763,9 +908,9 @@ class TradingEnvironment(Env):
         :return:
         """
         if symbol == 'online':
-            self.action_df.at[timestamp, symbol] = value
+            self.action_ledger.set(timestamp, symbol, value)
         else:
-            self.action_df.at[timestamp, symbol] = convert_to.decimal(value)
+            self.action_ledger.set(timestamp, symbol, convert_to.decimal(value))
 
     def log_action_vector(self, timestamp, vector, online):
         """
@@ -785,13 +930,7 @@ class TradingEnvironment(Env):
         :return: Decimal
         """
         try:
-            i = -1
-            portval = self.portfolio_df.get_value(self.portfolio_df.index[i], 'portval')
-            while not dec_con.create_decimal(portval).is_finite():
-                i -= 1
-                portval = self.portfolio_df.get_value(self.portfolio_df.index[i], 'portval')
-
-            return portval
+            return self.portfolio_ledger.last_valid('portval')
         except Exception as e:
             Logger.error(TradingEnvironment.get_last_portval, self.parse_error(e))
             raise e
@@ -816,15 +955,15 @@ class TradingEnvironment(Env):
         # return port_return - bench_return
 
         # Regret
-        pr = self.obs_df.xs('open', level=1, axis=1).iloc[-2:].values
+        pr = convert_to.decimal(self.obs_df.xs('open', level=1, axis=1).iloc[-2:].values)
         pr = np.append(safe_div(pr[-1], pr[-2]), [dec_one])
         pr_max = pr.max()
         # pr = safe_div(pr, pr_max)
 
         # port_log_return = rew_con.log10(np.dot(convert_to.decimal(self.action_df.iloc[-1].values[:-1]), pr))
         try:
-            port_change = safe_div(self.portfolio_df.get_value(self.portfolio_df.index[-1], 'portval'),
-                               self.portfolio_df.get_value(self.portfolio_df.index[-2], 'portval'))
+            port_change = safe_div(self.portfolio_ledger.iget(-1, 'portval'),
+                                   self.portfolio_ledger.iget(-2, 'portval'))
         except IndexError:
             port_change = dec_one
 
@@ -842,6 +981,9 @@ class TradingEnvironment(Env):
         :return: None
         """
         # TODO: IMPLEMENT SLIPPAGE MODEL
+        if self.account is not None:
+            return self.simulate_fixed_trade(action, timestamp)
+
         try:
             # Assert inputs
             action = self.assert_action(action)
@@ -852,75 +994,79 @@ class TradingEnvironment(Env):
             # Log desired action
             self.log_action_vector(timestamp, action, False)
 
-            # Calculate position change given action
-            posit_change = dec_vec_sub(action, self.calc_portfolio_vector())[:-1]
-
-            # Get initial portval
-            portval = self.calc_total_portval()
-
-            # Sell assets first
-            for i, change in enumerate(posit_change):
-                if change < dec_zero:
-
-                    symbol = self.symbols[i]
-
-                    crypto_pool = safe_div(dec_con.multiply(portval, action[i]), self.get_open_price(symbol))
-
-                    with localcontext() as ctx:
-                        ctx.rounding = ROUND_UP
-
-                        fee = ctx.multiply(dec_con.multiply(portval, change.copy_abs()), self.tax[symbol])
-
-                    self.fiat = {self._fiat: dec_con.add(self.fiat, portval.fma(change.copy_abs(), -fee)), 'timestamp': timestamp}
-
-                    self.crypto = {symbol: crypto_pool, 'timestamp': timestamp}
-
-            # Uodate prev portval with deduced taxes
-            portval = self.calc_total_portval()
+            # Rebalance portfolio
+            holdings = np.array([self.get_crypto(symbol) for symbol in self._crypto] + [self.fiat], dtype=Decimal)
+            prices = np.array([self.get_open_price(symbol) for symbol in self._crypto], dtype=Decimal)
+            fees = np.array([self.tax[symbol] for symbol in self._crypto], dtype=Decimal)
 
-            # Then buy some goods
-            for i, change in enumerate(posit_change):
-                if change > dec_zero:
+            holdings, _ = rebalance(holdings, prices, action, fees)
 
-                    symbol = self.symbols[i]
+            # Update portfolio_df
+            final_balance = dict(zip(self.symbols, holdings))
+            final_balance['timestamp'] = timestamp
+            self.balance = final_balance
 
-                    self.fiat = {self._fiat: dec_con.subtract(self.fiat, dec_con.multiply(portval, change.copy_abs())),
-                                 'timestamp': timestamp}
+            # Log executed action
+            self.log_action_vector(self.timestamp, self.calc_portfolio_vector(), True)
 
-                    # if fiat_pool is negative, deduce it from portval and clip
-                    if self.fiat < dec_zero:
-                        portval += self.fiat
-                        self.fiat = {self._fiat: dec_zero, 'timestamp': timestamp}
+            # Calculate new portval
+            self.portval = {'portval': self.calc_total_portval(),
+                            'timestamp': self.portfolio_ledger.timestamp(-1)}
 
-                    with localcontext() as ctx:
-                        ctx.rounding = ROUND_UP
+        except Exception as e:
+            Logger.error(TradingEnvironment.simulate_trade, self.parse_error(e))
+            if hasattr(self, 'email'):
+                self.send_email("TradingEnvironment Error: %s at %s" % (e,
+                                datetime.strftime(self.timestamp, "%Y-%m-%d %H:%M:%S")),
+                                self.parse_error(e))
+            raise e
 
-                        fee = ctx.multiply(dec_con.multiply(portval, change.copy_abs()), self.tax[symbol])
+    def simulate_fixed_trade(self, action, timestamp):
+        """
+        Simulates trade on exchange environment using fixed point account
+        :param action: np.array: Desired portfolio vector
+        :param timestamp: datetime.datetime: Trade time
+        :return: None
+        """
+        try:
+            weights = self.account.to_weights(action)
 
-                    crypto_pool = safe_div(portval.fma(action[i], -fee), self.get_open_price(symbol))
+            # Log desired action
+            self.log_action_vector(timestamp, [self.account.to_decimal(w, WEIGHT_PRECISION) for w in weights], False)
 
-                    self.crypto = {symbol: crypto_pool, 'timestamp': timestamp}
+            # Rebalance
+            rates = self.account.rate_units([self.tax[symbol] for symbol in self._crypto])
+            self.account.rebalance(weights, self.get_account_prices(), rates)
 
             # Log executed action and final balance
             self.log_action_vector(self.timestamp, self.calc_portfolio_vector(), True)
 
-            # Update portfolio_df
-            final_balance = self.balance
+            final_balance = self.account.balance()
             final_balance['timestamp'] = timestamp
             self.balance = final_balance
 
             # Calculate new portval
             self.portval = {'portval': self.calc_total_portval(),
-                            'timestamp': self.portfolio_df.index[-1]}
+                            'timestamp': self.portfolio_ledger.timestamp(-1)}
 
         except Exception as e:
-            Logger.error(TradingEnvironment.simulate_trade, self.parse_error(e))
+            Logger.error(TradingEnvironment.simulate_fixed_trade, self.parse_error(e))
             if hasattr(self, 'email'):
                 self.send_email("TradingEnvironment Error: %s at %s" % (e,
                                 datetime.strftime(self.timestamp, "%Y-%m-%d %H:%M:%S")),
                                 self.parse_error(e))
             raise e
 
+    def reset_account(self):
+        """
+        Create a new fixed point account if precision is set
+        :return: None
+        """
+        if self.precision is not None:
+            self.account = FixedPointAccount(self.symbols, self.precision)
+        else:
+            self.account = None
+
     ## Env methods
     def set_observation_space(self):
         """
@@ -1004,16 +1150,12 @@ class TradingEnvironment(Env):
 
 
         # Best Constant Rebalance Portfolio without taxes
-        hindsight = obs.xs('open', level=1, axis=1).rolling(2,
-                        min_periods=2).apply(lambda x: (safe_div(x[-1],
-                                                    x[-2]))).fillna(dec_one).applymap(dec_con.create_decimal)
-        hindsight[self._fiat] = dec_one
-
-        # hindsight = hindsight.apply(lambda x: safe_div(x, x.max()), axis=1)
+        hindsight = self.get_price_relatives(self.results.index[0], self.results.index[-1])
 
         # Take first operation fee just to start at the same point as strategy
         if benchmark == 'crp':
-            self.results['benchmark'] = np.dot(hindsight, self.benchmark).cumprod() * init_portval * \
+            self.results['benchmark'] = convert_to.decimal(hindsight.dot(np.asarray(self.benchmark, dtype=np.float64)
+                                                                         ).cumprod()) * init_portval * \
                                     (dec_one - self.tax[symbol.split('_')[1]])
 
         # Calculate metrics
@@ -1318,46 +1460,174 @@ class BacktestEnvironment(TradingEnvironment):
     """
     Backtest environment for financial strategies history testing
     """
-    def __init__(self, period, obs_steps, tapi, fiat, name):
+    def __init__(self, period, obs_steps, tapi, fiat, name, columnar=False, rolling=False, precision=None):
+        """
+        :param columnar: bool: Serve observations from tapi columnar arrays instead of chart data records.
+        Columnar mode assumes a gapless data feed, one row per period.
+        :param rolling: bool: Keep a rolling observation window and append only new bars each step
+        :param precision: int or dict: Fixed point accounting decimal places per symbol. None keeps Decimal
+        """
         assert isinstance(tapi, BacktestDataFeed), "Backtest tapi must be a instance of BacktestDataFeed."
         self.index = obs_steps
-        super().__init__(period, obs_steps, tapi, fiat, name)
+        super().__init__(period, obs_steps, tapi, fiat, name, rolling, precision)
         self.data_length = None
         self.training = False
+        self.columnar = columnar
+        self._timestamp = (None, None)
+
+    @property
+    def epoch(self):
+        return int(self.tapi.dates[self.index])
 
     @property
     def timestamp(self):
-        return datetime.fromtimestamp(self.tapi.ohlc_data[self.tapi.pairs[0]].index[self.index]).astimezone(timezone.utc)
+        # Converted once per bar
+        epoch = self.epoch
+        if self._timestamp[0] != epoch:
+            self._timestamp = (epoch, datetime.fromtimestamp(epoch, timezone.utc))
+        return self._timestamp[1]
+
+    def get_ledger_length(self):
+        if self.tapi.data_length:
+            return self.tapi.data_length + 1
+        return super().get_ledger_length()
+
+    # Columnar engine
+    def setup_columnar(self):
+        """
+        Precompute pair column offsets and observation columns for columnar mode
+        :return: None
+        """
+        self._pair_index = np.array([self.tapi.pairs.index(pair) for pair in self.pairs])
+        self._pair_slice = np.array_equal(self._pair_index, np.arange(len(self.tapi.pairs)))
+        self._symbol_index = {pair.split('_')[1]: self.tapi.pairs.index(pair) for pair in self.pairs}
+
+        self._ohlc_columns = pd.MultiIndex.from_tuples([(pair, field) for pair in self.pairs
+                                                        for field in OHLC_FIELDS])
+        self._obs_columns = pd.MultiIndex.from_tuples([(pair, field) for pair in self.pairs
+                                                       for field in OHLC_FIELDS + [pair.split('_')[1]]] +
+                                                      [(self._fiat, self._fiat)])
+
+    def get_window(self):
+        """
+        Return columnar observation window ending at current index
+        :return: tuple: int64 dates view, (obs_steps, pair, field) float64 ohlc array
+        """
+        dates, ohlc = self.tapi.get_window(self.index, self.obs_steps)
+        if not self._pair_slice:
+            ohlc = ohlc[:, self._pair_index]
+        return dates, ohlc
+
+    def get_dates(self, end=None):
+        if not self.columnar or end is not None:
+            return super().get_dates(end)
+
+        return self.tapi.get_window(self.index, self.obs_steps)[0]
+
+    def get_bars(self, index):
+        if not self.columnar:
+            return super().get_bars(index)
+
+        rows = np.searchsorted(self.tapi.dates, index.asi8 // 10 ** 9)
+        return self.tapi.ohlc_array[rows][:, self._pair_index]
+
+    def get_history(self, start=None, end=None, portfolio_vector=False):
+        if not self.columnar or start or end:
+            return super().get_history(start=start, end=end, portfolio_vector=portfolio_vector)
+
+        try:
+            dates, ohlc = self.get_window()
+            index = self.dates_index(dates)
+            n_pairs = len(self.pairs)
+
+            if portfolio_vector:
+                # Get portfolio observation, straight from the ledger arrays when possible
+                port_vec = self.portfolio_ledger.sample_filled(self.period, index.asi8, list(self.symbols))
+                if port_vec is None:
+                    port_vec = self.get_sampled_portfolio(index)
+                    if port_vec.shape[0] == 0:
+                        port_vec = self.get_sampled_portfolio().iloc[-1:]
+                        port_vec.index = [index[0]]
+                    port_vec = port_vec[self.symbols].reindex(index).ffill().bfill().values
+                port_vec = port_vec.astype(np.float64)
+
+                # Interleave pairs history and portfolio
+                obs = np.empty((index.shape[0], n_pairs, len(OHLC_FIELDS) + 1), dtype=np.float64)
+                obs[:, :, :-1] = ohlc
+                obs[:, :, -1] = port_vec[:, :-1]
+                obs = np.hstack([obs.reshape(index.shape[0], -1), port_vec[:, -1:]])
+
+                return pd.DataFrame(obs, index=index, columns=self._obs_columns)
+            else:
+                return pd.DataFrame(ohlc.reshape(index.shape[0], -1), index=index, columns=self._ohlc_columns)
+
+        except Exception as e:
+            Logger.error(BacktestEnvironment.get_history, self.parse_error(e))
+            raise e
+
+    def get_price_relatives(self, start=None, end=None):
+        """
+        Hindsight open price relatives, fiat last, sliced from the data feed cached matrix
+        :param start: datetime: First bar. None for the whole data set
+        :param end: datetime: Last bar
+        :return: numpy array: (n_bars, n_symbols) price relatives, first row ones
+        """
+        relatives = self.tapi.price_relatives
+        if start is None:
+            rows = np.arange(relatives.shape[0])
+        else:
+            index = pd.date_range(start=start, end=end or self.timestamp,
+                                  freq="%dT" % self.period).ceil("%dT" % self.period)
+            rows = np.searchsorted(self.tapi.dates, index.asi8 // 10 ** 9)
+
+            # Bars missing on the data feed fall back to the history frame
+            if rows[-1] >= self.tapi.dates.shape[0] or \
+                    (self.tapi.dates[rows] != index.asi8 // 10 ** 9).any():
+                return super().get_price_relatives(start, end)
+
+        pair_index = [self.tapi.pairs.index(pair) for pair in self.pairs]
+        relatives = np.append(relatives[rows][:, pair_index], np.ones((rows.shape[0], 1)), axis=1)
+        relatives[0] = 1.
+        return relatives
+
+    def get_open_price(self, symbol, timestamp=None):
+        """
+        Get symbol open price
+        :param symbol: str: Pair name
+        :param timestamp:
+        :return: Decimal: Symbol open price
+        """
+        if not self.columnar:
+            return super().get_open_price(symbol, timestamp)
+
+        if timestamp is None:
+            row = self.index
+        else:
+            row = np.searchsorted(self.tapi.dates, int(timestamp.timestamp()))
+
+        # Shortest float repr recovers the feed decimal string
+        return convert_to.decimal(str(float(self.tapi.ohlc_array[row, self._symbol_index[symbol], 0])))
+
+    def get_pairs_ohlc(self, index):
+        """
+        Return OHLC data for all pairs, requested over n_threads
+        :param index: pandas DatetimeIndex: Bars time
+        :return: list: pandas DataFrames in pairs order
+        """
+        if self.n_threads > 1:
+            return self.tapi.map_requests(self.get_ohlc, [(pair, index) for pair in self.pairs], self.n_threads)
+        return [self.get_ohlc(pair, index) for pair in self.pairs]
 
     def get_ohlc(self, symbol, index):
         # Get range
         start = index[0]
         end = index[-1]
 
-        # Call for data
-        ohlc_df = pd.DataFrame.from_records(self.tapi.returnChartData(symbol,
-                                                                        period=self.period * 60,
-                                                                        start=datetime.timestamp(start),
-                                                                        end=datetime.timestamp(end)),
-                                                                        nrows=index.shape[0])
-        # TODO 1 FIND A BETTER WAY
-        # TODO: FIX TIMESTAMP
-        # Set index
-
-        ohlc_df.set_index(ohlc_df.date.transform(lambda x: datetime.fromtimestamp(x).astimezone(timezone.utc)),
-                          inplace=True, drop=True)
+        # Call for data, gaps are filled by the data feed at load time
+        dates, ohlc = self.tapi.get_range(symbol, datetime.timestamp(start), datetime.timestamp(end))
+        synthetic = self.tapi.get_synthetic(symbol, datetime.timestamp(start), datetime.timestamp(end))
 
-        # Disabled fill on backtest for performance.
-        # We assume that backtest data feed will not return nan values
-
-        # Get right values to fill nans
-        # fill_dict = {col: ohlc_df.loc[ohlc_df.close.last_valid_index(), 'close'] for col in ['open', 'high', 'low', 'close']}
-        # fill_dict.update({'volume': '0E-8'})
-        # Reindex with desired time range and fill nans
-        ohlc_df = ohlc_df[['open','high','low','close',
-                           'volume']].reindex(index).asfreq("%dT" % self.period)#.fillna(fill_dict)
-
-        return ohlc_df.astype(str)
+        return self.frame_ohlc(symbol, index, dates, ohlc, synthetic)
 
     def reset(self, reset_dfs=True):
         """
@@ -1375,6 +1645,7 @@ class BacktestEnvironment(TradingEnvironment):
                 self.index = self.obs_steps
 
             # Reset log dfs
+            self.obs_window = None
             if reset_dfs:
                 self.obs_df = pd.DataFrame()
                 self.portfolio_df = pd.DataFrame()
@@ -1383,7 +1654,11 @@ class BacktestEnvironment(TradingEnvironment):
             self.set_observation_space()
             self.set_action_space()
 
+            if self.columnar:
+                self.setup_columnar()
+
             # Reset balance
+            self.reset_account()
             self.balance = self.init_balance = self.get_balance()
 
             # Get fee values
@@ -1398,11 +1673,11 @@ class BacktestEnvironment(TradingEnvironment):
             if reset_dfs:
                 self.action_df = pd.DataFrame([list(self.calc_portfolio_vector()) + [False]],
                                               columns=list(self.symbols) + ['online'],
-                                              index=[self.portfolio_df.index[0]])
+                                              index=[self.portfolio_ledger.timestamp(0)])
 
             # Reset portfolio value
             self.portval = {'portval': self.calc_total_portval(self.obs_df.index[-1]),
-                            'timestamp': self.portfolio_df.index[-1]}
+                            'timestamp': self.portfolio_ledger.timestamp(-1)}
 
             # Return first observation
             return obs.astype(np.float64)
@@ -1420,7 +1695,7 @@ class BacktestEnvironment(TradingEnvironment):
             self.simulate_trade(action, timestamp)
 
             # Calculate new portval
-            self.portval = {'portval': self.calc_total_portval(), 'timestamp': self.portfolio_df.index[-1]}
+            self.portval = {'portval': self.calc_total_portval(), 'timestamp': self.portfolio_ledger.timestamp(-1)}
 
             if self.index >= self.data_length - 2:
                 done = True
@@ -1456,18 +1731,20 @@ class PaperTradingEnvironment(TradingEnvironment):
     """
     Paper trading environment for financial strategies forward testing
     """
-    def __init__(self, period, obs_steps, tapi, fiat, name):
+    def __init__(self, period, obs_steps, tapi, fiat, name, rolling=False, precision=None):
         assert isinstance(tapi, PaperTradingDataFeed) or isinstance(tapi, DataFeed), "Paper trade tapi must be a instance of PaperTradingDataFeed."
-        super().__init__(period, obs_steps, tapi, fiat, name)
+        super().__init__(period, obs_steps, tapi, fiat, name, rolling, precision)
 
     def reset(self):
 
         self.obs_df = pd.DataFrame()
+        self.obs_window = None
         self.portfolio_df = pd.DataFrame()
 
         self.set_observation_space()
         self.set_action_space()
 
+        self.reset_account()
         self.balance = self.init_balance = self.get_balance()
 
         for symbol in self.symbols:
@@ -1480,7 +1757,7 @@ class PaperTradingEnvironment(TradingEnvironment):
                                       index=[self.timestamp])
 
         self.portval = {'portval': self.calc_total_portval(),
-                        'timestamp': self.portfolio_df.index[-1]}
+                        'timestamp': self.portfolio_ledger.timestamp(-1)}
 
         return obs.astype(np.float64)
 
@@ -1514,9 +1791,9 @@ class LiveTradingEnvironment(TradingEnvironment):
     Live trading environment for financial strategies execution
     ** USE AT YOUR OWN RISK**
     """
-    def __init__(self, period, obs_steps, tapi, fiat, name):
+    def __init__(self, period, obs_steps, tapi, fiat, name, rolling=False):
         assert isinstance(tapi, ExchangeConnection), "tapi must be an ExchangeConnection instance."
-        super().__init__(period, obs_steps, tapi, fiat, name)
+        super().__init__(period, obs_steps, tapi, fiat, name, rolling)
 
     # Data feed methods
     def get_balance_array(self):
@@ -1868,7 +2145,7 @@ class LiveTradingEnvironment(TradingEnvironment):
 
             # Calculate new portval
             self.portval = {'portval': self.calc_total_portval(ticker),
-                            'timestamp': self.portfolio_df.index[-1]}
+                            'timestamp': self.portfolio_ledger.timestamp(-1)}
 
             return done
 
@@ -1895,6 +2172,7 @@ class LiveTradingEnvironment(TradingEnvironment):
     # Env methods
     def reset(self):
         self.obs_df = pd.DataFrame()
+        self.obs_window = None
         self.portfolio_df = pd.DataFrame()
         ticker = self.tapi.returnTicker()
 
@@ -1913,7 +2191,7 @@ class LiveTradingEnvironment(TradingEnvironment):
                                       index=[self.timestamp])
 
         self.portval = {'portval': self.calc_total_portval(ticker),
-                        'timestamp': self.portfolio_df.index[-1]}
+                        'timestamp': self.portfolio_ledger.timestamp(-1)}
 
         return obs.astype(np.float64)
 
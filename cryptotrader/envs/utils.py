@@ -1,4 +1,5 @@
 import gc
+import os
 
 import numpy as np
 import pandas as pd
@@ -6,6 +7,8 @@ from time import time
 
 from ..random_process import ConstrainedOrnsteinUhlenbeckProcess
 from ..utils import convert_to
+from ..datafeed import CandleWriter, OHLC_FIELDS
+from .resample import aggregate_trades, stream_resample
 from bokeh.layouts import column
 from bokeh.palettes import inferno
 from bokeh.plotting import figure, show
@@ -112,14 +115,9 @@ def sample_trades(df, freq):
         df['trade_volume'] = df['trade_volume'].fillna(convert_to.decimal('1e-8'))
 
         # TODO FIND OUT WHAT TO DO WITH NANS
-        index = df.resample(freq).first().index
-        out = pd.DataFrame(index=index)
-
-        out['open'] = df['trade_px'].resample(freq).first()
-        out['high'] = df['trade_px'].resample(freq).max()
-        out['low'] = df['trade_px'].resample(freq).min()
-        out['close'] = df['trade_px'].resample(freq).last()
-        out['volume'] = df['trade_volume'].resample(freq).sum()
+        # One resampling pass for all fields
+        out = df.resample(freq).agg({'trade_px': ['first', 'max', 'min', 'last'], 'trade_volume': 'sum'})
+        out.columns = ['open', 'high', 'low', 'close', 'volume']
 
         return out
 
@@ -127,30 +125,36 @@ def sample_trades(df, freq):
 def sample_ohlc(df, freq):
 
         # TODO FIND OUT WHAT TO DO WITH NANS
-        index = df.resample(freq).first().index
-        out = pd.DataFrame(index=index, columns=df.columns)
-
-        out['open'] = df['open'].resample(freq).first().ffill()
-        out['high'] = df['high'].resample(freq).max().ffill()
-        out['low'] = df['low'].resample(freq).min().ffill()
-        out['close'] = df['close'].resample(freq).last().ffill()
-        out['volume'] = df['volume'].resample(freq).sum().fillna(convert_to.decimal('1e-8'))
+        # One resampling pass for all fields
+        out = df.resample(freq).agg({'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum'})
+        out[['open', 'high', 'low', 'close']] = out[['open', 'high', 'low', 'close']].ffill()
+        out['volume'] = out['volume'].fillna(convert_to.decimal('1e-8'))
 
-        return out
+        return out.reindex(columns=df.columns)
 
 
-def get_dfs_from_db(conn, exchange, start=None, end=None, freq='1min'):
+def get_dfs_from_db(conn, exchange, start=None, end=None, freq='1min', save_dir=None, batch_size=10000):
     """
-    Get dataframes from database
+    Get dataframes from database.
+    Trades are streamed from the database cursor and aggregated in batches, so memory use does not grow
+    with the trade history length. The date ordered stream needs an index on the trades date, which is
+    created on each trades collection when missing. Without it the database sorts whole collections in
+    memory and fails past its sort memory limit.
     :param conn: pymongo database instance
     :param exchange: exchnage name string
     :param start: start date string
     :param end: end date string
     :param freq: df's sampling frequency
+    :param save_dir: str: When given, bars are written to binary candle files on this directory as they are
+    built, named exchange_symbol_<period>min, and no dataframes are returned
+    :param batch_size: int: Trades read per batch
     :return: list, list: symbols, dfs
     """
     # assert isinstance(conn, pm.database), 'conn must be an instance of mongo database'
     assert isinstance(exchange, str), 'exchange must be a string'
+    period = int(pd.to_timedelta(freq).total_seconds() // 60)
+    assert period > 0, 'freq must be at least one minute'
+
     symbols = []
     for item in conn.collection_names():
         if exchange in item and 'zec' not in item and 'xmr' not in item:
@@ -168,20 +172,25 @@ def get_dfs_from_db(conn, exchange, start=None, end=None, freq='1min'):
         else:
             filt = None
 
-        df = pd.DataFrame.from_records(conn[exchange + '_' + symbol + '_trades'].find(filt))
-
-        df['rate'] = df['rate'].ffill().apply(convert_to.decimal)
-        df['amount'] = df['amount'].apply(convert_to.decimal)
-        df.index = df.date.apply(pd.to_datetime)
-
-        index = df.resample(freq).first().index
-        out = pd.DataFrame(index=index)
-
-        out['open'] = convert_and_clean(df['rate'].resample(freq).first())
-        out['high'] = convert_and_clean(df['rate'].resample(freq).max())
-        out['low'] = convert_and_clean(df['rate'].resample(freq).min())
-        out['close'] = convert_and_clean(df['rate'].resample(freq).last())
-        out['volume'] = convert_and_clean(df['amount'].resample(freq).sum())
+        collection = conn[exchange + '_' + symbol + '_trades']
+        collection.create_index('date')
+        trades = collection.find(filt).sort('date', 1)
+        bars = aggregate_trades(trades, period, batch_size)
+
+        if save_dir is not None:
+            path = os.path.join(save_dir, exchange + '_' + symbol + '_' + str(period) + 'min')
+            with CandleWriter(path, exchange=exchange, period=period) as writer:
+                for dates, ohlc in bars:
+                    writer.write(dates, ohlc)
+            print("Candles: {}, Acquisition time: {}".format(writer.length, time() - t0))
+            continue
+
+        batches = list(bars)
+        if batches:
+            dates, ohlc = np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+        else:
+            dates, ohlc = np.empty(0, dtype=np.int64), np.empty((0, len(OHLC_FIELDS)))
+        out = pd.DataFrame(ohlc, index=pd.to_datetime(dates, unit='s'), columns=OHLC_FIELDS)
 
         print("Dataframe shape: {}, Acquisition time: {}".format(out.shape, time() - t0))
         dfs.append(out)
@@ -429,47 +438,126 @@ def plot_candles(df, results=False):
         return handles
 
 
-def get_historical(file, freq, start=None, end=None):
+def epoch(date):
+    """
+    Epoch seconds from a date
+    :param date: str, datetime or number: Naive dates are taken as UTC, numbers as epoch seconds
+    :return: int: epoch seconds
+    """
+    if isinstance(date, (int, float, np.number)):
+        return int(date)
+    return pd.Timestamp(date).value // 10 ** 9
+
+
+def read_historical(file, start=None, end=None, chunksize=100000):
+    """
+    Stream minute bars from a historical csv file, as the Bitstamp and Kraken dumps.
+    Columns are taken by position: epoch Timestamp, open, high, low, close and volume; others are skipped.
+    Rows strictly between start and end are kept and missing values are forward filled across chunks.
+    :param file: path to csv file
+    :param start: start date
+    :param end: end date
+    :param chunksize: rows read per chunk
+    :return: generator: (n,) int64 epoch dates, (n, field) float bars in OHLC_FIELDS order
+    """
+    start = None if start is None else epoch(start)
+    end = None if end is None else epoch(end)
+    last = None
+
+    for chunk in pd.read_csv(file, usecols=range(6), chunksize=chunksize):
+        dates = chunk.iloc[:, 0].values.astype(np.int64)
+        ohlc = chunk.iloc[:, 1:].values.astype(np.float64)
+        del chunk
+
+        if end is not None and dates.shape[0] and dates[0] >= end:
+            break
+        keep = np.ones(dates.shape[0], dtype=bool)
+        if start is not None:
+            keep &= dates > start
+        if end is not None:
+            keep &= dates < end
+        dates, ohlc = dates[keep], ohlc[keep]
+        if not dates.shape[0]:
+            continue
+
+        # Forward fill, carrying the previous chunk last row
+        if last is not None:
+            ohlc[0] = np.where(np.isnan(ohlc[0]), last, ohlc[0])
+        ohlc = pd.DataFrame(ohlc).ffill().values
+        last = ohlc[-1].copy()
+
+        yield dates, np.where(np.isnan(ohlc), 1e-8, ohlc)
+
+
+def save_historical(file, path, freq, start=None, end=None, chunksize=100000):
+    """
+    Resample a historical csv file straight into a binary candle file, with constant memory
+    :param file: path to csv file
+    :param path: candle files path, without extension
+    :param freq: sample frequency in minutes
+    :param start: start date
+    :param end: end date
+    :param chunksize: rows read per chunk
+    :return: int: number of candles written
+    """
+    assert freq >= 1
+    with CandleWriter(path, period=freq) as writer:
+        for dates, ohlc in stream_resample(read_historical(file, start, end, chunksize), freq):
+            writer.write(dates, ohlc)
+    return writer.length
+
+
+def get_historical(file, freq, start=None, end=None, chunksize=100000):
     """
-    Gets historical data from csv file
+    Gets historical data from csv file.
+    Files are read in chunks and resampled incrementally; only the sampled bars are held in memory.
+    As pandas resample, periods without rows have nan prices and zero volume, and the index carries
+    the sample frequency.
 
     :param file: path to csv file
     :param freq: sample frequency
     :param start: start date
     :param end: end date
+    :param chunksize: rows read per chunk
     :return: sampled pandas DataFrame
     """
 
     assert freq >= 1
-    freq = "%dmin" % (freq)
 
     if isinstance(file, pd.core.frame.DataFrame):
         df = file
+        if start:
+            df = df.drop(df.loc[:start].index)
+        if end:
+            df = df.drop(df.loc[end:].index)
+        try:
+            df = df.drop(['Volume_(Currency)', 'Weighted_Price'], axis=1)
+        except:
+            pass
+        df = df.ffill().fillna(1e-8)
+        name = file.index.name
+        batches = [(df.index.values.astype(np.int64) // 10 ** 9, df.values.astype(np.float64))]
+    else:
+        name = 'Timestamp'
+        batches = read_historical(file, start, end, chunksize)
+
+    # Periods holding rows, as stream_resample fills the others with flat bars
+    step = freq * 60
+    filled = []
+
+    def track(batches):
+        for dates, ohlc in batches:
+            filled.append(np.unique(dates // step * step))
+            yield dates, ohlc
+
+    sampled = list(stream_resample(track(batches), freq))
+    if sampled:
+        dates, ohlc = np.concatenate([b[0] for b in sampled]), np.concatenate([b[1] for b in sampled])
+        ohlc[~np.isin(dates, np.concatenate(filled)), :4] = np.nan
     else:
-        df = pd.read_csv(file)
-        df['Timestamp'] = pd.to_datetime(df.Timestamp, infer_datetime_format=True, unit='s')
-        df.set_index('Timestamp', drop=True, inplace=True)
-    if start:
-        df = df.drop(df.loc[:start].index)
-    if end:
-        df = df.drop(df.loc[end:].index)
-    try:
-        df = df.drop(['Volume_(Currency)', 'Weighted_Price'], axis=1)
-        df = df.rename({'Volume_(BTC)': 'volume'})
-    except:
-        pass
-    df.columns = ['open', 'high', 'low', 'close', 'volume']
-
-    df.ffill(inplace=True)
-    df.fillna(1e-8, inplace=True)
-
-    index = df.resample(freq).first().index
-    out = pd.DataFrame(index=index)
-    out['open'] = df.resample(freq).first().open
-    out['high'] = df.resample(freq).max().high
-    out['low'] = df.resample(freq).min().low
-    out['close'] = df.resample(freq).last().close
-    out['volume'] = df.resample(freq).sum().volume
+        dates, ohlc = np.empty(0, dtype=np.int64), np.empty((0, len(OHLC_FIELDS)))
+    index = pd.DatetimeIndex(pd.to_datetime(dates, unit='s'), freq="%dmin" % freq, name=name)
+    out = pd.DataFrame(ohlc, index=index, columns=OHLC_FIELDS)
 
     return out.applymap(convert_to.decimal)
 
@@ -180,6 +180,22 @@ def simplex_proj(y):
     return np.maximum(y - tmax, 0.)
 
 
+def batch_simplex_proj(y):
+    """ Projection of each row of y onto simplex. Matches simplex_proj row by row. """
+    y = np.asarray(y, dtype=np.float64)
+    m = y.shape[-1]
+
+    s = -np.sort(-y, axis=-1)
+    tmax = (np.cumsum(s, axis=-1) - 1) / np.arange(1, m + 1)
+
+    # First position where the threshold reaches the next sorted value, last one if none does
+    stop = np.concatenate([tmax[..., :-1] >= s[..., 1:], np.ones_like(s[..., :1], dtype=bool)], axis=-1)
+    first = np.argmax(stop, axis=-1)[..., None]
+    tmax = np.where(np.arange(m) == first, tmax, 0.).sum(axis=-1, keepdims=True)
+
+    return np.maximum(y - tmax, 0.)
+
+
 def euclidean_proj_simplex(v, s=1):
     """ Compute the Euclidean projection on a positive simplex
     Solves the optimisation problem (using the algorithm from [1]):
@@ -279,10 +295,54 @@ def read(_socket, flags=0, block=True):
             return False
 
 
+def dtype_descr(dtype):
+    """json friendly numpy dtype description, keeping field names of record arrays"""
+    return dtype.descr if dtype.names else str(dtype)
+
+
+def descr_dtype(descr):
+    """numpy dtype from dtype_descr output"""
+    return np.dtype([tuple(field) for field in descr]) if isinstance(descr, list) else np.dtype(descr)
+
+
+def frame_array(md, msg):
+    """numpy array over a received buffer, without copying it"""
+    dtype = descr_dtype(md['dtype'])
+    if not int(np.prod(md['shape'])):
+        return np.empty(md['shape'], dtype=dtype)
+    return np.frombuffer(msg.buffer if isinstance(msg, zmq.Frame) else msg, dtype=dtype).reshape(md['shape'])
+
+
+def pack_frames(msg):
+    """msgpack message frames. Arrays in msg, or in a msg list, go on their own raw frames"""
+    arrays = []
+
+    def encode(item):
+        if isinstance(item, np.ndarray):
+            arrays.append(np.ascontiguousarray(item))
+            return {'__array__': len(arrays) - 1, 'dtype': dtype_descr(item.dtype), 'shape': item.shape}
+        return item
+
+    msg = [encode(item) for item in msg] if isinstance(msg, list) else encode(msg)
+    return [msgpack.packb(msg, use_bin_type=True)] + arrays
+
+
+def unpack_frames(frames):
+    """message from pack_frames frames, arrays over the received buffers"""
+    msg = msgpack.unpackb(frames[0].bytes if isinstance(frames[0], zmq.Frame) else frames[0], raw=False)
+
+    def decode(item):
+        if isinstance(item, dict) and '__array__' in item:
+            return frame_array(item, frames[1 + item['__array__']])
+        return item
+
+    return [decode(item) for item in msg] if isinstance(msg, list) else decode(msg)
+
+
 def send_array(socket, A, flags=0, copy=False, track=False, block=True):
     """send a numpy array with metadata"""
     md = dict(
-        dtype=str(A.dtype),
+        dtype=dtype_descr(A.dtype),
         shape=A.shape,
     )
     if block:
@@ -302,14 +362,14 @@ def recv_array(socket, flags=0, copy=False, track=False, block=True):
         md = socket.recv_json(flags=flags)
         msg = socket.recv(flags=flags, copy=copy, track=track)
         buf = bytearray(msg)
-        A = np.frombuffer(buf, dtype=md['dtype'])
+        A = np.frombuffer(buf, dtype=descr_dtype(md['dtype']))
         return A.reshape(md['shape'])
     else:
         try:
             md = socket.recv_json(flags=flags | zmq.NOBLOCK)
             msg = socket.recv(flags=flags | zmq.NOBLOCK, copy=copy, track=track)
             buf = bytearray(msg)
-            A = np.frombuffer(buf, dtype=md['dtype'])
+            A = np.frombuffer(buf, dtype=descr_dtype(md['dtype']))
             return A.reshape(md['shape'])
         except zmq.Again:
             return False
@@ -0,0 +1,120 @@
+"""
+Test fixed point accounting
+"""
+import pytest
+from hypothesis import given, strategies as st
+from hypothesis.extra.numpy import arrays
+import numpy as np
+from decimal import Decimal
+
+from cryptotrader.envs.accounting import FixedPointAccount, mul_div, rebalance, WEIGHT_SCALE
+
+
+@given(st.integers(min_value=-2 ** 62, max_value=2 ** 62),
+       st.integers(min_value=-2 ** 62, max_value=2 ** 62),
+       st.integers(min_value=1, max_value=2 ** 62))
+def test_mul_div(a, b, d):
+    prod = a * b
+    if abs(prod // d) < 2 ** 63 and abs(-(-prod // d)) < 2 ** 63:
+        assert mul_div(a, b, d) == prod // d
+        assert mul_div(a, b, d, round_up=True) == -(-prod // d)
+
+
+def test_account_conversions():
+    account = FixedPointAccount(['BTC', 'ETH', 'USDT'], {'BTC': 8, 'ETH': 6, 'USDT': 8})
+    account.set('BTC', Decimal('0.123456789'))
+    account.set('ETH', '1.5')
+    account.set('USDT', 100.)
+
+    assert list(account.units) == [12345679, 1500000, 10000000000]
+    assert account.get('ETH') == Decimal('1.5')
+    assert list(account.price_units([3500.12345678, 300.5])) == [350012345678, 30050000000]
+
+
+@given(arrays(dtype=np.float64, shape=4, elements=st.floats(min_value=0., max_value=1e3)))
+def test_to_weights(action):
+    account = FixedPointAccount(['BTC', 'ETH', 'LTC', 'USDT'], 8)
+    if action.sum() > 0:
+        weights = account.to_weights(action)
+        assert weights.sum() == WEIGHT_SCALE
+        assert (weights >= 0).all()
+    else:
+        with pytest.raises(AssertionError):
+            account.to_weights(action)
+
+
+@given(arrays(dtype=np.float64, shape=3, elements=st.floats(min_value=0., max_value=1.)),
+       arrays(dtype=np.float64, shape=2, elements=st.floats(min_value=1e-4, max_value=1e5)))
+def test_rebalance(action, prices):
+    account = FixedPointAccount(['BTC', 'ETH', 'USDT'], 8)
+    account.set('USDT', '1000')
+    action[-1] += 1e-3
+
+    prices = account.price_units(prices)
+    rates = account.rate_units(['0.0025', '0.0025'])
+    portval = account.portval(prices)
+    fees = account.rebalance(account.to_weights(action), prices, rates)
+
+    # Balances stay positive and rounding never creates value
+    assert (account.units >= 0).all()
+    assert (fees >= 0).all()
+    assert account.portval(prices) <= portval - fees.sum()
+
+
+def sequential_rebalance(holdings, prices, weights, fees):
+    # Loop reference, as in the original simulate_trade
+    holdings = holdings.copy()
+    portval = (holdings[:-1] * prices).sum() + holdings[-1]
+    change = weights[:-1] - holdings[:-1] * prices / portval
+
+    for i in range(prices.shape[0]):
+        if change[i] < 0:
+            holdings[-1] += portval * -change[i] * (1 - fees[i])
+            holdings[i] = portval * weights[i] / prices[i]
+
+    portval = (holdings[:-1] * prices).sum() + holdings[-1]
+    for i in range(prices.shape[0]):
+        if change[i] > 0:
+            holdings[-1] -= portval * change[i]
+            if holdings[-1] < 0:
+                portval += holdings[-1]
+                holdings[-1] = 0
+            holdings[i] = (portval * weights[i] - portval * change[i] * fees[i]) / prices[i]
+    return holdings
+
+
+@given(arrays(dtype=np.float64, shape=4, elements=st.floats(min_value=0., max_value=1e2)),
+       arrays(dtype=np.float64, shape=4, elements=st.floats(min_value=0., max_value=1.)),
+       arrays(dtype=np.float64, shape=3, elements=st.floats(min_value=1e-2, max_value=1e3)),
+       st.floats(min_value=0., max_value=0.01))
+def test_rebalance_kernel(holdings, weights, prices, fee):
+    holdings[-1] += 1.
+    weights[0] += 1e-3
+    weights /= weights.sum()
+    fees = np.full(3, fee)
+
+    new_holdings, fees_paid = rebalance(holdings, prices, weights, fees)
+    assert np.allclose(new_holdings, sequential_rebalance(holdings, prices, weights, fees), rtol=1e-9, atol=1e-9)
+    assert (new_holdings >= -1e-9).all()
+    assert (fees_paid >= 0).all()
+
+    # Batch call matches single calls
+    batch, _ = rebalance(np.stack([holdings, new_holdings]), prices, weights[::-1], fees)
+    assert np.allclose(batch[1], rebalance(new_holdings, prices, weights[::-1], fees)[0])
+
+
+def test_rebalance_kernel_decimal():
+    holdings = np.array([Decimal('0'), Decimal('0'), Decimal('100')], dtype=Decimal)
+    prices = np.array([Decimal('4000'), Decimal('300')], dtype=Decimal)
+    weights = np.array([Decimal('0.5'), Decimal('0.5'), Decimal('0')], dtype=Decimal)
+    fees = np.array([Decimal('0.0025'), Decimal('0.0025')], dtype=Decimal)
+
+    new_holdings, fees_paid = rebalance(holdings, prices, weights, fees)
+    assert all(isinstance(value, Decimal) for value in new_holdings[:-1])
+    assert new_holdings[-1] == 0
+    assert fees_paid.sum() > 0
+    assert new_holdings[0] * prices[0] + new_holdings[1] * prices[1] + fees_paid.sum() <= Decimal('100')
+
+
+if __name__ == '__main__':
+    pytest.main()
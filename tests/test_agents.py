@@ -0,0 +1,122 @@
+"""
+Test apriori agents
+"""
+import os
+import shutil
+import pytest
+import numpy as np
+import pandas as pd
+from cryptotrader.envs.trading import BacktestEnvironment, BacktestDataFeed
+from cryptotrader.envs.batch import BatchBacktestEnvironment
+from cryptotrader.agents.apriori import PAMR, OLMAR, STMR, Momentum, CWMR, TCO
+from cryptotrader.agents.parallel import stack_params
+
+from .mocks import *
+
+
+def make_feed():
+    feed = BacktestDataFeed(tapi, period=5, pairs=["USDT_BTC", "USDT_ETH"], balance={"BTC": '0.00000000',
+                                                                                     "ETH": '0.00000000',
+                                                                                     "USDT": '100.00000000'})
+    df = pd.DataFrame.from_records(chart_data).set_index('date', drop=False)
+    feed.ohlc_data["USDT_BTC"] = df
+
+    # A second pair with its own moves, so agents weight pairs apart
+    df = df.copy()
+    drift = np.exp(np.cumsum(np.random.RandomState(0).randn(df.shape[0]) * 0.01))
+    for field in ['open', 'high', 'low', 'close']:
+        df[field] = (df[field].astype(np.float64) * drift).round(8)
+    feed.ohlc_data["USDT_ETH"] = df
+
+    feed.data_length = len(chart_data)
+    feed.build_arrays()
+    return feed
+
+
+@pytest.fixture
+def env():
+    yield BacktestEnvironment(period=5, obs_steps=8, tapi=make_feed(), fiat="USDT", name='agent_test')
+    shutil.rmtree(os.path.join(os.path.abspath(os.path.curdir), 'logs'))
+
+
+def assert_batch_matches_serial(agent, env, params, n_steps=18):
+    """ Each batch portfolio takes the actions and rewards of a serial run with its parameter set """
+    batch_env = BatchBacktestEnvironment(env)
+    agent.fiat = env._fiat
+
+    obs = batch_env.reset(len(params))
+    agent.step = 0
+    batch_actions = []
+    for _ in range(n_steps):
+        batch_actions.append(agent.batch_rebalance(obs, stack_params(params)))
+        obs = batch_env.step(batch_actions[-1])[0]
+        agent.step += 1
+    batch_actions = np.array(batch_actions)
+
+    for k, kwargs in enumerate(params):
+        agent.set_params(**kwargs)
+        obs = env.reset(reset_dfs=True)
+        agent.step = 0
+        for batch_action in batch_actions[:, k]:
+            action = np.asarray(agent.rebalance(obs), dtype=np.float64)
+            assert np.allclose(action, batch_action, atol=1e-5)
+            obs = env.step(action)[0]
+            agent.step += 1
+
+    # Parameter sets trade apart
+    assert np.ptp(batch_actions, axis=1).max() > 1e-3
+
+    rewards = agent.batch_test(BatchBacktestEnvironment(env), stack_params(params))
+    for k, kwargs in enumerate(params):
+        agent.set_params(**kwargs)
+        assert np.isclose(agent.test(env), rewards[k], rtol=1e-4)
+
+
+def test_pamr_batch(env):
+    assert_batch_matches_serial(PAMR(), env, [{'sensitivity': 0.01, 'C': 10, 'variant': 'PAMR0'},
+                                              {'sensitivity': 0.001, 'C': 2444, 'variant': 'PAMR1'},
+                                              {'sensitivity': 0.03, 'C': 5, 'variant': 'PAMR2'}])
+
+
+def test_olmar_batch(env):
+    assert_batch_matches_serial(OLMAR(), env, [{'eps': 0.02, 'window': 3, 'smooth': 0.5},
+                                               {'eps': 0.1, 'window': 7, 'smooth': 1.},
+                                               {'eps': 0.01, 'window': 5, 'smooth': 0.2}])
+
+
+def test_stmr_batch(env):
+    assert_batch_matches_serial(STMR(), env, [{'sensitivity': 0.001}, {'sensitivity': 0.01}, {'sensitivity': 0.05}])
+
+
+def test_momentum_batch(env):
+    assert_batch_matches_serial(Momentum(), env, [{'alpha_v': 1., 'alpha_a': 1., 'mean_type': 'simple', 'ma1': 2,
+                                                   'ma2': 3, 'std_span': 3, 'sensitivity': 0.01},
+                                                  {'alpha_v': 1., 'alpha_a': 0.5, 'mean_type': 'exp', 'ma1': 2,
+                                                   'ma2': 5, 'std_span': 4, 'sensitivity': 0.05},
+                                                  {'alpha_v': 2., 'alpha_a': 2., 'mean_type': 'simple', 'ma1': 3,
+                                                   'ma2': 4, 'std_span': 3, 'sensitivity': 0.1}])
+
+
+def test_cwmr_batch(env):
+    assert_batch_matches_serial(CWMR(), env, [{'eps': 0.5, 'confidence': 0.95},
+                                              {'eps': 0.1, 'confidence': 0.8},
+                                              {'eps': 1., 'confidence': 0.99}])
+
+
+def test_tco_batch(env):
+    assert_batch_matches_serial(TCO(predictor=PAMR()), env, [{'toff': 0.01, 'sensitivity': 0.01, 'variant': 'PAMR1'},
+                                                             {'toff': 0.1, 'sensitivity': 0.001, 'variant': 'PAMR1'},
+                                                             {'toff': 0.001, 'sensitivity': 0.03, 'variant': 'PAMR1'}])
+
+
+def test_parallel_fit(env):
+    # Seeded serial and parallel fits evaluate the same points on the same episodes
+    fits = [STMR().fit(env, 12, 2, {'sensitivity': [0.001, 0.1]}, verbose=0, n_workers=n_workers, seed=42)
+            for n_workers in (1, 2)]
+    assert fits[0][0] == fits[1][0]
+    assert fits[0][1].optimum == fits[1][1].optimum
+    assert fits[0][1].stats['num_evals'] == fits[1][1].stats['num_evals']
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,586 @@
+"""
+Test backtest engine
+"""
+import os
+import shutil
+import threading
+from time import sleep, time
+import pytest
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+from datetime import datetime, timedelta, timezone
+from cryptotrader.envs.trading import BacktestEnvironment, BacktestDataFeed
+from cryptotrader.envs.buffers import RollingWindow, Ledger
+from cryptotrader.envs.batch import BatchBacktestEnvironment
+from cryptotrader.datafeed import CandleCache, CandleWriter, OHLC_FIELDS, save_candles, load_header, load_arrays, \
+    PaperTradingDataFeed, DataFeed
+from cryptotrader.exceptions import ExchangeError
+
+from .mocks import *
+
+
+def make_feed():
+    feed = BacktestDataFeed(tapi, period=5, pairs=["USDT_BTC", "USDT_ETH"], balance={"BTC": '0.00000000',
+                                                                                     "ETH": '0.00000000',
+                                                                                     "USDT": '100.00000000'})
+    for pair in feed.pairs:
+        feed.ohlc_data[pair] = pd.DataFrame.from_records(chart_data).set_index('date', drop=False)
+    feed.data_length = len(chart_data)
+    feed.build_arrays()
+    return feed
+
+
+# Fixtures
+@pytest.fixture
+def envs():
+    yield [BacktestEnvironment(period=5, obs_steps=5, tapi=make_feed(), fiat="USDT", name='env_test',
+                               columnar=columnar) for columnar in (False, True)]
+    shutil.rmtree(os.path.join(os.path.abspath(os.path.curdir), 'logs'))
+
+
+@pytest.fixture
+def rolling_envs():
+    yield [BacktestEnvironment(period=5, obs_steps=5, tapi=make_feed(), fiat="USDT", name='env_test',
+                               columnar=columnar, rolling=rolling) for columnar, rolling in ((False, False),
+                                                                                             (False, True),
+                                                                                             (True, True))]
+    shutil.rmtree(os.path.join(os.path.abspath(os.path.curdir), 'logs'))
+
+
+def test_build_arrays():
+    feed = make_feed()
+    assert feed.ohlc_array.shape == (len(chart_data), 2, 5)
+    assert feed.ohlc_array.flags['C_CONTIGUOUS']
+    assert feed.dates.dtype == np.int64
+    assert feed.ohlc_array[3, 0, 0] == float(chart_data[3]['open'])
+    assert feed.ohlc_array[3, 1, 4] == float(chart_data[3]['volume'])
+
+    dates, ohlc = feed.get_window(9, 4)
+    assert ohlc.base is feed.ohlc_array
+    assert list(dates) == [item['date'] for item in chart_data[6:10]]
+
+
+def test_get_range():
+    feed = make_feed()
+    dates = feed.dates
+    assert feed.get_rows(dates[2], dates[5]) == slice(2, 6)
+    assert feed.get_rows(dates[2] - 1, dates[5] + 1) == slice(2, 6)
+    assert feed.get_rows() == slice(None, None)
+
+    range_dates, ohlc = feed.get_range("USDT_ETH", dates[2], dates[5])
+    assert ohlc.base is feed.ohlc_array
+    assert (range_dates == dates[2:6]).all()
+    assert (ohlc == feed.ohlc_array[2:6, 1]).all()
+    assert [item['date'] for item in feed.returnChartData("USDT_ETH", 300, dates[2], dates[5])] == list(dates[2:6])
+
+
+def test_resample():
+    feed = make_feed()
+    feeds = feed.resample(15, 30)
+    assert sorted(feeds) == [15, 30]
+
+    for period, resampled in feeds.items():
+        assert resampled.period == period
+        assert resampled.pairs == feed.pairs
+        assert resampled.data_length == resampled.dates.shape[0] > 0
+        assert resampled.ohlc_array.flags['C_CONTIGUOUS']
+        assert (resampled.dates % (period * 60) == 0).all()
+
+        # Every bin is complete and aggregates its base bars
+        for i, date in enumerate(resampled.dates):
+            rows = (feed.dates >= date) & (feed.dates < date + period * 60)
+            assert rows.sum() == period // feed.period
+            bars = feed.ohlc_array[rows]
+            assert (resampled.ohlc_array[i, :, 0] == bars[0, :, 0]).all()
+            assert (resampled.ohlc_array[i, :, 1] == bars[:, :, 1].max(axis=0)).all()
+            assert (resampled.ohlc_array[i, :, 2] == bars[:, :, 2].min(axis=0)).all()
+            assert (resampled.ohlc_array[i, :, 3] == bars[-1, :, 3]).all()
+            assert np.allclose(resampled.ohlc_array[i, :, 4], bars[:, :, 4].sum(axis=0))
+
+        assert list(resampled.ohlc_data[feed.pairs[0]].index) == list(resampled.dates)
+
+    # Periods without a complete bin get empty feeds
+    empty = feed.resample(5 * len(chart_data))[5 * len(chart_data)]
+    assert empty.data_length == empty.dates.shape[0] == 0
+    assert empty.ohlc_array.shape == (0, 2, 5) and empty.synthetic.shape == (0, 2)
+    assert empty.ohlc_data[feed.pairs[0]].empty
+
+
+def test_binary_store(tmpdir):
+    feed = make_feed()
+    feed.save_data(str(tmpdir), binary=True)
+
+    loaded = BacktestDataFeed(tapi, period=5, pairs=feed.pairs, load_dir=str(tmpdir))
+    loaded.load_data('')
+    assert loaded.data_length == feed.data_length
+    assert (loaded.dates == feed.dates).all()
+    assert (loaded.ohlc_array == feed.ohlc_array).all()
+    assert (loaded.ohlc_data[feed.pairs[0]].index == feed.ohlc_data[feed.pairs[0]].index).all()
+    assert loaded.returnChartData(feed.pairs[0], 300, feed.dates[2], feed.dates[4])[1]['open'] == \
+           float(feed.returnChartData(feed.pairs[0], 300, feed.dates[2], feed.dates[4])[1]['open'])
+
+    # Columnar arrays and frames prices are views over the mapped file
+    dates, ohlc, synthetic = load_arrays(str(tmpdir.join('arrays_5min')))
+    assert isinstance(loaded.ohlc_array, np.memmap) and loaded.ohlc_array.filename == ohlc.filename
+    assert np.shares_memory(loaded.ohlc_data[feed.pairs[1]]['close'].values, loaded.ohlc_array)
+    assert (loaded.synthetic == feed.synthetic).all()
+    for pair in feed.pairs:
+        assert sorted(loaded.ohlc_data[pair].columns) == sorted(feed.ohlc_data[pair].columns)
+        assert (loaded.ohlc_data[pair]['quoteVolume'].values == feed.ohlc_data[pair]['quoteVolume'].values
+                .astype(np.float64)).all()
+
+    # Pickled copies map the file again, feeds with other pairs build their arrays
+    state = loaded.__getstate__()
+    assert state['ohlc_data'] is None and state['ohlc_array'] is None
+    copy = BacktestDataFeed.__new__(BacktestDataFeed)
+    copy.__setstate__(state)
+    assert isinstance(copy.ohlc_array, np.memmap) and (copy.ohlc_array == loaded.ohlc_array).all()
+    assert copy.ohlc_data[feed.pairs[0]].equals(loaded.ohlc_data[feed.pairs[0]])
+    other = BacktestDataFeed(tapi, period=5, pairs=feed.pairs[:1], load_dir=str(tmpdir))
+    other.load_data('')
+    assert not isinstance(other.ohlc_array, np.memmap) and (other.ohlc_array == feed.ohlc_array[:, :1]).all()
+
+
+def test_candle_writer(tmpdir):
+    feed = make_feed()
+    df = feed.ohlc_data[feed.pairs[0]]
+    path = str(tmpdir.join('written'))
+
+    with CandleWriter(path, period=5) as writer:
+        for rows in np.array_split(np.arange(feed.data_length), 4):
+            writer.write(feed.dates[rows], feed.ohlc_array[rows, 0])
+    save_candles(df[['date'] + OHLC_FIELDS].astype({field: np.float64 for field in OHLC_FIELDS}), str(tmpdir.join('saved')))
+
+    assert open(path + '.bin', 'rb').read() == open(str(tmpdir.join('saved')) + '.bin', 'rb').read()
+    assert load_header(path) == dict(period=5, length=feed.data_length, fields=OHLC_FIELDS)
+    assert sorted(os.listdir(str(tmpdir))) == ['saved.bin', 'saved.header.json', 'written.bin', 'written.header.json']
+
+    # Failed streams leave the previous file in place
+    with pytest.raises(ValueError):
+        with CandleWriter(path) as writer:
+            writer.write(feed.dates[:2], feed.ohlc_array[:2, 0])
+            raise ValueError
+    assert load_header(path)['length'] == feed.data_length
+    assert len(os.listdir(str(tmpdir))) == 4
+
+
+def test_pair_reciprocal():
+    calls = []
+
+    def returnChartData(currencyPair, period, start=None, end=None):
+        calls.append(currencyPair)
+        if currencyPair != "USDT_BTC":
+            raise ExchangeError('Invalid currency pair.')
+        return chart_data
+
+    feed = PaperTradingDataFeed(mock.Mock(returnChartData=returnChartData), period=5, pairs=["BTC_USDT"])
+    for _ in range(2):
+        records = feed.returnChartData("BTC_USDT", 300)
+    # The failing request is made once
+    assert calls == ["BTC_USDT", "USDT_BTC", "USDT_BTC"]
+
+    for record, item in zip(records, chart_data):
+        assert record['open'] == round(1 / float(item['open']), 8)
+        assert record['high'] == round(1 / float(item['low']), 8)
+        assert record['low'] == round(1 / float(item['high']), 8)
+        assert record['volume'] == float(item['quoteVolume']) and record['quoteVolume'] == float(item['volume'])
+        assert record['date'] == item['date']
+
+    df = feed.pair_reciprocal(pd.DataFrame.from_records(chart_data))
+    assert list(df.columns) == list(pd.DataFrame.from_records(chart_data).columns)
+    assert (df[['open', 'high', 'low', 'close', 'volume']].values ==
+            pd.DataFrame.from_records(records)[['open', 'high', 'low', 'close', 'volume']].values).all()
+    assert np.isnan(feed.reciprocal_records([{'close': '0'}])[0]['close'])
+
+    # Only an unlisted pair is inverted, other errors are raised
+    def failing(currencyPair, period, start=None, end=None):
+        raise ExchangeError('Please do not make more than 6 API calls per second.')
+
+    feed = BacktestDataFeed(mock.Mock(returnChartData=failing), period=5, pairs=["USDT_BTC"])
+    with pytest.raises(ExchangeError):
+        feed.fetch_candles("USDT_BTC")
+    assert not feed._inverted
+
+    feed.tapi.returnChartData = returnChartData
+    assert (feed.fetch_candles("BTC_USDT")['date'].values == [item['date'] for item in chart_data]).all()
+    assert feed._inverted == {"BTC_USDT"}
+
+
+def test_candle_cache(tmpdir):
+    assert CandleCache.missing_ranges([[10, 20], [30, 40]], 0, 50) == [[0, 9], [21, 29], [41, 50]]
+    assert CandleCache.missing_ranges([[10, 20]], 12, 18) == []
+    assert CandleCache.merge_ranges([[30, 40], [0, 9], [10, 20]]) == [[0, 20], [30, 40]]
+
+    calls = []
+    def fetch(pair, start, end):
+        calls.append((start, end))
+        return pd.DataFrame.from_records([item for item in chart_data if start <= item['date'] <= end] or
+                                         [{'date': 0, 'open': 0}])
+
+    cache = CandleCache(str(tmpdir), 'exchange', 5, chunk_size=10)
+    start, end = chart_data[0]['date'], chart_data[-1]['date']
+    middle = chart_data[len(chart_data) // 2]['date']
+
+    df = cache.update('USDT_BTC', fetch, start, middle)
+    assert list(df['date']) == [item['date'] for item in chart_data if item['date'] <= middle]
+    assert all(call_end - call_start < 10 * 5 * 60 for call_start, call_end in calls)
+
+    # Only the missing range is downloaded
+    calls.clear()
+    df = cache.update('USDT_BTC', fetch, start, end)
+    assert calls[0][0] == middle + 1
+    assert list(df['date']) == [item['date'] for item in chart_data]
+    assert (df['open'].values == [float(item['open']) for item in chart_data]).all()
+
+    calls.clear()
+    cache.update('USDT_BTC', fetch, start, end)
+    assert not calls
+
+    # The open candle is fetched again until it closes
+    now = int(time())
+    live = [{'date': date, 'open': date} for date in range(now // 300 * 300 - 3000, now, 300)]
+
+    def fetch_live(pair, start, end):
+        calls.append((start, end))
+        return pd.DataFrame.from_records([item for item in live if start <= item['date'] <= end])
+
+    cache.update('USDT_ETH', fetch_live, now - 3000, now)
+    live[-1]['open'] = -1
+    calls.clear()
+    df = cache.update('USDT_ETH', fetch_live, now - 3000, now)
+    assert calls == [(live[-1]['date'], now)] and df['open'].values[-1] == -1
+
+
+def test_map_requests():
+    feed = make_feed()
+    threads = set()
+
+    def request(pair, delay):
+        threads.add(threading.get_ident())
+        sleep(delay)
+        return pair
+
+    calls = [(pair, 0.05 * (4 - i)) for i, pair in enumerate(["USDT_BTC", "USDT_ETH", "USDT_LTC", "USDT_XMR"])]
+    assert feed.map_requests(request, calls, n_threads=4) == [pair for pair, _ in calls]
+    assert len(threads) > 1
+    assert feed.map_requests(request, calls[:1], n_threads=4) == ["USDT_BTC"]
+
+    # Successive calls share the connection rate limiter
+    waits = []
+    feed.coach.wait = lambda: waits.append(1)
+    for _ in range(2):
+        feed.map_requests(request, calls, n_threads=4)
+    assert len(waits) == 2 * len(calls)
+
+    # zmq feeds run in sequence
+    threads.clear()
+    socket_feed = DataFeed(5, feed.pairs, exchange='exchange', addr='inproc://unused')
+    assert socket_feed.map_requests(request, calls, n_threads=4) == [pair for pair, _ in calls]
+    assert threads == {threading.get_ident()}
+    socket_feed.close()
+
+
+def test_share_memory():
+    feed = make_feed()
+    ohlc = feed.ohlc_array.copy()
+    feed.share_memory()
+    assert (feed.ohlc_array == ohlc).all()
+
+    # Pickled state carries the shared buffers only
+    state = feed.__getstate__()
+    assert state['ohlc_data'] is None and state['ohlc_array'] is None
+
+    copy = BacktestDataFeed.__new__(BacktestDataFeed)
+    copy.__setstate__(state)
+    assert np.shares_memory(copy.ohlc_array, feed.ohlc_array)
+    assert (copy.dates == feed.dates).all()
+    for pair in feed.pairs:
+        assert (copy.ohlc_data[pair]['open'].values == ohlc[:, feed.pairs.index(pair), 0]).all()
+        assert (copy.ohlc_data[pair].index == feed.ohlc_data[pair].index).all()
+        # Workers see the same frames as the parent process, other fields included
+        assert list(copy.ohlc_data[pair].columns) == list(feed.ohlc_data[pair].columns)
+        assert (copy.ohlc_data[pair].dtypes == feed.ohlc_data[pair].dtypes).all()
+        assert copy.ohlc_data[pair].equals(feed.ohlc_data[pair])
+        assert (copy.ohlc_data[pair]['quoteVolume'].values ==
+                [float(item['quoteVolume']) for item in chart_data]).all()
+
+
+def test_gap_fill():
+    feed = BacktestDataFeed(tapi, period=5, pairs=["USDT_BTC", "USDT_ETH"])
+    for i, pair in enumerate(feed.pairs):
+        df = pd.DataFrame.from_records(chart_data).set_index('date', drop=False)
+        # Missing periods common to all pairs and bars without prices
+        df = df.drop(df.index[[10, 11]])
+        df.iloc[[0, 5 + i], df.columns.get_indexer(OHLC_FIELDS)] = np.nan
+        feed.ohlc_data[pair] = df
+    feed.data_length = len(chart_data) - 2
+    feed.build_arrays()
+
+    assert feed.data_length == len(chart_data)
+    assert (np.diff(feed.dates) == 300).all()
+    assert not np.isnan(feed.ohlc_array).any()
+    assert list(np.flatnonzero(feed.synthetic[:, 0])) == [0, 5, 10, 11]
+    assert list(np.flatnonzero(feed.synthetic[:, 1])) == [0, 6, 10, 11]
+
+    btc = feed.ohlc_array[:, 0]
+    assert (btc[0, :4] == float(chart_data[1]['close'])).all()
+    assert (btc[5, :4] == btc[4, 3]).all() and (btc[[10, 11], :4] == btc[9, 3]).all()
+    assert (btc[feed.synthetic[:, 0], 4] == 0).all()
+    assert (feed.ohlc_data["USDT_BTC"]['close'].values == btc[:, 3]).all()
+
+    # Other fields are kept, synthetic bars trade nothing
+    df = feed.ohlc_data["USDT_BTC"]
+    assert df['quoteVolume'].values[1] == float(chart_data[1]['quoteVolume'])
+    assert (df['quoteVolume'].values[feed.synthetic[:, 0]] == 0).all()
+    assert (df['weightedAverage'].values[feed.synthetic[:, 0]] == btc[feed.synthetic[:, 0], 3]).all()
+    assert not df.isnull().values.any()
+    assert list(feed.get_synthetic("USDT_ETH", feed.dates[5], feed.dates[7])) == [False, True, False]
+
+    # Mask travels with shared memory
+    feed.share_memory()
+    copy = BacktestDataFeed.__new__(BacktestDataFeed)
+    copy.__setstate__(feed.__getstate__())
+    assert np.shares_memory(copy.synthetic, feed.synthetic)
+    assert (copy.synthetic == feed.synthetic).all()
+
+    # Environments see the filled bars and which ones are synthetic
+    env = BacktestEnvironment(period=5, obs_steps=5, tapi=feed, fiat="USDT", name='env_test')
+    index = pd.date_range(end=pd.Timestamp(int(feed.dates[12]), unit='s', tz='utc'), periods=5, freq='5T')
+    df = env.get_ohlc("USDT_BTC", index)
+    assert list(df.columns) == OHLC_FIELDS and df.index.equals(index)
+    assert list(env.synthetic["USDT_BTC"].values) == [False, False, True, True, False]
+
+    # Bars beyond the data are synthetic as well
+    index = pd.date_range(start=pd.Timestamp(int(feed.dates[-2]), unit='s', tz='utc'), periods=4, freq='5T')
+    df = env.get_ohlc("USDT_BTC", index)
+    assert df.shape[0] == 4 and (df['close'].astype(float) == btc[-1, 3]).all()
+    assert list(env.synthetic["USDT_BTC"].values) == [False, False, True, True]
+
+
+def test_price_relatives(envs):
+    env, col_env = envs
+    relatives = env.tapi.price_relatives
+    opens = env.tapi.ohlc_array[:, :, 0]
+    assert relatives is env.tapi.price_relatives
+    assert (relatives[0] == 1.).all()
+    assert np.allclose(relatives[1:], opens[1:] / opens[:-1])
+
+    for test_env in envs:
+        test_env.reset()
+        test_env.step(np.array([0.3, 0.5, 0.2]))
+        hindsight = test_env.get_price_relatives()
+        assert hindsight.shape == (env.tapi.data_length, 3)
+        assert (hindsight[:, -1] == 1.).all()
+
+        # Bounded slices match the history frame
+        index = test_env.get_index()
+        history = test_env.get_history(index[0], index[-1]).xs('open', level=1, axis=1).values.astype(np.float64)
+        assert np.allclose(test_env.get_price_relatives(index[0], index[-1])[1:, :-1], history[1:] / history[:-1])
+
+
+def test_columnar_observation(envs):
+    env, col_env = envs
+    obs = env.reset()
+    col_obs = col_env.reset()
+
+    assert (obs.columns == col_obs.columns).all()
+    assert (obs.index == col_obs.index).all()
+    assert (obs.values == col_obs.values).all()
+    assert col_env.get_open_price('BTC') == env.get_open_price('BTC')
+    assert isinstance(col_env.get_open_price('BTC'), Decimal)
+
+
+def test_columnar_step(envs):
+    env, col_env = envs
+    env.reset()
+    col_env.reset()
+
+    action = np.array([0.3, 0.5, 0.2])
+    for _ in range(5):
+        obs, reward, _, _ = env.step(action)
+        col_obs, col_reward, _, _ = col_env.step(action)
+
+        assert (obs.values == col_obs.values).all()
+        assert reward == col_reward
+        assert env.calc_total_portval() == col_env.calc_total_portval()
+
+
+def test_rolling_window():
+    window = RollingWindow(["USDT_BTC", "USDT_ETH"], "USDT", 3, 5)
+    assert window.columns.shape[0] == 13
+    assert list(window.portfolio_cols) == [5, 11, 12]
+
+    index = pd.date_range(start=pd.Timestamp(1500000000, unit='s', tz='UTC'), periods=4, freq='5T')
+    obs = pd.DataFrame(np.arange(4 * 13, dtype=np.float64).reshape(4, 13), index=index, columns=window.columns)
+    window.fill(obs)
+    assert (window.to_frame().values == obs.values[1:]).all()
+    assert window.last_date == 1500000900
+
+    # Refresh last bar in place
+    window.push(1500000900, np.ones((2, 5)))
+    assert window.values[-1, 0] == 1.
+    assert window.values[-1, 5] == obs.values[-1, 5]
+
+    # Append new bars and check the view stays ordered and contiguous
+    for i in range(4):
+        window.push(1500001200 + 300 * i, np.full((2, 5), i, dtype=np.float64))
+        window.set_portfolio(1500001200 + 300 * i + 10, 2, float(i))
+        assert window.values.flags['C_CONTIGUOUS']
+        assert list(np.diff(window.dates)) == [300, 300]
+        assert window.values[-1, 0] == i
+        assert window.values[-1, 12] == i
+        assert window.values[-1, 5] == obs.values[-1, 5]
+
+    frame = window.to_frame()
+    assert frame.index[-1] == pd.Timestamp(1500002100, unit='s', tz='UTC')
+    assert list(frame['USDT', 'USDT']) == [1., 2., 3.]
+
+
+def test_ledger():
+    ledger = Ledger(2)
+    df = pd.DataFrame()
+    index = pd.date_range(start=pd.Timestamp(1500000000, unit='s', tz='UTC'), periods=5, freq='5T')
+    for i, timestamp in enumerate(index):
+        for column in ['BTC', 'USDT'] + (['portval'] if i > 1 else []):
+            ledger.set(timestamp, column, Decimal(i))
+            df.at[timestamp, column] = Decimal(i)
+    ledger.set(index[1], 'BTC', Decimal('0.5'))
+    df.at[index[1], 'BTC'] = Decimal('0.5')
+
+    frame = ledger.to_frame()
+    assert len(ledger) == 5
+    assert frame.index.equals(df.index)
+    assert list(frame.columns) == list(df.columns)
+    assert (frame.fillna(-1).values == df.fillna(-1).values).all()
+    assert ledger.iget(-4, 'BTC') == Decimal('0.5')
+    assert ledger.get(index[3], 'portval') == Decimal(3)
+    assert ledger.timestamp(-1) == index[-1]
+    with pytest.raises(IndexError):
+        ledger.iget(5, 'BTC')
+
+    # Last valid values skip NaN cells and older rows rewrites
+    ledger.set(index[-1] + pd.Timedelta(minutes=5), 'portval', Decimal(7))
+    ledger.set(index[0], 'BTC', Decimal(9))
+    assert ledger.last_valid('BTC') == Decimal(4)
+    assert ledger.last_valid('portval') == Decimal(7)
+    with pytest.raises(KeyError):
+        ledger.last_valid('ETH')
+
+    loaded = Ledger.from_frame(df)
+    assert (loaded.to_frame().fillna(-1).values == df.fillna(-1).values).all()
+    assert Ledger().to_frame().shape == pd.DataFrame().shape
+
+
+def test_ledger_sample():
+    ledger = Ledger(4)
+    rng = np.random.RandomState(0)
+    timestamp = pd.Timestamp(1500000000, unit='s', tz='UTC')
+    for i in range(50):
+        timestamp += pd.Timedelta(minutes=int(rng.choice([1, 5, 30, 200])))
+        for column in ['BTC', 'ETH', 'USDT']:
+            if rng.rand() < 0.7:
+                ledger.set(timestamp, column, Decimal(int(rng.randint(100))))
+    df = ledger.to_frame()
+
+    for period in (5, 7, 30):
+        for start, end in ((None, None), (df.index[10], df.index[30]), (df.index[0], df.index[0]),
+                           (df.index[-1] + pd.Timedelta(minutes=1), None)):
+            sampled = ledger.sample(period, start, end)
+            expected = df.loc[start:end].resample('%dmin' % period).last()
+            assert sampled.index.equals(expected.index)
+            assert sampled.index.freq == expected.index.freq
+            assert list(sampled.columns) == list(expected.columns)
+            assert (sampled.fillna(-1).values == expected.fillna(-1).values).all()
+
+    # Filled samples on period windows, as the columnar observation reads them
+    for period in (5, 30):
+        for start in (df.index[5], df.index[20], df.index[-1]):
+            index = pd.date_range(start=start.floor('%dmin' % period), periods=8, freq='%dmin' % period)
+            filled = ledger.sample_filled(period, index.asi8, ['USDT', 'BTC'])
+            expected = ledger.sample(period, index[0], index[-1]).reindex(index)[['USDT', 'BTC']].ffill().bfill()
+            assert (pd.DataFrame(filled).fillna(-1).values == expected.fillna(-1).values).all()
+    index = pd.date_range(start=df.index[-1].ceil('5min'), periods=8, freq='5min')
+    assert ledger.sample_filled(5, index.asi8, ['BTC']) is None
+    assert ledger.sample_filled(5, df.index[:1].asi8, ['LTC']) is None
+
+
+def test_time_axis(envs):
+    for env in envs:
+        env.reset()
+        assert env.epoch == env.tapi.dates[env.index]
+        assert env.timestamp == datetime.fromtimestamp(env.epoch, timezone.utc)
+        assert env.timestamp is env.timestamp
+
+        end = env.timestamp + timedelta(seconds=17)
+        start = end - timedelta(minutes=env.period * env.obs_steps)
+        expected = pd.date_range(start=start, end=end, freq="5T").ceil("5T")[-env.obs_steps:]
+        assert env.get_index(end).equals(expected)
+        assert env.get_index(end).freqstr == "5T"
+
+        # Observation dates are kept as epochs, naive ends give naive indexes
+        assert env.get_dates()[-1] == env.epoch
+        assert (env.get_dates() == env.get_index().asi8 // 10 ** 9).all()
+        naive = env.get_index(end.replace(tzinfo=None))
+        assert naive.tz is None and (naive.asi8 == expected.asi8).all()
+
+
+def test_rolling_step(rolling_envs):
+    env, roll_env, col_roll_env = rolling_envs
+    obs = [e.reset() for e in rolling_envs]
+    assert (obs[0].values == obs[1].values).all()
+    assert (obs[0].values == obs[2].values).all()
+
+    action = np.array([0.3, 0.5, 0.2])
+    for _ in range(5):
+        obs = [e.step(action)[0] for e in rolling_envs]
+        assert (obs[0].index == obs[1].index).all()
+        assert (obs[0].values == obs[1].values).all()
+        assert (obs[0].values == obs[2].values).all()
+        assert env.calc_total_portval() == roll_env.calc_total_portval() == col_roll_env.calc_total_portval()
+
+
+def test_fixed_point_step():
+    env = BacktestEnvironment(period=5, obs_steps=5, tapi=make_feed(), fiat="USDT", name='env_test')
+    fixed_env = BacktestEnvironment(period=5, obs_steps=5, tapi=make_feed(), fiat="USDT", name='env_test',
+                                    precision=8)
+    env.reset()
+    fixed_env.reset()
+    assert fixed_env.calc_total_portval() == env.calc_total_portval()
+
+    action = np.array([0.3, 0.5, 0.2])
+    for _ in range(5):
+        env.step(action)
+        fixed_env.step(action)
+
+        assert fixed_env.account.balance() == {symbol: value.quantize(Decimal('1e-8'))
+                                               for symbol, value in fixed_env.balance.items()}
+        assert abs(fixed_env.calc_total_portval() - env.calc_total_portval()) < Decimal('1e-3')
+        assert fixed_env.portfolio_df.index[-1] == env.portfolio_df.index[-1]
+    shutil.rmtree(os.path.join(os.path.abspath(os.path.curdir), 'logs'))
+
+
+def test_batch_step():
+    env = BacktestEnvironment(period=5, obs_steps=5, tapi=make_feed(), fiat="USDT", name='env_test')
+    batch_env = BatchBacktestEnvironment(env)
+    actions = np.array([[0.3, 0.5, 0.2], [0.1, 0.1, 0.8], [0., 0., 1.]])
+
+    ohlc, portfolio = batch_env.reset(actions.shape[0])
+    assert ohlc.shape == (5, 2, 5)
+    assert portfolio.shape == (2, 3, 3)
+    assert (portfolio[-1] == [0., 0., 1.]).all()
+
+    rewards = np.array([batch_env.step(actions)[1] for _ in range(5)])
+    assert batch_env.portval_std().shape == (3,)
+
+    # Each portfolio matches a serial backtest
+    for k, action in enumerate(actions):
+        env.reset()
+        assert np.allclose([env.step(action)[1] for _ in range(5)], rewards[:, k], rtol=1e-9, atol=1e-12)
+        assert np.isclose(float(env.portfolio_df.portval.iat[-1]), batch_env.portval[k])
+        assert np.isclose(float(env.portfolio_df.portval.astype(np.float64).std()), batch_env.portval_std()[k])
+    shutil.rmtree(os.path.join(os.path.abspath(os.path.curdir), 'logs'))
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,62 @@
+"""
+Test best constant rebalanced portfolio solver
+"""
+import pytest
+from hypothesis import given, settings, strategies as st
+from hypothesis.extra.numpy import arrays
+import numpy as np
+
+from cryptotrader.envs.bcrp import bcrp, crp_log_wealth
+from cryptotrader.utils import batch_simplex_proj
+
+
+def random_hindsight(seed, T, n):
+    rng = np.random.RandomState(seed)
+    prices = np.exp(np.cumsum(0.01 * rng.randn(T + 1, n) + 0.0005 * rng.randn(n), axis=0))
+    hindsight = prices[1:] / prices[:-1]
+    hindsight[:, -1] = 1.
+    return hindsight
+
+
+def test_crp_log_wealth():
+    hindsight = random_hindsight(0, 100, 4)
+    portfolios = batch_simplex_proj(np.random.RandomState(1).rand(5, 4))
+
+    wealth = crp_log_wealth(hindsight, portfolios)
+    assert wealth.shape == (5,)
+    for portfolio, value in zip(portfolios, wealth):
+        assert np.allclose(value, np.log(hindsight.dot(portfolio)).sum())
+
+
+@settings(max_examples=30, deadline=None)
+@given(st.integers(min_value=0, max_value=2 ** 31), st.integers(min_value=10, max_value=2000),
+       st.integers(min_value=2, max_value=8), st.booleans())
+def test_bcrp(seed, T, n, collinear):
+    hindsight = random_hindsight(seed, T, n)
+    if collinear:
+        hindsight[:, 1] = hindsight[:, 0]
+
+    b = bcrp(hindsight)
+    assert np.allclose(b.sum(), 1.)
+    assert (b >= 0).all()
+
+    # KKT conditions
+    grad = hindsight.T.dot(1. / hindsight.dot(b))
+    assert np.allclose(grad[b > 0], T, rtol=1e-6)
+    assert (grad <= T * (1 + 1e-6)).all()
+
+    # No candidate does better
+    candidates = batch_simplex_proj(np.random.RandomState(seed).rand(1000, n) * 2 - .5)
+    assert crp_log_wealth(hindsight, b) >= crp_log_wealth(hindsight, candidates).max() - 1e-9
+
+
+@given(arrays(dtype=np.float64, shape=(50, 3), elements=st.floats(min_value=0.5, max_value=2.)))
+def test_bcrp_random_relatives(hindsight):
+    b = bcrp(hindsight)
+    assert np.allclose(b.sum(), 1.)
+    assert (b >= 0).all()
+    assert crp_log_wealth(hindsight, b) >= crp_log_wealth(hindsight, np.eye(3)).max() - 1e-9
+
+
+if __name__ == '__main__':
+    pytest.main()
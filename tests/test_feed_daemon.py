@@ -0,0 +1,323 @@
+"""
+Test feed daemon and clients
+"""
+import threading
+import asyncio
+from time import sleep, time
+import zmq
+import msgpack
+import pytest
+import numpy as np
+from cryptotrader.utils import unpack_frames
+from cryptotrader.datafeed import ResponseCache, FeedDaemon, DataFeed, AsyncDataFeed, SubscriberDataFeed, \
+    CHART_DTYPE, chart_array
+from cryptotrader.exceptions import DataFeedException
+from cryptotrader.exceptions import ExchangeError
+
+from .mocks import *
+
+
+def test_response_cache():
+    now = [0.]
+    cache = ResponseCache(max_size=2, clock=lambda: now[0])
+    calls = []
+
+    def request(value):
+        calls.append(value)
+        return value
+
+    assert cache.get('a', lambda: request(1), ttl=1) == 1
+    assert cache.get('a', lambda: request(2), ttl=1) == 1
+    now[0] = 1.5
+    assert cache.get('a', lambda: request(3), ttl=1) == 3
+    assert cache.get('b', lambda: request(4)) == 4
+    assert cache.get('c', lambda: request(5), ttl=0) == 5
+    assert cache.get('c', lambda: request(6), ttl=0) == 6
+    assert calls == [1, 3, 4, 5, 6]
+
+    # Least recently used entries go first
+    cache.get('d', lambda: request(7))
+    assert cache.get('b', lambda: request(8)) == 4
+    assert cache.get('a', lambda: request(9)) == 9
+
+    def fail():
+        raise ExchangeError('down')
+    with pytest.raises(ExchangeError):
+        cache.get('e', fail)
+    assert cache.get('e', lambda: request(10)) == 10
+
+
+def test_feed_daemon_cache():
+    class Api(object):
+        def __init__(self):
+            self.calls = []
+
+        def __call__(self, command, args={}):
+            self.calls.append(command)
+            sleep(0.1)
+            return {'command': command, 'calls': len(self.calls)}
+
+    api = Api()
+    daemon = FeedDaemon(api={'exchange': api})
+    daemon.context.term()
+
+    # Lock and thread holders are made on the daemon process
+    assert daemon.cache is None and daemon.executor is None
+    daemon.setup()
+
+    def request(req):
+        return daemon.request(req, daemon.handle_req(req))
+
+    # Concurrent identical requests make one upstream call
+    replies = []
+    threads = [threading.Thread(target=lambda: replies.append(request('exchange returnTicker'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert api.calls == ['returnTicker'] and len(replies) == 8
+    assert all(reply == replies[0] for reply in replies)
+
+    # Closed candles are kept, orders always reach the exchange
+    for _ in range(2):
+        request('exchange returnChartData USDT_BTC 300 1500000000 1500003000')
+        request('exchange buy USDT_BTC 1000 1')
+    assert api.calls == ['returnTicker', 'returnChartData', 'buy', 'buy']
+
+    assert daemon.get_ttl(daemon.handle_req('exchange returnChartData USDT_BTC 300 1500000000 None')) == 1
+    assert daemon.get_ttl(daemon.handle_req('exchange returnCurrencies')) == daemon.HOUR
+    assert daemon.get_ttl(daemon.handle_req('exchange sell USDT_BTC 1000 1')) is False
+
+
+def serve(daemon):
+    """ Run a FeedDaemon on threads of the test process """
+    daemon.setup()
+    clients = daemon.context.socket(zmq.ROUTER)
+    clients.bind(daemon.addr)
+    workers = daemon.context.socket(zmq.DEALER)
+    workers.bind("inproc://workers.inproc")
+    for target in [daemon.worker] * daemon.n_workers + [lambda: zmq.proxy(clients, workers)]:
+        threading.Thread(target=target, daemon=True).start()
+    return daemon
+
+
+def test_chart_array_framing(tmpdir):
+    records = [{'date': 1500000000 + 300 * i, 'high': 2. + i, 'low': 1., 'open': 1.5, 'close': '1.75',
+                'volume': 10., 'quoteVolume': 5., 'weightedAverage': 1.6} for i in range(4)]
+
+    class Api(object):
+        def __call__(self, command, args={}):
+            if args['currencyPair'] == 'BTC_USDT':
+                raise ExchangeError('Invalid currency pair.')
+            return records
+
+    addr = 'ipc://' + str(tmpdir.join('feed.ipc'))
+    serve(FeedDaemon(api={'exchange': Api()}, addr=addr, n_workers=2))
+
+    feed = DataFeed(5, ['USDT_BTC'], exchange='exchange', addr=addr, timeout=5)
+
+    # Candles come as a typed block over the received buffer
+    chart = feed.returnChartArray('USDT_BTC', 300, 1500000000, 1500000900)
+    assert chart.dtype == CHART_DTYPE and chart.shape == (4,) and not chart.flags.owndata
+    assert (chart == chart_array(records)).all()
+    assert (chart == chart_array(feed.returnChartData('USDT_BTC', 300, 1500000000, 1500000900))).all()
+    assert chart['close'][0] == 1.75 and chart['date'][-1] == records[-1]['date']
+
+    # Inverted pairs
+    inverted = feed.returnChartArray('BTC_USDT', 300, 1500000000, 1500000900)
+    assert 'BTC_USDT' in feed._inverted
+    assert (inverted['high'] == np.round(1. / chart['low'], 8)).all()
+    assert (inverted['volume'] == chart['quoteVolume']).all()
+    assert (inverted == feed.reciprocal_array(chart)).all()
+
+    assert chart_array([]).shape == (0,)
+
+    feed.close()
+
+
+def test_async_datafeed(tmpdir):
+    records = [{'date': 1500000000 + 300 * i, 'high': 2., 'low': 1., 'open': 1.5, 'close': 1.75,
+                'volume': 10., 'quoteVolume': 5., 'weightedAverage': 1.6} for i in range(4)]
+
+    class Api(object):
+        def __call__(self, command, args={}):
+            if command == 'returnChartData':
+                if args['currencyPair'] == 'BTC_USDT':
+                    raise ExchangeError('Invalid currency pair.')
+                sleep(float(args['start']) - 1500000000)
+                return records
+            if command == 'buy':
+                return {'orderNumber': '1', 'resultingTrades': []}
+            return {'USDT_BTC': {'last': '1000'}}
+
+    addr = 'ipc://' + str(tmpdir.join('feed.ipc'))
+    serve(FeedDaemon(api={'exchange': Api()}, addr=addr, n_workers=8))
+    feed = AsyncDataFeed(5, ['USDT_BTC'], exchange='exchange', addr=addr, timeout=5)
+    loop = asyncio.get_event_loop()
+
+    # Requests are pipelined, all pairs take as long as the slowest one
+    t0 = time()
+    charts = loop.run_until_complete(feed.get_charts(['USDT_BTC', 'USDT_ETH', 'USDT_LTC', 'USDT_XRP'], 300,
+                                                     1500000000.3, 1500000900))
+    assert time() - t0 < 1.
+    assert all((chart == chart_array(records)).all() for chart in charts)
+
+    async def requests():
+        return await asyncio.gather(feed.returnTicker(),
+                                    feed.returnChartData('BTC_USDT', 300, 1500000000, 1500000900),
+                                    feed.buy('USDT_BTC', 1000, 1, 'fillOrKill'))
+
+    ticker, inverted, order = loop.run_until_complete(requests())
+    assert ticker['USDT_BTC']['last'] == '1000' and order['orderNumber'] == '1'
+    assert 'BTC_USDT' in feed._inverted and inverted[0]['volume'] == records[0]['quoteVolume']
+
+    # A timed out request does not stall the others, its late reply is dropped
+    with pytest.raises(DataFeedException):
+        loop.run_until_complete(feed.get_response('returnChartData USDT_BTC 300 1500000000.5 1500000900', 0.1))
+    assert loop.run_until_complete(feed.returnTicker()) == ticker
+    sleep(0.5)
+    assert loop.run_until_complete(feed.returnTicker()) == ticker and not feed._pending
+
+    feed.close()
+
+
+def test_feed_broadcast(tmpdir):
+    class Api(object):
+        def __init__(self):
+            self.calls = []
+
+        def __call__(self, command, args={}):
+            self.calls.append(command)
+            if command == 'returnChartData':
+                dates = np.arange(-(-int(float(args['start'])) // 300) * 300, int(float(args['end'])) + 1, 300)
+                return [{'date': int(date), 'high': 2., 'low': 1., 'open': 1.5, 'close': date / 1e9,
+                         'volume': 10., 'quoteVolume': 5., 'weightedAverage': 1.6} for date in dates]
+            return {'USDT_BTC': {'last': '1000'}, 'calls': len(self.calls)}
+
+    api = Api()
+    addr, pub_addr = ['ipc://' + str(tmpdir.join(name)) for name in ('feed.ipc', 'pub.ipc')]
+    daemon = serve(FeedDaemon(api={'exchange': api}, addr=addr, n_workers=2, pub_addr=pub_addr,
+                              channels={'exchange': ['USDT_BTC']}))
+    sock = daemon.context.socket(zmq.PUB)
+    sock.bind(pub_addr)
+
+    feeds = [SubscriberDataFeed(5, ['USDT_BTC', 'BTC_USDT'], exchange='exchange', addr=addr, sub_addr=pub_addr,
+                                timeout=5) for _ in range(3)]
+    requests = []
+    for feed in feeds:
+        feed.get_response = lambda req, get_response=feed.get_response: requests.append(req) or get_response(req)
+
+    # Windows are seeded by a request, with closed candles only
+    end = int(time())
+    for feed in feeds:
+        chart = feed.returnChartArray('USDT_BTC', 300, end - 3000, end)
+        assert chart.size == 10 and (np.diff(chart['date']) == 300).all()
+        assert feed.charts[('USDT_BTC', 300)]['date'][-1] == chart['date'][-2]
+    assert len(requests) == 3
+
+    # Subscribers share one upstream fetch per closed candle
+    sleep(0.2)
+    closed = chart['date'][-2]
+    last = {('exchange', 'USDT_BTC'): closed - 600}
+    daemon.publish(sock, last)
+    assert api.calls[-2:] == ['returnTicker', 'returnChartData'] and last[('exchange', 'USDT_BTC')] == closed
+    n_calls = len(api.calls)
+    for _ in range(3):
+        daemon.publish(sock, last)
+    assert 'returnChartData' not in api.calls[n_calls:]
+
+    sleep(0.1)
+    for feed in feeds:
+        assert feed.update() > 0
+        assert (feed.returnChartArray('USDT_BTC', 300, end - 3000, end) == chart[:-1]).all()
+        assert feed.returnTicker()['USDT_BTC']['last'] == '1000'
+        inverted = feed.charts[('BTC_USDT', 300)]
+        assert (inverted['volume'] == 5.).all() and inverted['date'][-1] == closed
+    assert len(requests) == 3
+
+    # Gaps drop the older bars
+    feed = feeds[0]
+    window = feed.charts[('USDT_BTC', 300)]
+    later = window[-1:].copy()
+    later['date'] -= 300
+    feed.charts[('USDT_BTC', 300)] = window[:-5]
+    feed.merge(('USDT_BTC', 300), later)
+    assert feed.charts[('USDT_BTC', 300)].size == 1
+
+    for feed in feeds:
+        feed.close()
+
+
+def test_batch_requests(tmpdir):
+    records = [{'date': 1500000000 + 300 * i, 'high': 2., 'low': 1., 'open': 1.5, 'close': 1.75,
+                'volume': 10., 'quoteVolume': 5., 'weightedAverage': 1.6} for i in range(4)]
+
+    class Api(object):
+        def __init__(self):
+            self.calls = []
+
+        def __call__(self, command, args={}):
+            self.calls.append((command, args))
+            sleep(0.2)
+            if command == 'returnChartData':
+                if args['currencyPair'] == 'BTC_USDT':
+                    raise ExchangeError('Invalid currency pair.')
+                return records
+            return {'command': command}
+
+    api = Api()
+    addr = 'ipc://' + str(tmpdir.join('feed.ipc'))
+    daemon = serve(FeedDaemon(api={'exchange': api}, addr=addr, n_workers=2))
+
+    # Named arguments build the same calls as text requests
+    assert daemon.handle_call('exchange', 'returnChartData', {'currencyPair': 'usdt_btc', 'period': 300,
+                                                              'start': 1500000000, 'end': 1500003000}) == \
+           daemon.handle_req('exchange returnChartData usdt_btc 300 1500000000 1500003000')
+    assert daemon.handle_req('exchange buy USDT_BTC 1000 1 False') == \
+           ('exchange', 'buy', {'currencyPair': 'USDT_BTC', 'rate': '1000', 'amount': '1'})
+    assert daemon.handle_req('exchange sell USDT_BTC 1000 1 postOnly')[2]['postOnly'] == 1
+    with pytest.raises(ExchangeError):
+        daemon.handle_call('exchange', 'buy', {'currencyPair': 'USDT_BTC', 'rate': 1000})
+
+    feed = DataFeed(5, ['USDT_BTC', 'BTC_USDT'], exchange='exchange', addr=addr, timeout=5)
+    round_trips = []
+    send_request = feed.send_request
+    feed.send_request = lambda msg, name: round_trips.append(name) or send_request(msg, name)
+
+    # Parts run concurrently on one round trip
+    t0 = time()
+    ticker, balances, chart, error = feed.get_batch([
+        ('returnTicker', {}),
+        ('returnBalances', {}),
+        ('returnChartArray', {'currencyPair': 'USDT_BTC', 'period': 300, 'start': 1500000000, 'end': 1500000900}),
+        ('returnChartArray', {'currencyPair': 'BTC_USDT', 'period': 300, 'start': 1500000000, 'end': 1500000900})
+        ])
+    assert time() - t0 < 0.6 and len(round_trips) == 1
+    assert ticker == {'command': 'returnTicker'} and balances == {'command': 'returnBalances'}
+    assert (chart == chart_array(records)).all() and not chart.flags.owndata
+    assert error == 'Invalid currency pair.'
+
+    # All pairs charts on one round trip, inverted pairs are remembered
+    charts = feed.get_charts(['USDT_BTC', 'BTC_USDT'], 300, 1500000000, 1500000900)
+    assert len(round_trips) == 3 and feed._inverted == {'BTC_USDT'}
+    assert (charts[0] == chart).all() and (charts[1] == feed.reciprocal_array(chart)).all()
+    charts = feed.get_charts(['USDT_BTC', 'BTC_USDT'], 300, 1500000000, 1500000900)
+    assert len(round_trips) == 4 and (charts[1] == feed.reciprocal_array(chart)).all()
+
+    # Text requests are still served
+    assert feed.returnTicker() == ticker
+
+    # Malformed requests get an error reply, the workers keep serving
+    for req in [b'\x81\xa5batch', msgpack.packb({'batch': 1}), msgpack.packb({'batch': [1, 'x']}),
+                msgpack.packb({'exchange': 'exchange'})]:
+        feed.sock.send(req)
+        assert feed.sock.poll(5000)
+        rep = unpack_frames(feed.sock.recv_multipart(copy=False))
+        assert isinstance(rep, str) or all(isinstance(item, str) for item in rep)
+    assert feed.returnTicker() == ticker
+
+    feed.close()
+
+
+if __name__ == '__main__':
+    pytest.main()
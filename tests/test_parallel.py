@@ -0,0 +1,83 @@
+"""
+Test parallel hyperparameter evaluation
+"""
+import pytest
+import numpy as np
+import optunity as ot
+
+from cryptotrader.agents.parallel import GenerationMap, FitPool, SeededMap, stack_params
+
+
+class RandomAgent(object):
+    """ Scores a random draw, so scores depend on evaluation seeding """
+    def set_params(self, **kwargs):
+        self.x = kwargs['x']
+
+    def score(self, env, batch_size, **kwargs):
+        return self.x + np.random.rand()
+
+
+class Feed(object):
+    def share_memory(self):
+        self.shared = True
+
+
+class Env(object):
+    tapi = Feed()
+
+
+def test_stack_params():
+    params = stack_params([{'variant': 'a', 'C': None, 'x': 1.}, {'variant': 'b', 'C': 2., 'x': 3}])
+    assert list(params['variant']) == ['a', 'b']
+    assert np.isnan(params['C'][0]) and params['C'][1] == 2.
+    assert params['x'].dtype == np.float64
+
+
+def test_generation_map():
+    calls = []
+
+    def score(candidates):
+        calls.append(len(candidates))
+        return [candidate['x'] ** 2 for candidate in candidates]
+
+    pmap = GenerationMap(score, {'x': [0, 2]}, constraints=[lambda x: x < 1.5])
+
+    def f(x):
+        return pmap.pop({'x': x}) if pmap.cached({'x': x}) else -1
+
+    assert pmap(lambda d: f(**d), [{'x': 0.5}, {'x': 1.}, {'x': 1.8}, {'x': 3.}]) == [0.25, 1., -1, -1]
+    assert calls == [2] and pmap.n_evals == 2 and not pmap.scores
+
+    # Points on the box bounds are scored with the generation
+    assert pmap(lambda d: f(**d), [{'x': 0.}, {'x': 2.}, {'x': 1.}]) == [0., -1, 1.]
+    assert calls == [2, 2] and pmap.n_evals == 4 and not pmap.scores
+
+    # Structured spaces are decoded before scoring
+    tree = ot.search_spaces.SearchTree({'variant': {'a': {'x': [0, 1]}, 'b': {'x': [0, 1]}}})
+    pmap = GenerationMap(lambda candidates: [candidate['variant'] for candidate in candidates], tree.to_box(), tree)
+    pmap(lambda d: None, [{'variant': 1.5, 'variant|a|x': 0.5, 'variant|b|x': 0.2}])
+    assert pmap.pop({'variant': 'b', 'x': 0.2}) == 'b'
+
+
+def test_fit_pool():
+    env = Env()
+    pool = FitPool(RandomAgent(), env, 2, 1, 42)
+    try:
+        assert env.tapi.shared
+        scores = pool([{'x': 0.}, {'x': 1.}, {'x': 0.}])
+        # Each evaluation is seeded, so equal params score equal
+        assert scores[0] == scores[2]
+        assert scores[1] == scores[0] + 1
+        assert pool([{'x': 1.}]) == [scores[1]]
+    finally:
+        pool.close()
+
+    # In process evaluations score as the workers do and keep the caller random state
+    np.random.seed(0)
+    state = np.random.get_state()[1].copy()
+    assert SeededMap(RandomAgent(), env, 1, 42)([{'x': 0.}, {'x': 1.}]) == scores[:2]
+    assert (np.random.get_state()[1] == state).all()
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,300 @@
+"""
+Test multi timeframe OHLCV resampling
+"""
+import json
+import pytest
+from hypothesis import given, settings, strategies as st
+import numpy as np
+import pandas as pd
+
+from cryptotrader.datafeed import load_candles
+from cryptotrader.envs.resample import resample_ohlc, resample_multi, OHLCResampler, aggregate_trades, fill_gaps, fill_bars
+from cryptotrader.envs.utils import get_dfs_from_db, get_historical, read_historical, save_historical
+
+
+def random_bars(seed, T, period=30, gaps=True):
+    rng = np.random.RandomState(seed)
+    dates = 1500000000 // (period * 60) * period * 60 + np.arange(T, dtype=np.int64) * period * 60
+    if gaps:
+        dates = dates[rng.rand(T) > 0.1]
+    close = 100 * np.exp(np.cumsum(0.01 * rng.randn(dates.shape[0])))
+    open = np.append(close[:1], close[:-1])
+    high = np.maximum(open, close) * (1 + 0.01 * rng.rand(dates.shape[0]))
+    low = np.minimum(open, close) * (1 - 0.01 * rng.rand(dates.shape[0]))
+    volume = rng.rand(dates.shape[0])
+    return dates, np.stack([open, high, low, close, volume], axis=-1)
+
+
+def pandas_resample(dates, ohlc, period):
+    df = pd.DataFrame(ohlc, index=pd.to_datetime(dates, unit='s'),
+                      columns=['open', 'high', 'low', 'close', 'volume'])
+    out = df.resample('%dmin' % period).agg({'open': 'first', 'high': 'max', 'low': 'min',
+                                             'close': 'last', 'volume': 'sum'}).dropna()
+    return out.index.values.astype(np.int64) // 10 ** 9, out[['open', 'high', 'low', 'close', 'volume']].values
+
+
+@settings(max_examples=30, deadline=None)
+@given(st.integers(min_value=0, max_value=2 ** 31), st.integers(min_value=1, max_value=500),
+       st.sampled_from([60, 120, 240, 1440]))
+def test_resample_ohlc(seed, T, period):
+    dates, ohlc = random_bars(seed, T)
+    bin_dates, bars = resample_ohlc(dates, ohlc, period)
+    ref_dates, ref_bars = pandas_resample(dates, ohlc, period)
+
+    assert np.array_equal(bin_dates, ref_dates)
+    assert np.allclose(bars, ref_bars)
+
+
+def test_resample_ohlc_pairs_axis():
+    dates, ohlc = random_bars(0, 300)
+    other = random_bars(1, 300, gaps=False)[1][:dates.shape[0]]
+    stacked = np.stack([ohlc, other], axis=1)
+
+    bin_dates, bars = resample_ohlc(dates, stacked, 120)
+    assert bars.shape == (bin_dates.shape[0], 2, 5)
+    assert np.allclose(bars[:, 0], resample_ohlc(dates, ohlc, 120)[1])
+    assert np.allclose(bars[:, 1], resample_ohlc(dates, other, 120)[1])
+
+
+def test_resample_ohlc_empty():
+    bin_dates, bars = resample_ohlc(np.empty(0, dtype=np.int64), np.empty((0, 5)), 120)
+    assert bin_dates.shape == (0,)
+    assert bars.shape == (0, 5)
+
+
+def test_resample_multi():
+    dates, ohlc = random_bars(2, 1000)
+    frames = resample_multi(dates, ohlc, 30, [240, 120, 30])
+
+    assert sorted(frames) == [30, 120, 240]
+    assert np.array_equal(frames[30][1], ohlc)
+    for period in (120, 240):
+        direct_dates, direct_bars = resample_ohlc(dates, ohlc, period)
+        assert np.array_equal(frames[period][0], direct_dates)
+        assert np.allclose(frames[period][1], direct_bars)
+
+    with pytest.raises(AssertionError):
+        resample_multi(dates, ohlc, 30, [45])
+
+
+@settings(max_examples=20, deadline=None)
+@given(st.integers(min_value=0, max_value=2 ** 31), st.lists(st.integers(min_value=1, max_value=50), max_size=10))
+def test_ohlc_resampler(seed, splits):
+    dates, ohlc = random_bars(seed, 300)
+    resampler = OHLCResampler(30, [120, 240], length=4)
+
+    for chunk in np.split(np.arange(dates.shape[0]), np.cumsum(splits)):
+        resampler.update(dates[chunk], ohlc[chunk])
+
+    for period in (120, 240):
+        bin_dates, bars = resample_ohlc(dates, ohlc, period)
+        assert np.array_equal(resampler.get(period)[0], bin_dates)
+        assert np.allclose(resampler.get(period)[1], bars)
+
+    with pytest.raises(AssertionError):
+        resampler.update(dates[:1], ohlc[:1])
+
+    resampler.clear()
+    assert resampler.get(120)[0].shape == (0,)
+
+
+def test_fill_bars():
+    dates = np.array([0, 60, 180, 200, 240], dtype=np.int64)
+    ohlc = np.full((5, 2, 5), np.nan)
+    ohlc[1, 0] = [1., 2., .5, 1.5, 1.]
+    ohlc[[2, 4], 0] = [2., 2.5, 1., 2., 1.]
+    ohlc[:, 1] = [1., 1., 1., 1., 1.]
+    ohlc[3, 1] = [9., 9., 9., 9., 9.]
+    ohlc[4, 1, [0, 4]] = np.nan
+
+    grid, out, synthetic = fill_bars(dates, ohlc, 1, end=300)
+    assert list(grid) == [0, 60, 120, 180, 240, 300]
+    assert list(synthetic[:, 0]) == [True, False, True, False, False, True]
+    assert list(synthetic[:, 1]) == [False, False, True, False, False, True]
+    assert not np.isnan(out).any()
+
+    # Previous close, first known close before any, zero volume
+    assert list(out[0, 0]) == [1.5, 1.5, 1.5, 1.5, 0.]
+    assert list(out[2, 0]) == [1.5, 1.5, 1.5, 1.5, 0.]
+    assert list(out[5, 0]) == [2., 2., 2., 2., 0.]
+    # Off grid dates are dropped and missing fields of real bars take the close
+    assert 9. not in out[:, 1]
+    assert list(out[4, 1]) == [1., 1., 1., 1., 0.]
+
+    grid, out, synthetic = fill_bars(dates[:2], ohlc[:2, 1], 1)
+    assert list(grid) == [0, 60] and (out == ohlc[:2, 1]).all() and not synthetic.any()
+
+
+def random_trades(seed, n):
+    rng = np.random.RandomState(seed)
+    # Bursts of trades with silent periods between them
+    dates = 1500000000 + np.cumsum(1 + rng.exponential(20, n) * (1 + 200 * (rng.rand(n) > 0.97))).astype(np.int64)
+    rates = 100 * np.exp(np.cumsum(0.001 * rng.randn(n)))
+    return [{'date': str(pd.Timestamp(date, unit='s')), 'rate': '%.8f' % rate, 'amount': '%.8f' % amount}
+            for date, rate, amount in zip(dates, rates, rng.rand(n))]
+
+
+def pandas_trades(trades, period):
+    df = pd.DataFrame.from_records(trades)
+    df.index = pd.to_datetime(df['date'])
+    rate, amount = df['rate'].astype(float), df['amount'].astype(float)
+    freq = '%dmin' % period
+    out = pd.DataFrame({'open': rate.resample(freq).first(), 'high': rate.resample(freq).max(),
+                        'low': rate.resample(freq).min(), 'close': rate.resample(freq).last(),
+                        'volume': amount.resample(freq).sum()})
+    out['close'] = out['close'].ffill()
+    for field in ('open', 'high', 'low'):
+        out[field] = out[field].fillna(out['close'])
+    out['volume'] = out['volume'].fillna(0.)
+    return out.index.values.astype(np.int64) // 10 ** 9, out[['open', 'high', 'low', 'close', 'volume']].values
+
+
+@settings(max_examples=20, deadline=None)
+@given(st.integers(min_value=0, max_value=2 ** 31), st.integers(min_value=1, max_value=2000),
+       st.integers(min_value=1, max_value=500), st.sampled_from([1, 5, 30]))
+def test_aggregate_trades(seed, n, batch_size, period):
+    trades = random_trades(seed, n)
+    batches = list(aggregate_trades(iter(trades), period, batch_size))
+    assert all(dates.shape[0] for dates, _ in batches)
+
+    dates, bars = np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+    ref_dates, ref_bars = pandas_trades(trades, period)
+    assert np.array_equal(dates, ref_dates)
+    assert np.allclose(bars, ref_bars)
+
+
+def test_aggregate_trades_json_lines(tmpdir):
+    trades = random_trades(0, 1000)
+    path = str(tmpdir.join('trades.jsonl'))
+    with open(path, 'w') as file:
+        for trade in trades:
+            file.write(json.dumps(trade) + '\n')
+
+    with open(path) as file:
+        batches = list(aggregate_trades((json.loads(line) for line in file), 5, batch_size=64))
+    assert np.allclose(np.concatenate([b[1] for b in batches]), pandas_trades(trades, 5)[1])
+
+    assert list(aggregate_trades([], 5)) == []
+    with pytest.raises(AssertionError):
+        list(aggregate_trades(trades[::-1], 5))
+
+
+def test_fill_gaps():
+    dates = np.array([0, 60, 240], dtype=np.int64)
+    bars = np.array([[1., 2., .5, 1.5, 1.], [1.5, 3., 1., 2., 1.], [2., 2.5, 1.5, 2.5, 1.]])
+    grid, out = fill_gaps(dates, bars, 1)
+    assert list(grid) == [0, 60, 120, 180, 240]
+    assert (out[[0, 1, 4]] == bars).all()
+    assert (out[[2, 3]] == [2., 2., 2., 2., 0.]).all()
+
+    grid, out = fill_gaps(dates[1:], bars[1:], 1, start=0, close=1.)
+    assert list(out[0]) == [1., 1., 1., 1., 0.]
+
+
+class Cursor(list):
+    def sort(self, key, direction):
+        return Cursor(sorted(self, key=lambda item: item[key], reverse=direction < 0))
+
+
+class Database(dict):
+    def collection_names(self):
+        return list(self)
+
+
+class Collection(list):
+    def create_index(self, key):
+        self.indexes = getattr(self, 'indexes', []) + [key]
+
+    def find(self, filt=None):
+        if filt is None:
+            return Cursor(self)
+        return Cursor(item for item in self if item['date'] > filt['date']['$gt'])
+
+
+def test_get_dfs_from_db(tmpdir):
+    trades = random_trades(3, 3000)
+    conn = Database(poloniex_btc_trades=Collection(trades[::-1]))
+
+    symbols, dfs = get_dfs_from_db(conn, 'poloniex', freq='5min', batch_size=100)
+    ref_dates, ref_bars = pandas_trades(trades, 5)
+    assert symbols == ['btc'] and conn['poloniex_btc_trades'].indexes == ['date']
+    assert np.array_equal(dfs[0].index.values.astype(np.int64) // 10 ** 9, ref_dates)
+    assert np.allclose(dfs[0].values, ref_bars)
+
+    symbols, dfs = get_dfs_from_db(conn, 'poloniex', start=trades[1000]['date'], freq='5min',
+                                   save_dir=str(tmpdir), batch_size=100)
+    assert dfs == []
+    df = load_candles(str(tmpdir.join('poloniex_btc_5min')))
+    ref_dates, ref_bars = pandas_trades(trades[1001:], 5)
+    assert np.array_equal(df['date'].values, ref_dates)
+    assert np.allclose(df[['open', 'high', 'low', 'close', 'volume']].values, ref_bars)
+
+
+def historical_csv(path, n=5000):
+    rng = np.random.RandomState(0)
+    close = 1000 * np.exp(np.cumsum(0.001 * rng.randn(n)))
+    df = pd.DataFrame({'Timestamp': 1483228800 + 60 * np.arange(n), 'Open': close, 'High': close * 1.001,
+                       'Low': close * 0.999, 'Close': close, 'Volume_(BTC)': rng.rand(n),
+                       'Volume_(Currency)': rng.rand(n), 'Weighted_Price': close},
+                      columns=['Timestamp', 'Open', 'High', 'Low', 'Close', 'Volume_(BTC)', 'Volume_(Currency)',
+                               'Weighted_Price'])
+    df.iloc[rng.rand(n) < 0.05, 1:] = np.nan
+    df.iloc[:3, 1:] = np.nan
+    df.to_csv(path, index=False)
+
+    df['Timestamp'] = pd.to_datetime(df.Timestamp, unit='s')
+    return df.set_index('Timestamp').drop(['Volume_(Currency)', 'Weighted_Price'], axis=1)
+
+
+@pytest.mark.parametrize("chunksize", [1, 333, 10000])
+def test_read_historical(tmpdir, chunksize):
+    path = str(tmpdir.join('bitstamp.csv'))
+    df = historical_csv(path)
+    start, end = '2017-01-01 03:07:00', '2017-01-03 10:00:00'
+
+    batches = list(read_historical(path, start, end, chunksize))
+    assert all(dates.shape[0] <= chunksize for dates, _ in batches)
+    dates, ohlc = np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+
+    ref = df[(df.index > start) & (df.index < end)].ffill().fillna(1e-8)
+    assert np.array_equal(dates, ref.index.values.astype(np.int64) // 10 ** 9)
+    assert np.allclose(ohlc, ref.values)
+
+
+def test_get_historical(tmpdir):
+    path = str(tmpdir.join('bitstamp.csv'))
+    df = historical_csv(path)
+
+    ref = df[df.index > '2017-01-01 03:07:00'].ffill().fillna(1e-8)
+    ref = ref.resample('30min').agg({'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last',
+                                     'Volume_(BTC)': 'sum'})[['Open', 'High', 'Low', 'Close', 'Volume_(BTC)']]
+
+    for source in (path, df):
+        out = get_historical(source, 30, start='2017-01-01 03:07:00', chunksize=1000)
+        assert list(out.columns) == ['open', 'high', 'low', 'close', 'volume']
+        assert out.index.equals(ref.index)
+        assert out.index.name == 'Timestamp' and out.index.freqstr == '30T'
+        assert np.allclose(out.astype(np.float64).values, ref.values)
+
+    candles = str(tmpdir.join('bitstamp_30min'))
+    assert save_historical(path, candles, 30, start='2017-01-01 03:07:00', chunksize=1000) == ref.shape[0]
+    stored = load_candles(candles)
+    assert np.array_equal(stored['date'].values, ref.index.values.astype(np.int64) // 10 ** 9)
+    assert np.allclose(stored[['open', 'high', 'low', 'close', 'volume']].values, ref.values)
+
+    # Periods without rows have nan prices and zero volume
+    df = df[(df.index < '2017-01-02 00:00:00') | (df.index > '2017-01-02 02:00:00')]
+    csv = df.reset_index()
+    csv['Timestamp'] = csv['Timestamp'].values.astype(np.int64) // 10 ** 9
+    csv.to_csv(path, index=False)
+    ref = df.ffill().fillna(1e-8).resample('30min').agg({'Open': 'first', 'High': 'max', 'Low': 'min',
+                                                         'Close': 'last', 'Volume_(BTC)': 'sum'})
+    for source in (path, df):
+        out = get_historical(source, 30, chunksize=1000).astype(np.float64)
+        assert out.index.equals(ref.index)
+        assert np.isnan(out['open'].values).sum() == 4 and out['volume'].values.min() == 0
+        assert np.allclose(out.values, ref[['Open', 'High', 'Low', 'Close', 'Volume_(BTC)']].values, equal_nan=True)
+
+
+if __name__ == '__main__':
+    pytest.main()
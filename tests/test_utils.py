@@ -10,7 +10,7 @@ from hypothesis.extra.numpy import arrays, array_shapes
 from math import nan
 import numpy as np
 
-from cryptotrader.utils import convert_to, array_normalize, array_softmax
+from cryptotrader.utils import convert_to, array_normalize, array_softmax, simplex_proj, batch_simplex_proj
 from decimal import Decimal, InvalidOperation, Overflow
 
 @given(st.one_of(st.floats(allow_nan=False, allow_infinity=False), st.integers()))
@@ -38,6 +38,14 @@ def test_array_normalize(data):
 def test_array_softmax(data):
     array_softmax(data)
 
+@given(arrays(dtype=np.float64,
+              shape=st.tuples(st.integers(min_value=1, max_value=5), st.integers(min_value=2, max_value=6)),
+              elements=st.floats(allow_nan=False, allow_infinity=False, max_value=1e3, min_value=-1e3)))
+def test_batch_simplex_proj(data):
+    out = batch_simplex_proj(data)
+    assert np.allclose(out, [simplex_proj(row) for row in data])
+    assert np.allclose(out.sum(axis=1), 1.)
+
 
 if __name__ == '__main__':
     pytest.main()
\ No newline at end of file